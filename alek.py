@@ -9,13 +9,27 @@
 #  or (at your option) any later version.
 #
 
+from array import array
+import ast
+import asyncio
+import hashlib
+import heapq
+import json
+import marshal
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import os
+import random
+import sys
+import time
+
 from PyQt5.QtCore import Qt, QSize, QPoint, QRect, QLine, pyqtSignal
-from PyQt5.QtGui import (QPainter, qRgb, qGray, QColor,
-    QPen, QFont, QImage, QPalette, QPolygon)
+from PyQt5.QtGui import (QPainter, qRgb, qGray, QColor, QBrush,
+    QPen, QFont, QImage, QPixmap, QPalette, QPolygon)
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget,
     QTableWidget, QTableWidgetItem, QTableWidgetSelectionRange,
-    QHeaderView, QTabBar, QToolButton, QMenu, QAction, QFrame,
-    QStackedWidget, QFileDialog)
+    QHeaderView, QTabBar, QToolButton, QMenu, QAction, QActionGroup, QFrame,
+    QStackedWidget, QFileDialog, QInputDialog, QMessageBox)
 
 
 ##############################################################################
@@ -23,14 +37,101 @@ from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget,
 #  global tables
 #
 
+# memory configuration (see configureMemory): cells have Digits decimal
+# digits, and there are as many cells as numbers, so every number is an
+# address
+Digits = 3
+Cells = 1000
+
 Map = list(range(1000))
-Mem = [0] * 1000
+Maps = [Map]        # Map and the maps of CPUs with private pages
+Mem = array('H', [0] * 1000)    # 2 bytes per cell instead of a boxed int
 
 NumToChar = [""] * 1000
 CharToNum = [4] * 128
 
 NumToBits = [0] * 1000
 BitsToNum = [0] * 1000
+BitsMask = 0o777    # all bits of the octal digits of a cell
+
+# debugger stops (VirtualCPU.Stop flags for each address) and register
+# conditions, shared by all CPUs
+Stops = bytearray(1000)
+Conditions = []     # [register, bytearray with 1 for values that stop, last
+                    # value of each CPU (indexed by VirtualCPU.number)]
+
+# VirtualCPU.PageFlag protection attributes for each page
+PageFlags = bytearray(10)
+
+# Map translates addresses to Mem indices; Mem grows beyond 1000 cells
+# for pages private to additional CPUs and for allocated pages
+def allocPage():
+    Mem.extend([0] * 100)
+    return len(Mem) - 100
+
+# With 4 digits, only the first 1000 cells (with the devices) are allocated
+# at first. All other pages map to the zero page and are marked Unallocated,
+# so the first write to them traps and allocates the page.
+ZeroPage = 1000     # Mem index of the zero page
+
+def newMemory():
+    # Map, Mem and PageFlags for the configured number of cells
+    pages = Cells // 100
+    memoryMap = list(range(1000))
+    mem = array('H', [0] * 1000)
+    pageFlags = bytearray(pages)
+    if pages > 10:
+        mem.extend([0] * 100)
+        zero = list(range(ZeroPage, ZeroPage + 100))
+        memoryMap.extend(zero * (pages - 10))     # shares the int objects
+        for page in range(10, pages):
+            pageFlags[page] = VirtualCPU.PageFlag.Unallocated
+    return memoryMap, mem, pageFlags
+
+def allocatePage(page):
+    # give the page its own cells in all maps that still have the zero page
+    a = allocPage()
+    for m in Maps:
+        if m[100 * page] == ZeroPage:
+            for i in range(100):
+                m[100 * page + i] = a + i
+    PageFlags[page] &= ~VirtualCPU.PageFlag.Unallocated
+
+def touchPage(a):
+    # called before writing to address a from outside the CPU
+    if PageFlags[a // 100] & VirtualCPU.PageFlag.Unallocated:
+        allocatePage(a // 100)
+
+def protectPage(page, flags):
+    # sets the ReadOnly/NoExecute/StackOnly flags of a page; an unallocated
+    # page keeps mapping to the zero page until its first write
+    PageFlags[page] = PageFlags[page] & VirtualCPU.PageFlag.Unallocated | flags
+
+def configureMemory(digits):
+    # 3 digits: the classic 1000 cells, 4 digits: 10000 cells
+    global Digits, Cells, Map, Maps, Mem, Stops, PageFlags
+    Digits = digits
+    Cells = 10 ** digits
+    Map, Mem, PageFlags = newMemory()
+    Maps = [Map]
+    Stops = bytearray(Cells)
+    Conditions.clear()
+    VirtualCPU.microOpCache.clear()     # labels have Digits digits
+    initTables()
+
+# video palettes [name, qRgb of each cell value, QColor of each cell value],
+# computed once (see initColorTables) and shared by all VirtualGPUs
+Palettes = []
+
+# indexed by VirtualCPU.Addressing, then by the mode cell of a (##) operand
+EAModes = [[None] * 1000, [None] * 1000]    # address accessor functions
+EAExtra = [[0] * 1000, [0] * 1000]          # number of extra cells used
+EALabels = [[""] * 1000, [""] * 1000]       # "##" is the extra cell
+
+# indexed by instruction codes, which have 3 digits (fetch() turns larger
+# numbers into code 000)
+CycleCost = [1] * 1000          # cycles used by each instruction code
+PrefixCycleCost = [0] * 1000    # additional cycles of 990/890 instructions
 
 
 ##############################################################################
@@ -38,6 +139,9 @@ BitsToNum = [0] * 1000
 def initTables():
     initCharTables()
     initBitsTables()
+    initAddrTables()
+    initCycleTables()
+    initColorTables()
 
 def initCharTables():
     cmap = (
@@ -52,6 +156,7 @@ def initCharTables():
         "jklmnopqrs"
         "tuvwxyz{|}"
     )
+    NumToChar[100:] = [""] * (Cells - 100)
     for x in range(100):
         char = cmap[x]
         NumToChar[x] = char;
@@ -59,15 +164,135 @@ def initCharTables():
             CharToNum[ord(char)] = x
 
 def initBitsTables():
-    for d2 in range(8):
-        for d1 in range(8):
-            v8 = (d2 * 8 + d1) * 8
-            v10 = (d2 * 10 + d1) * 10
-            for d0 in range(8):
-                bits = v8 + d0
-                num = v10 + d0
-                NumToBits[num] = bits
-                BitsToNum[bits] = num
+    # each decimal digit 0..7 is an octal digit (3 bits), 8 and 9 are 0
+    global BitsMask
+    BitsMask = 8 ** Digits - 1
+    NumToBits[:] = [0] * Cells
+    BitsToNum[:] = [0] * Cells
+    for bits in range(BitsMask + 1):
+        num = int(oct(bits)[2:])
+        NumToBits[num] = bits
+        BitsToNum[bits] = num
+
+def initColorTables():
+    if not Palettes:
+        color = [min(255, int(230 * ((v / 8) ** 0.85))) for v in range(10)]
+        contrast = [0, 0, 0, 51, 102, 153, 204, 255, 255, 255]
+        rgb = [qRgb(color[i // 100], color[(i // 10) % 10], color[i % 10]) for i in range(1000)]
+        Palettes.append(["Color", array('I', rgb), []])
+        Palettes.append(["Grayscale", array('I', [qRgb(qGray(c), qGray(c), qGray(c)) for c in rgb]), []])
+        Palettes.append(["High Contrast", array('I', [qRgb(contrast[i // 100],
+            contrast[(i // 10) % 10], contrast[i % 10]) for i in range(1000)]), []])
+    for palette in Palettes:
+        # 4-digit cells use the colors of their last 3 digits
+        palette[1][1000:] = palette[1][:1000] * (Cells // 1000 - 1)
+        del palette[2][1000:]
+
+def paletteColors(palette):
+    # the QColors are made when first needed (the debug server never paints)
+    colors = palette[2]
+    if not colors:
+        colors.extend([QColor(rgb) for rgb in palette[1][:1000]])
+    if len(colors) < Cells:
+        colors.extend(colors[:1000] * (Cells // 1000 - 1))
+    return colors
+
+def initAddrTables():
+    for table in EAModes + EAExtra + EALabels:
+        table[1000:] = table[:1000] * (Cells // 1000 - 1)  # in place, CPUs keep them
+    for v in range(Cells):
+        EAModes[0][v] = makeClassicEA(v)
+        EALabels[0][v] = "(" + str(v).zfill(Digits) + ")"
+        EAModes[1][v], EAExtra[1][v], EALabels[1][v] = makeExtendedEA(v)
+
+def initCycleTables():
+    for op in range(1000):
+        d = op // 100
+        dmem = 1 if (op // 10) % 10 >= 5 else 0
+        smem = 1 if op % 10 >= 5 else 0
+        c = 1
+        if d in [1, 2, 6]:
+            c = 2 + dmem + smem     # ADD, SUB, CMP
+        elif d == 3:
+            c = 8 + dmem + smem     # MUL
+        elif d == 4:
+            c = 12 + dmem + smem    # DIV
+        elif d == 5:
+            c = 1 + dmem + smem     # MOV
+        elif d == 7:
+            c = 2 + smem            # JMP
+        elif op // 10 in [91, 92, 82, 85]:
+            c = 1 + smem            # INC, DEC, NEG, MOVZ
+        elif op // 10 in [93, 94, 95, 96, 86]:
+            c = 2 + smem            # IN, OUT, POP, PUSH, CMPZ
+        elif op // 10 in [97, 87]:
+            c = 3 + smem            # CALL, RETcc
+        elif op in [994, 996]:
+            c = 2                   # OUTZ, PUSHZ
+        elif op == 997:
+            c = 3                   # RET
+        CycleCost[op] = c
+        if d in [1, 2, 3, 4, 5, 6]:
+            PrefixCycleCost[op] = 1 + dmem + smem
+        elif d == 9:
+            PrefixCycleCost[op] = 1 + smem
+
+def makeClassicEA(v):
+    return lambda cpu: v
+
+def regName(r):
+    return "SP" if r == 0 else "R" + str(r)
+
+def makeExtendedEA(v):
+    if v < 900:
+        r = v // 100
+        disp = v % 100
+        if disp == 0:
+            # (Indirect)
+            return (lambda cpu: cpu.reg[r]), 0, "(" + regName(r) + ")"
+        # (Relative)
+        return ((lambda cpu: (cpu.reg[r] + disp) % Cells), 0,
+            "(" + regName(r) + "+" + str(disp) + ")")
+    v -= 900
+    if v < 90:
+        b = v // 10
+        i = v % 10
+        if b == i:
+            # (Streaming)
+            def streaming(cpu):
+                a = cpu.reg[b]
+                cpu.reg[b] = (a + 1) % Cells
+                return a
+            return streaming, 0, "(" + regName(b) + ")+"
+        if i == 0:
+            # (Displacement)
+            def displaced(cpu):
+                a = cpu.op[cpu.i]
+                cpu.i += 1
+                return (cpu.reg[b] + a) % Cells
+            return displaced, 1, "(" + regName(b) + "+##)"
+        if i == 9:
+            # (IP Relative)
+            if b == 0:
+                def relative(cpu):
+                    a = cpu.op[cpu.i]
+                    cpu.i += 1
+                    return (cpu.reg[9] + a) % Cells
+                return relative, 1, "(IP+##)"
+            def relative(cpu):
+                a = cpu.op[cpu.i]
+                cpu.i += 1
+                return (cpu.reg[9] + cpu.reg[b] + a) % Cells
+            return relative, 1, "(IP+" + regName(b) + "+##)"
+        # (Indexed)
+        return ((lambda cpu: (cpu.reg[b] + cpu.reg[i]) % Cells), 0,
+            "(" + regName(b) + "+" + regName(i) + ")")
+    # (Absolute)
+    def absolute(cpu):
+        a = cpu.op[cpu.i]
+        cpu.i += 1
+        return a
+    return absolute, 1, "(##)"
 
 
 ##############################################################################
@@ -76,36 +301,82 @@ def initBitsTables():
 #
 
 class VirtualGPU:
+    class Addr:
+        FrameVector = 696   # address of the frame interrupt handler (0 = none)
+        FrameCount = 697    # number of frames done (modulo Cells)
+        Sprites = 660       # sprite table, 4 cells for each sprite: visible
+                            # (0 = hidden), x, y (in quarter text cells) and
+                            # the address of its color cells
+
+    FrameCycles = 1000      # a video frame is done every 1000 CPU cycles
+    SpriteCount = 5
+    SpriteSize = 4          # color cells in each row and column of a sprite
+
+    class State:
+        TxtMem = 0      # text page shown, the color page follows it
+        BackMem = 1     # text page of the back buffer
+        Flips = 2       # counts flip() (modulo 65536), so a shown frame can be kept
+
+    __slots__ = ("ColorMap", "Colors", "palette", "bg_rgb", "fg_rgb", "vid_w", "vid_h",
+                 "state", "txtwide", "layers", "bus", "sprites")
+
     def __init__(self):
+        self.sprites = {}   # pattern address -> (color cells, dot size, pixmap)
+        # the state moves into shared memory while CPUs run in other
+        # processes (see shareState), so a FLIP there is shown by the UI
+        self.state = array('H', [700, 400, 0])
+        self.palette = 0    # index in Palettes, kept by reset()
         self.reset()
 
+    @property
+    def txtmem(self):
+        return self.state[self.State.TxtMem]
+
+    @txtmem.setter
+    def txtmem(self, v):
+        self.state[self.State.TxtMem] = v
+
+    @property
+    def backmem(self):
+        return self.state[self.State.BackMem]
+
+    @backmem.setter
+    def backmem(self, v):
+        self.state[self.State.BackMem] = v
+
+    @property
+    def flips(self):
+        return self.state[self.State.Flips]
+
     def reset(self):
-        self.ColorMap = [0] * 1000
+        Mem[Map[self.Addr.FrameVector]] = 0
+        Mem[Map[self.Addr.FrameCount]] = 0
+        for a in range(self.Addr.Sprites, self.Addr.Sprites + 4 * self.SpriteCount):
+            Mem[Map[a]] = 0
         self.bg_rgb = int("112")
         self.fg_rgb = int("889")
-        self.initColorMap()
+        self.setPalette(self.palette)   # the number of cells may have changed
         self.setVideoMode()
         self.clearVideo()
 
-    def initColorMap(self):
-        cmap = []
-        for v in range(10):
-            u = int(230 * ((v / 8) ** 0.85))
-            if u > 255: u = 255
-            cmap.append(u)
-#        print(cmap)
-        for R in range(10):
-            for G in range(10):
-                for B in range(10):
-                    i = 100 * R + 10 * G + B
-                    self.ColorMap[i] = qRgb(cmap[R], cmap[G], cmap[B])
+    def setPalette(self, index):
+        self.palette = index
+        self.ColorMap = Palettes[index][1]
+        self.Colors = paletteColors(Palettes[index])
+        self.sprites.clear()
 
     def setVideoMode(self):
         self.vid_w = 10
         self.vid_h = 10
         self.txtmem = 700
+        self.backmem = 400  # pages 0..3 have the code of CPUs 0..3
         self.txtwide = True
-        self.layers = [self.paintColorBackground, self.paintText]
+        self.layers = [self.paintColorBackground, self.paintSprites, self.paintText]
+
+    def flip(self):
+        # show the back buffer, the shown pages become the back buffer
+        self.txtmem, self.backmem = self.backmem, self.txtmem
+        self.state[self.State.Flips] = (self.flips + 1) % 65536
 
     def clearVideo(self):
         a1 = Map[self.txtmem]
@@ -121,6 +392,18 @@ class VirtualGPU:
         for paintLayer in self.layers:
             paintLayer(painter, rect)
 
+    def busReset(self, bus):
+        self.bus = bus
+        frame = bus.cpu.clock // self.FrameCycles + 1
+        bus.schedule(frame * self.FrameCycles, self.frameDone)
+
+    def frameDone(self, cycle):
+        a = Map[self.Addr.FrameCount]
+        Mem[a] = (Mem[a] + 1) % Cells
+        if Mem[Map[self.Addr.FrameVector]]:
+            self.bus.cpu.interrupt(self.Addr.FrameVector)
+        self.bus.schedule(cycle + self.FrameCycles, self.frameDone)
+
 
 ##############################################################################
 #
@@ -128,11 +411,11 @@ class VirtualGPU:
 #
 
     def paintSolidBackground(self, painter, rect):
-        bg_rgb = self.ColorMap[self.bg_rgb]
-        painter.fillRect(rect, QColor(bg_rgb))
+        painter.fillRect(rect, self.Colors[self.bg_rgb])
 
     def paintColorBackground(self, painter, rect):
-        bg_rgb = self.ColorMap[self.bg_rgb]
+        colors = self.Colors
+        bg = colors[self.bg_rgb]
         cw = rect.width() // self.vid_w
         ch = rect.height() // self.vid_h
         a1 = Map[self.txtmem]
@@ -142,12 +425,41 @@ class VirtualGPU:
                 char = Mem[a1]
                 a1 += 1
                 if char == 0:
-                    rgb = self.ColorMap[Mem[a2]]
+                    color = colors[Mem[a2]]
                 else:
-                    rgb = bg_rgb
+                    color = bg
                 a2 += 1
                 crect = QRect(rect.x() + cw * x, rect.y() + ch * y, cw, ch)
-                painter.fillRect(crect, QColor(rgb))
+                painter.fillRect(crect, color)
+
+    def paintSprites(self, painter, rect):
+        # a sprite is only drawn again from its color cells when they change,
+        # moving it just draws its pixmap somewhere else
+        dot = rect.width() // (self.vid_w * self.SpriteSize)
+        painter.save()
+        painter.setClipRect(rect)
+        for n in range(self.SpriteCount):
+            a = self.Addr.Sprites + 4 * n
+            visible, x, y, pattern = [Mem[Map[a + i]] for i in range(4)]
+            if visible:
+                pixmap = self.spritePixmap(pattern, dot)
+                painter.drawPixmap(rect.x() + dot * x, rect.y() + dot * y, pixmap)
+        painter.restore()
+
+    def spritePixmap(self, pattern, dot):
+        size = self.SpriteSize
+        cells = [Mem[Map[(pattern + i) % Cells]] for i in range(size * size)]
+        cached = self.sprites.get(pattern)
+        if cached != None and cached[0] == cells and cached[1] == dot:
+            return cached[2]
+        image = QImage(size, size, QImage.Format.Format_ARGB32)
+        image.fill(0)       # color 000 is transparent
+        for i in range(len(cells)):
+            if cells[i]:
+                image.setPixel(i % size, i // size, self.ColorMap[cells[i]])
+        pixmap = QPixmap.fromImage(image.scaled(size * dot, size * dot))
+        self.sprites[pattern] = (cells, dot, pixmap)
+        return pixmap
 
     def paintText(self, painter, rect):
         painter.save()
@@ -160,12 +472,17 @@ class VirtualGPU:
             painter.scale(2, 1)
             cw //= 2
         painter.setFont(font)
-        fg_rgb = self.ColorMap[self.fg_rgb]
-        painter.setPen(QColor(fg_rgb))
-        a = Map[self.txtmem]
+        painter.setPen(self.Colors[self.fg_rgb])
+        if Mem[Map[VirtualConsole.Addr.Show]]:
+            cells = console.text
+            rows = console.rows(self.vid_h)
+        else:
+            cells = Mem
+            rows = [Map[self.txtmem + self.vid_w * y] for y in range(self.vid_h)]
         for y in range(self.vid_h):
+            a = rows[y]
             for x in range(self.vid_w):
-                char = Mem[a]
+                char = cells[a]
                 a += 1
                 if char > 4:
                     crect = QRect(cw * x, ch * y, cw, ch)
@@ -173,6 +490,237 @@ class VirtualGPU:
         painter.restore()
 
 
+##############################################################################
+#
+#  virtual I/O (keyboard and output ports)
+#
+
+class VirtualIO:
+    class Addr:
+        Keys = 680      # 680..689 ring buffer with key codes
+        KeyIn = 690     # ring index of the next key to write
+        KeyOut = 691    # ring index of the next key to read
+        Out = 692       # output port, has the number from OUT
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        for a in range(self.Addr.Keys, self.Addr.Out + 1):
+            Mem[Map[a]] = 0
+
+    def keyPending(self):
+        return Mem[Map[self.Addr.KeyIn]] != Mem[Map[self.Addr.KeyOut]]
+
+    def pushKey(self, c):
+        i = Mem[Map[self.Addr.KeyIn]] % 10
+        if (i + 1) % 10 == Mem[Map[self.Addr.KeyOut]] % 10:
+            return False    # buffer full, key is dropped
+        Mem[Map[self.Addr.Keys + i]] = c
+        Mem[Map[self.Addr.KeyIn]] = (i + 1) % 10
+        return True
+
+    def readKey(self):
+        if not self.keyPending():
+            return 0
+        i = Mem[Map[self.Addr.KeyOut]] % 10
+        Mem[Map[self.Addr.KeyOut]] = (i + 1) % 10
+        return Mem[Map[self.Addr.Keys + i]]
+
+    def write(self, v):
+        Mem[Map[self.Addr.Out]] = v
+
+
+class VirtualConsole:
+    # Lines of text written to the output port. While cell Show is not 0,
+    # the video text layer shows the last lines instead of page 7. The lines
+    # are a ring, so a new line or scrolling does not move any text.
+    class Addr:
+        Show = 698      # 1 = video shows the console instead of page 7
+        Scroll = 699    # lines scrolled back from the last line
+
+    Backlog = 100       # lines kept
+    Width = 10          # characters per line
+
+    class State:
+        Line = 0        # ring index of the last line
+        Column = 1      # where the next character goes
+        Lines = 2       # lines in use (up to Backlog)
+
+    def __init__(self):
+        # the ring and its state move into shared memory while CPUs run in
+        # other processes (see shareState), so they are only changed in place
+        self.text = array('H', [0] * (self.Backlog * self.Width))
+        self.state = array('H', [0, 0, 1])
+        self.reset()
+
+    @property
+    def line(self):
+        return self.state[self.State.Line]
+
+    @line.setter
+    def line(self, v):
+        self.state[self.State.Line] = v
+
+    @property
+    def column(self):
+        return self.state[self.State.Column]
+
+    @column.setter
+    def column(self, v):
+        self.state[self.State.Column] = v
+
+    @property
+    def lines(self):
+        return self.state[self.State.Lines]
+
+    @lines.setter
+    def lines(self, v):
+        self.state[self.State.Lines] = v
+
+    def reset(self):
+        Mem[Map[self.Addr.Show]] = 0
+        Mem[Map[self.Addr.Scroll]] = 0
+        self.clear()
+
+    def clear(self):
+        self.text[:] = array('H', [0] * (self.Backlog * self.Width))
+        self.state[:] = array('H', [0, 0, 1])
+
+    def busReset(self, bus):
+        bus.ports[VirtualIO.Addr.Out] = self.written
+
+    def written(self):
+        # OUT, OUTZ or a write to the output port
+        c = Mem[Map[VirtualIO.Addr.Out]]
+        if c == 2:          # new line (Return key)
+            self.newLine()
+        elif c == 3:        # Backspace key
+            if self.column > 0:
+                self.column -= 1
+                self.text[self.Width * self.line + self.column] = 0
+        elif c == 1 or c > 4:
+            if self.column == self.Width:
+                self.newLine()
+            self.text[self.Width * self.line + self.column] = 5 if c == 1 else c
+            self.column += 1
+
+    def newLine(self):
+        self.line = (self.line + 1) % self.Backlog
+        a = self.Width * self.line
+        self.text[a:a + self.Width] = array('H', [0] * self.Width)
+        self.column = 0
+        self.lines = min(self.lines + 1, self.Backlog)
+
+    def rows(self, n):
+        # index in text of each of n lines shown, scrolled back by the
+        # Scroll cell (until the first line is at the top)
+        back = max(0, min(Mem[Map[self.Addr.Scroll]], self.lines - n))
+        top = self.line - back - min(n, self.lines) + 1
+        return [self.Width * ((top + y) % self.Backlog) for y in range(n)]
+
+    def lineTexts(self):
+        # all lines in use as strings, the first line first
+        first = self.line - self.lines + 1
+        return ["".join([NumToChar[c] for c in self.text[a:a + self.Width] if c])
+                for a in [self.Width * ((first + y) % self.Backlog) for y in range(self.lines)]]
+
+
+##############################################################################
+#
+#  device bus
+#
+#  Devices schedule callbacks for a CPU clock cycle instead of being polled.
+#  The CPU only compares its clock with the cycle of the first event, so
+#  nothing is done per instruction until an event is due.
+#
+
+class DeviceBus:
+    NoEvent = 1 << 62
+
+    __slots__ = ("cpu", "devices", "ports", "events", "sequence")
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.devices = []
+        self.ports = [None] * Cells  # device callbacks for written cells
+        self.events = []            # heap of (cycle, sequence, callback)
+        self.sequence = 0
+
+    def attach(self, device):
+        self.devices.append(device)
+        device.busReset(self)
+
+    def reset(self):
+        self.ports = [None] * Cells
+        self.events = []
+        self.cpu.nextEvent = self.NoEvent
+        for device in self.devices:
+            device.busReset(self)
+
+    def schedule(self, cycle, callback):
+        heapq.heappush(self.events, (cycle, self.sequence, callback))
+        self.sequence += 1
+        self.cpu.nextEvent = self.events[0][0]
+
+    def dispatch(self):
+        clock = self.cpu.clock
+        while self.events and self.events[0][0] <= clock:
+            cycle, sequence, callback = heapq.heappop(self.events)
+            callback(cycle)
+        if self.events:
+            self.cpu.nextEvent = self.events[0][0]
+        else:
+            self.cpu.nextEvent = self.NoEvent
+
+    def written(self, a):
+        port = self.ports[a]
+        if port:
+            port()
+
+
+class VirtualTimer:
+    class Addr:
+        Period = 693    # cycles between timer interrupts (0 = off)
+        Vector = 694    # address of the timer interrupt handler (0 = none)
+        Count = 695     # number of timer periods (modulo Cells)
+
+    def __init__(self):
+        self.generation = 0
+        self.reset()
+
+    def reset(self):
+        for a in range(self.Addr.Period, self.Addr.Count + 1):
+            Mem[Map[a]] = 0
+
+    def busReset(self, bus):
+        self.bus = bus
+        bus.ports[self.Addr.Period] = self.programmed
+        self.programmed()
+
+    def programmed(self):
+        # events scheduled before the period was written are ignored
+        self.generation += 1
+        period = Mem[Map[self.Addr.Period]]
+        if period:
+            self.schedule(self.bus.cpu.clock + period)
+
+    def schedule(self, cycle):
+        generation = self.generation
+        self.bus.schedule(cycle, lambda cycle: self.expired(cycle, generation))
+
+    def expired(self, cycle, generation):
+        if generation != self.generation:
+            return
+        a = Map[self.Addr.Count]
+        Mem[a] = (Mem[a] + 1) % Cells
+        if Mem[Map[self.Addr.Vector]]:
+            self.bus.cpu.interrupt(self.Addr.Vector)
+        period = Mem[Map[self.Addr.Period]]
+        if period:
+            self.schedule(cycle + period)
+
+
 ##############################################################################
 #
 #  virtual CPU (central processing unit)
@@ -184,6 +732,24 @@ class VirtualCPU:
         Idle = 0
         Running = 1
         Waiting = 2
+        Break = 3       # stopped by the debugger, continues with Exec
+
+    class Stop:
+        Break = 1       # stop before the instruction at this address
+        Watch = 2       # stop after a write to this cell
+
+    class PageFlag:
+        ReadOnly = 1    # instructions cannot write to the page
+        NoExecute = 2   # instructions cannot be fetched from the page
+        StackOnly = 4   # only PUSH, CALL and interrupts write to the page,
+                        # and instructions cannot be fetched from it
+        Unallocated = 8 # maps to the zero page, allocated by the first write
+        NoWrite = ReadOnly | StackOnly | Unallocated
+        NoPush = ReadOnly | Unallocated
+
+    # devices write cells of page 6 (keyboard buffer, counters) between
+    # instructions, so its decoded instructions are not kept, even if read-only
+    DevicePage = 6
 
     class Reg:
         SP = 0
@@ -205,35 +771,174 @@ class VirtualCPU:
         GreaterThan = 2
         EqualTo = 4
 
-    def __init__(self):
+    class Addressing:
+        Classic = 0     # (##) uses the next cell as absolute address
+        Extended = 1    # (##) uses the next cell as mode cell
+
+    class MicroOp:
+        ReadImm = 0     # instruction word -> ALU
+        ReadReg = 1     # register -> ALU
+        ReadMem = 2     # address -> memory -> ALU
+        ALU = 3         # ALU -> data latch
+        Compare = 4     # ALU -> comparison result
+        WriteReg = 5    # data latch -> register
+        WriteMem = 6    # data latch -> memory
+
+    # micro operations only depend on the instruction words and addressing
+    # (and Digits, see configureMemory), so they are shared by all CPUs and
+    # computed once per instruction
+    microOpCache = {}
+
+    # no instance dict, so thousands of machines stay small and attribute
+    # access in the execution loop is a bit faster
+    __slots__ = ("number", "map", "reg", "addressing", "eaModes", "eaExtra",
+                 "bus", "state", "op", "size", "cycles", "clock", "intSP",
+                 "returnDepth", "fault", "decoded", "nextEvent", "md", "da", "i",
+                 "control", "loops", "pair")
+
+    def __init__(self, number = 0):
+        self.number = number    # CPU n starts at address 100 * n
+        self.map = Map
+        self.reg = [0] * 20     # cleared in place by reset, may be shared
+        self.decoded = {}       # (op, size, pair) of instructions on read-only pages
+        self.pair = None        # fused pair started by the fetched instruction
+        self.loops = None       # LoopAccelerator, if counting loops are skipped
+        self.setAddressing(self.Addressing.Classic)
+        self.bus = DeviceBus(self)
         self.reset()
 
+    def mapPages(self, private):
+        # give this CPU its own copy of the private pages (e.g. the stack
+        # page 9), all other pages are shared with the other CPUs
+        self.map = list(Map)
+        Maps.append(self.map)
+        for page in private:
+            a = allocPage()
+            for i in range(100):
+                self.map[100 * page + i] = a + i
+
+    def setAddressing(self, addressing):
+        self.addressing = addressing
+        self.decoded.clear()
+        self.eaModes = EAModes[addressing]
+        self.eaExtra = EAExtra[addressing]
+
     def reset(self):
-        self.reg = [0] * 20     # SP, A, B, C, D, R5, R6, R7, R8, IP
-                                # 0, SR, RAND, CLK, VER, REM, MHI, DHI, T1, T2
+        for r in range(20):     # SP, A, B, C, D, R5, R6, R7, R8, IP
+            self.reg[r] = 0     # 0, SR, RAND, CLK, VER, REM, MHI, DHI, T1, T2
         self.reg[self.Reg.Flags] = self.ComparisonResult.EqualTo
         self.reg[self.Reg.Ver] = 1      # VER
+        self.reg[self.Reg.IP] = 100 * self.number
         self.state = self.State.Idle
         self.op = [0] * 10
-
-    def fetch(self):
+        self.size = 1
+        self.cycles = 0     # cycles used by the last executed instruction
+        self.clock = 0      # cycles used since reset, Clk has the last 3 digits
+        self.intSP = -1     # SP inside a running interrupt handler
+        self.returnDepth = -1   # stop when a RET leaves this stack depth
+        self.fault = -1     # address of the last protection fault
+        self.decoded.clear()
+        self.pair = None
+        self.bus.reset()
+
+    def fetch(self, fuse = False):
+        # with fuse, the next execute() may run two instructions (a fused
+        # pair), as for a single step the UI shows each instruction
         ip = self.reg[self.Reg.IP]
+        flags = PageFlags[ip // 100]
+        if flags:
+            if flags & (self.PageFlag.NoExecute | self.PageFlag.StackOnly):
+                self.protectionFault(ip)
+                return
+            # instructions cannot change read-only pages, so their decoding
+            # can be kept without checking writes (see DevicePage)
+            decoded = self.decoded.get(ip)
+            if decoded != None:
+                self.op, self.size, pair = decoded
+                self.reg[self.Reg.IP] = (ip + self.size) % Cells
+                if fuse:
+                    self.pair = pair
+                return
+        op = [0] * 10       # a new list, decoded instructions keep theirs
         for i in range(10):
-            self.op[i] = Mem[Map[ip + i]]
+            op[i] = Mem[self.map[(ip + i) % Cells]]
+        if Cells > 1000 and (op[0] > 999 or op[0] in [890, 990] and op[1] > 999):
+            op[0] = 0       # not an instruction code, stops with an error
+        self.op = op
 #        print("Fetch", self.op, "from", self.reg[self.Reg.IP])
-        self.reg[self.Reg.IP] += self.decode()
+        self.size = self.decode()
+        self.reg[self.Reg.IP] = (ip + self.size) % Cells
+        if flags & self.PageFlag.ReadOnly and ip % 100 + self.size <= 100 and ip // 100 != self.DevicePage:
+            self.decoded[ip] = (op, self.size, self.decodePair(ip + self.size))
+
+    def predecode(self, analyzer):
+        # keeps the instructions a ProgramAnalyzer decoded on read-only pages,
+        # so a program known from the ProgramCache is not decoded again
+        if analyzer.addressing != self.addressing:
+            return
+        m = analyzer.cpu.map
+        op, size = self.op, self.size
+        for a, insn in analyzer.instructions.items():
+            page = a // 100
+            if (PageFlags[page] & self.PageFlag.ReadOnly and page != self.DevicePage
+                    and self.map[100 * page] == m[100 * page] and a % 100 + insn[1] <= 100
+                    and insn[2] != ProgramAnalyzer.Flow.Error and a not in self.decoded):
+                self.op, self.size = list(insn[0]), insn[1]
+                self.decoded[a] = (self.op, self.size, self.decodePair(a + self.size))
+        self.op, self.size = op, size
+
+    # pairs of instructions that often follow each other; the first one runs
+    # directly and the second one without fetch and decode
+    def fusedHandler(self, op, op2):
+        if op // 100 == 6 and op2 // 100 == 7:
+            return VirtualCPU.execCMP       # CMP, JMPcc
+        if op // 100 == 5 and 1 <= (op // 10) % 10 <= 4 and op2 // 100 == 1:
+            return VirtualCPU.execMOV       # MOV to a register, ADD
+        if op // 10 == 96 and op2 // 10 == 97:
+            return VirtualCPU.execPUSH      # PUSH, CALL
+        return None
+
+    def decodePair(self, a):
+        # (op, size, handler of the first instruction) if the instruction
+        # at a forms a fused pair with the one just decoded, both on the
+        # same read-only page
+        if a % 100 == 0:
+            return None
+        handler = self.fusedHandler(self.op[0], Mem[self.map[a]])
+        if handler == None:
+            return None
+        op, size = self.op, self.size
+        self.op = [Mem[self.map[(a + i) % Cells]] for i in range(10)]
+        pair = (self.op, self.decode(), handler)
+        self.op, self.size = op, size
+        if a % 100 + pair[1] > 100:
+            return None
+        return pair
+
+    def protectionFault(self, a):
+        self.fault = a
+        self.state = self.State.Error
+
+    def writeFault(self, a, protect):
+        # a write to a page with protect flags faults, unless the page is
+        # only unallocated; then it gets its own cells and the write is done
+        if PageFlags[a // 100] & protect != self.PageFlag.Unallocated:
+            self.protectionFault(a)
+            return True
+        allocatePage(a // 100)
+        return False
 
     # decode helpers
     def digitX00(self, i): return self.op[i] // 100
     def digit0X0(self, i): return (self.op[i] % 100) // 10
     def digit00X(self, i): return self.op[i] % 10
 
-    # FIXME: this isn't really correct
     def decode(self):
         size = 1
         imm = False
         destEA = False
         srcEA = False
+        srcFirst = False
         op = self.op[0]
         if op == 990:
             size += 1
@@ -242,46 +947,143 @@ class VirtualCPU:
                 destEA = True
                 srcEA = True
                 imm = True
+            elif op // 100 in [9]:
+                srcEA = True # NOT, SHL1, SHR1 have an argument
         elif op == 890:
             size += 1
             op = self.op[1]
-            if op in [1]:
-                destEA = True
+            if op // 100 in [1, 2, 3, 4, 7]:
+                destEA = True   # TSTm, SCAN, LEN, CNT, MOVM
                 srcEA = True
                 imm = True
+            elif op // 100 in [9]:
+                srcEA = True # TST, CTB, CTD have an argument
         else:
             if op // 100 in [1, 2, 3, 4, 5, 6]:
                 destEA = True
                 srcEA = True
+            if op // 100 in [5]:
+                srcFirst = True # MOV reads the source before writing
             if op // 100 in [7]:
                 srcEA = True
             if op // 100 in [1, 2, 3, 4, 5, 6, 7]:
                 imm = True  # ADD, SUB, MUL, DIV, MOV, CMP, JMP can have immediate
-            elif op // 10 in [94, 96, 97]:
-                imm = True  # OUT, PUSH, CALL can have immediate
+            elif op // 10 in [94, 96, 97, 86]:
+                imm = True  # OUT, PUSH, CALL, CMPZ can have immediate
                 srcEA = True
-            elif op // 10 in [91, 92, 93]:
-                srcEA = True # INC, DEC, IN have an argument (FIXME: but not src?)
-            elif op in [987, 989]:
-                return 2    # LIB and SYS always have immediate
-        if srcEA and op % 10 == 9:
-            size += 1
+            elif op // 10 in [91, 92, 93, 95, 82, 85]:
+                srcEA = True # INC, DEC, IN, POP, NEG, MOVZ have an argument
+            elif op in [895, 896, 987, 989]:
+                return 2    # POPM, PUSHM, LIB and SYS always have immediate
+        # operand cells follow in the order the instruction reads them
+        cells = []
         if destEA and (op // 10) % 10 == 9:
-            size += 1
-        if imm and op % 10 == 0:
-            size += 1
+            cells.append(9)
+        if (srcEA and op % 10 == 9) or (imm and op % 10 == 0):
+            if srcFirst:
+                cells.insert(0, op % 10)
+            else:
+                cells.append(op % 10)
+        for m in cells:
+            if m == 9:
+                size += 1 + self.eaExtra[self.op[size]]
+            else:
+                size += 1
         return size
 
     def execute(self):
+        # returns the number of instructions executed
 #        print("CPU state:", self.state, "Registers:", self.reg)
         if self.state != self.State.Running:
-            return
+            self.pair = None
+            return 0
+        steps = 1
+        if self.pair != None:
+            steps = self.executeFirst()
+            if self.state != self.State.Running:
+                return 1
         self.md = -1
+        self.da = -1
         self.i = 1
+        self.cycles = CycleCost[self.op[0]]
         self.execA()
+        self.clock += self.cycles
+        self.reg[self.Reg.Clk] = self.clock % Cells
         if self.md != -1:
 #            print("Memory dirty at", self.md)
-            pass    # check memory updates
+            self.bus.written(self.md)
+            if Stops[self.md] & self.Stop.Watch:
+                self.stop()
+        if self.clock >= self.nextEvent:
+            self.bus.dispatch()
+        if Stops[self.reg[self.Reg.IP]] & self.Stop.Break:
+            self.stop()
+        if Conditions:
+            self.checkConditions()
+        return steps
+
+    def executeFirst(self):
+        # run the first instruction of a fused pair, so that execute() goes
+        # on with the second one; both are run one by one if anything could
+        # happen in between (a device event, a breakpoint or a condition)
+        op, size, handler = self.pair
+        self.pair = None
+        ip = self.reg[self.Reg.IP]
+        cycles = CycleCost[self.op[0]]
+        if Conditions or Stops[ip] or self.clock + cycles >= self.nextEvent:
+            return 1
+        self.da = -1
+        self.i = 1
+        handler(self)
+        self.clock += cycles
+        self.reg[self.Reg.Clk] = self.clock % Cells
+        self.op = op
+        self.size = size
+        self.reg[self.Reg.IP] = (ip + size) % Cells
+        return 2
+
+    def stop(self):
+        if self.state == self.State.Running:
+            self.state = self.State.Break
+
+    def checkConditions(self):
+        # stop when an instruction changes a register to one of the values
+        for condition in Conditions:
+            r, values, last = condition
+            v = self.reg[r]
+            if v != last[self.number]:
+                last[self.number] = v
+                if values[v]:
+                    self.stop()
+
+    def stackDepth(self):
+        return -self.reg[self.Reg.SP] % Cells
+
+    def runUntilReturn(self, depth):
+        # run until a RET returns to the given stack depth (or below)
+        self.returnDepth = depth
+        self.state = self.State.Running
+
+    def idle(self, until):
+        # a waiting CPU skips ahead to the next device event
+        while self.state == self.State.Waiting and self.nextEvent <= until:
+            self.clock = self.nextEvent
+            self.reg[self.Reg.Clk] = self.clock % Cells
+            self.bus.dispatch()
+        if self.state == self.State.Waiting and self.clock < until < self.bus.NoEvent:
+            self.clock = until
+            self.reg[self.Reg.Clk] = self.clock % Cells
+
+    def interrupt(self, vector):
+        # like CALL through the address in the vector cell, but only if no
+        # other interrupt handler is running
+        if self.intSP >= 0 or self.state not in [self.State.Running, self.State.Waiting]:
+            return False
+        self.pushValue(self.reg[self.Reg.IP])
+        self.intSP = self.reg[self.Reg.SP]
+        self.reg[self.Reg.IP] = Mem[self.map[vector]]
+        self.wake()
+        return True
 
 
 ##############################################################################
@@ -290,42 +1092,9 @@ class VirtualCPU:
 #
 
     def ea(self):
-        #return self.reg[self.Reg.SP]
         v = self.op[self.i]
         self.i += 1
-        # disable advanced modes
-        return v
-        if v < 900:
-            disp = v % 100
-            base = self.reg[v / 100]
-            if disp == 0:
-                # (Indirect)
-                return base
-            # (Relative)
-            base += offset
-        else:
-            v -= 900
-            if v < 90:
-                b = v / 10
-                i = v % 10
-                base = self.reg[b]
-                if b == i:
-                    # (Streaming)
-                    self.reg[b] = (self.reg[b] + 1) % 1000
-                    return base
-                if b == 0 and i == 9:
-                    base = 0
-                if i == 0 or i == 9:
-                    base += self.op[self.i]
-                    self.i += 1
-                # (Indexed)
-                base += self.reg[i]
-            else:
-                # (Absolute)
-                base = self.op[self.i]
-                self.i += 1
-                return base
-        return base % 1000
+        return self.eaModes[v](self)
 
     def rs(self, m):                # read src
         if m == 0:
@@ -336,32 +1105,39 @@ class VirtualCPU:
             return self.reg[m]
         elif m < 9:
             a = self.reg[m - 4]
-            return Mem[Map[a]]
+            return Mem[self.map[a]]
         else:
             a = self.ea()
-            return Mem[Map[a]]
+            return Mem[self.map[a]]
 
     def rd(self, m):                # read dst
         if m < 5:
             return self.reg[m]
         elif m < 9:
             a = self.reg[m - 4]
-            return Mem[Map[a]]
+            return Mem[self.map[a]]
         else:
             a = self.ea()
-            return Mem[Map[a]]
+            self.da = a             # wd() writes back to the same address
+            return Mem[self.map[a]]
 
     def wd(self, m, v):             # write dst
         if m < 5:
             self.reg[m] = v
         elif m < 9:
             a = self.reg[m - 4]
+            if PageFlags[a // 100] & self.PageFlag.NoWrite and self.writeFault(a, self.PageFlag.NoWrite):
+                return
             self.md = a             # memory dirty
-            Mem[Map[a]] = v
+            Mem[self.map[a]] = v
         else:
-            a = self.ea()
+            a = self.da
+            if a < 0:
+                a = self.ea()
+            if PageFlags[a // 100] & self.PageFlag.NoWrite and self.writeFault(a, self.PageFlag.NoWrite):
+                return
             self.md = a
-            Mem[Map[a]] = v
+            Mem[self.map[a]] = v
 
 
 ##############################################################################
@@ -388,22 +1164,36 @@ class VirtualCPU:
             self.execX0, #self.execC90,
             self.execINC,
             self.execDEC,
-            self.execX0, #self.execIN,
-            self.execX0, #self.execOUT,
+            self.execIN,
+            self.execOUT,
             self.execPOP,
             self.execPUSH,
             self.execCALL,
-            self.execX0, #self.execA98,
+            self.execA98,
             self.execA99,
         ][self.digit0X0(0)]()
 
+    def execA98(self):
+        [
+            self.execX0,
+            self.execX0,
+            self.execX0,
+            self.execX0,
+            self.execX0,
+            self.execX0,
+            self.execX0,
+            self.execLIB,
+            self.execX0,
+            self.execSYS,
+        ][self.digit00X(0)]()
+
     def execA99(self):
         [
             self.execB990,
             self.execX0, #
             self.execX0, #
             self.execX0, #
-            self.execX0, #self.execOUTZ,
+            self.execOUTZ,
             self.execX0, #
             self.execPUSHZ,
             self.execRET,
@@ -422,7 +1212,7 @@ class VirtualCPU:
             self.execCMPZ,
             self.execRETcc,
             self.execX0, #self.execA88,
-            self.execX0, #self.execA89,
+            self.execA89,
         ][self.digit0X0(0)]()
 
     def execA89(self):
@@ -432,11 +1222,11 @@ class VirtualCPU:
             self.execX0,
             self.execX0, #self.execRI,
             self.execX0, #self.execRO,
-            self.execX0, #self.execPOPM,
-            self.execX0, #self.execPUSHM,
-            self.execX0, #self.execLIB,
-            self.execX0, #self.execWAIT,
-            self.execX0, #self.execSYS,
+            self.execPOPM,
+            self.execPUSHM,
+            self.execX0,
+            self.execWAIT,
+            self.execX0,
         ][self.digit00X(0)]()
 
 
@@ -447,6 +1237,7 @@ class VirtualCPU:
 
     def execB990(self):
         self.i += 1
+        self.cycles += PrefixCycleCost[self.op[1]]
         [
             self.execX0,
             self.execOR,
@@ -476,15 +1267,17 @@ class VirtualCPU:
 
     def execB890(self):
         self.i += 1
+        if self.digitX00(1) in [1, 9]:
+            self.cycles += PrefixCycleCost[self.op[1]]  # not for block instructions
         [
             self.execX0,
             self.execTSTm,
-            self.execX0, #self.execSCAN,
-            self.execX0, #self.execLEN,
-            self.execX0, #self.execCNT,
+            self.execSCAN,
+            self.execLEN,
+            self.execCNT,
             self.execX0, #self.execROL,
             self.execX0, #self.execROR,
-            self.execX0,
+            self.execMOVM,
             self.execX0,
             self.execB8909,
         ][self.digitX00(1)]()
@@ -512,19 +1305,19 @@ class VirtualCPU:
     def execADD(self):
         d = self.rd(self.digit0X0(0))
         s = self.rs(self.digit00X(0))
-        d = (d + s) % 1000
+        d = (d + s) % Cells
         self.wd(self.digit0X0(0), d)
 
     def execSUB(self):
         d = self.rd(self.digit0X0(0))
         s = self.rs(self.digit00X(0))
-        d = (d - s) % 1000
+        d = (d - s) % Cells
         self.wd(self.digit0X0(0), d)
 
     def execMUL(self):
         d = self.rd(self.digit0X0(0))
         s = self.rs(self.digit00X(0))
-        d = (d * s) % 1000
+        d = (d * s) % Cells
         self.wd(self.digit0X0(0), d)
 
     def execDIV(self):
@@ -538,17 +1331,17 @@ class VirtualCPU:
 
     def execINC(self):
         d = self.rd(self.digit00X(0))
-        d = (d + 1) % 1000
+        d = (d + 1) % Cells
         self.wd(self.digit00X(0), d)
 
     def execDEC(self):
         d = self.rd(self.digit00X(0))
-        d = (d - 1) % 1000
+        d = (d - 1) % Cells
         self.wd(self.digit00X(0), d)
 
     def execNEG(self):
         d = self.rd(self.digit00X(0))
-        d = (0 - d) % 1000
+        d = (0 - d) % Cells
         self.wd(self.digit00X(0), d)
 
 
@@ -579,7 +1372,7 @@ class VirtualCPU:
 
     def execCMPZ(self):
         s = self.rs(self.digit00X(0))
-        if s >= 500:
+        if s >= Cells // 2:
             c = self.ComparisonResult.LessThan
         elif s >= 1:
             c = self.ComparisonResult.GreaterThan
@@ -594,7 +1387,10 @@ class VirtualCPU:
     def execJMPcc(self):
         c = self.digit0X0(0)
         if self.reg[self.Reg.Flags] & c:
-            self.setIP()
+            if self.loops != None:
+                self.loops.jump(self)
+            else:
+                self.setIP()
 
 
 ##############################################################################
@@ -604,16 +1400,20 @@ class VirtualCPU:
 
     def popValue(self):
         a = self.reg[self.Reg.SP]
-        s = Mem[Map[a]]
-        a = (a + 1) % 1000
+        s = Mem[self.map[a]]
+        a = (a + 1) % Cells
         self.reg[self.Reg.SP] = a
         return s
 
     def pushValue(self, s):
         a = self.reg[self.Reg.SP]
-        a = (a - 1) % 1000
-        Mem[Map[a]] = s
+        a = (a - 1) % Cells
+        if PageFlags[a // 100] & self.PageFlag.NoPush and self.writeFault(a, self.PageFlag.NoPush):
+            return
+        Mem[self.map[a]] = s
         self.reg[self.Reg.SP] = a
+        if Stops[a] & self.Stop.Watch:
+            self.stop()
 
     def execPOP(self):
         d = self.popValue()
@@ -633,8 +1433,13 @@ class VirtualCPU:
         self.setIP()
 
     def execRET(self):
+        if self.reg[self.Reg.SP] == self.intSP:
+            self.intSP = -1         # returning from interrupt handler
         s = self.popValue()
         self.reg[self.Reg.IP] = s
+        if self.returnDepth >= 0 and self.stackDepth() <= self.returnDepth:
+            self.returnDepth = -1
+            self.stop()
 
     def execRETcc(self):
         c = self.digit00X(0)
@@ -642,6 +1447,133 @@ class VirtualCPU:
             self.execRET()
 
 
+##############################################################################
+#
+#  block instructions
+#
+#  These run as a single step; they cost one cycle plus one cycle for each
+#  memory cell they read or write.
+#
+
+    def pageRuns(self, a, n):
+        # split n cells starting at address a into runs within one page,
+        # so they can be sliced from Mem in one go (Mem may be a list or a
+        # view of shared memory, so slices are copied to lists when needed)
+        while n > 0:
+            k = min(n, 100 - a % 100)
+            yield self.map[a], k
+            a = (a + k) % Cells
+            n -= k
+
+    def readBlock(self, a, n):
+        cells = []
+        for p, k in self.pageRuns(a, n):
+            cells.extend(Mem[p:p + k])
+        self.cycles += n
+        return cells
+
+    def writeBlock(self, a, cells, stack = False):
+        protect = self.PageFlag.NoPush if stack else self.PageFlag.NoWrite
+        b = a
+        for p, k in self.pageRuns(a, len(cells)):
+            if PageFlags[b // 100] & protect and self.writeFault(b, protect):
+                return
+            b = (b + k) % Cells
+        i = 0
+        for p, k in self.pageRuns(a, len(cells)):
+            Mem[p:p + k] = array('H', cells[i:i + k])
+            i += k
+        # watchpoints and device ports of all written cells (so md stays -1)
+        ports = self.bus.ports
+        for j in range(len(cells)):
+            b = (a + j) % Cells
+            if Stops[b] & self.Stop.Watch:
+                self.stop()
+            if ports[b]:
+                ports[b]()
+        self.cycles += len(cells)
+
+    def stringLength(self, a):
+        n = 0
+        for p, k in self.pageRuns(a, Cells):
+            run = list(Mem[p:p + k])
+            if 0 in run:
+                n += run.index(0)
+                break
+            n += k
+        self.cycles += n + 1
+        return n
+
+    def registerRange(self):
+        v = self.op[self.i]             # e.g. 14 is R1..R4
+        self.i += 1
+        first = v // 10
+        last = v % 10
+        if v > 99 or first < 1 or last > 8 or first > last:
+            return 1, 0
+        return first, last + 1
+
+    def execPUSHM(self):
+        first, last = self.registerRange()
+        if first >= last:
+            self.execX0()
+            return
+        cells = list(self.reg[first:last])
+        cells.reverse()                 # last register ends up on top
+        a = (self.reg[self.Reg.SP] - len(cells)) % Cells
+        self.writeBlock(a, cells, True)
+        self.reg[self.Reg.SP] = a
+
+    def execPOPM(self):
+        first, last = self.registerRange()
+        if first >= last:
+            self.execX0()
+            return
+        a = self.reg[self.Reg.SP]
+        cells = self.readBlock(a, last - first)
+        cells.reverse()
+        for r in range(first, last):
+            self.reg[r] = cells[r - first]
+        self.reg[self.Reg.SP] = (a + len(cells)) % Cells
+
+    def execLEN(self):
+        self.rd(self.digit0X0(1))
+        a = self.rs(self.digit00X(1))
+        d = self.stringLength(a) % Cells
+        self.wd(self.digit0X0(1), d)
+
+    def execSCAN(self):
+        a = self.rd(self.digit0X0(1))
+        s = self.rs(self.digit00X(1))
+        n = self.stringLength(a)
+        c = self.ComparisonResult.GreaterThan
+        d = n
+        i = 0
+        for p, k in self.pageRuns(a, n + 1):
+            run = list(Mem[p:p + k])
+            if s in run:
+                c = self.ComparisonResult.EqualTo
+                d = i + run.index(s)
+                break
+            i += k
+        self.reg[self.Reg.Flags] = c
+        self.wd(self.digit0X0(1), (a + d) % Cells)
+
+    def execCNT(self):
+        a = self.rd(self.digit0X0(1))
+        s = self.rs(self.digit00X(1))
+        d = 0
+        for p, k in self.pageRuns(a, self.stringLength(a)):
+            d += list(Mem[p:p + k]).count(s)
+        self.wd(self.digit0X0(1), d % Cells)
+
+    def execMOVM(self):
+        d = self.rd(self.digit0X0(1))
+        s = self.rs(self.digit00X(1))
+        n = self.reg[4]                 # R4 has the number of cells
+        self.writeBlock(d, self.readBlock(s, n))
+
+
 ##############################################################################
 #
 #  bit logic instructions
@@ -673,7 +1605,7 @@ class VirtualCPU:
 
     def execNOT(self):
         d = self.rd(self.digit00X(1))
-        d = BitsToNum[NumToBits[d] ^ 0x1FF]
+        d = BitsToNum[NumToBits[d] ^ BitsMask]
         self.wd(self.digit00X(1), d)
 
 
@@ -686,7 +1618,7 @@ class VirtualCPU:
         d = self.rd(self.digit0X0(1))
         s = self.rs(self.digit00X(1))
         s %= 10
-        d = BitsToNum[(NumToBits[d] << s) & 0x1FF]
+        d = BitsToNum[(NumToBits[d] << s) & BitsMask]
         self.wd(self.digit0X0(1), d)
 
     def execSHR(self):
@@ -709,11 +1641,11 @@ class VirtualCPU:
         d = self.rd(self.digit0X0(1))
         s = self.rs(self.digit00X(1))
         d = BitsToNum[NumToBits[d] & NumToBits[s]]
-        execBitTest(d, s)
+        self.execBitTest(d, s)
 
     def execTST(self):
         d = self.rd(self.digit00X(1))
-        execBitTest(d, 777)
+        self.execBitTest(d, BitsToNum[BitsMask])
 
     def execCTB(self):
         d = self.rd(self.digit00X(1))
@@ -726,6 +1658,119 @@ class VirtualCPU:
         self.wd(self.digit00X(1), d)
 
 
+##############################################################################
+#
+#  input/output instructions
+#
+
+    def execIN(self):
+        d = io.readKey()
+        self.wd(self.digit00X(0), d)
+
+    def execOUT(self):
+        s = self.rs(self.digit00X(0))
+        io.write(s)
+        self.md = io.Addr.Out       # for the console and watchpoints
+
+    def execOUTZ(self):
+        io.write(0)
+        self.md = io.Addr.Out
+
+    def execWAIT(self):
+        if not io.keyPending():
+            self.state = self.State.Waiting
+
+    def wake(self):
+        if self.state == self.State.Waiting:
+            self.state = self.State.Running
+
+
+##############################################################################
+#
+#  library instructions
+#
+#  LIB ### and SYS ### call routines that run at host speed; they take a
+#  single step and advance the clock by the cycles they would need.
+#
+
+    def execLIB(self):
+        n = self.op[self.i]
+        self.i += 1
+        routines = [
+            self.execX0,
+            self.libMUL,
+            self.libDIV,
+            self.libRAND,
+            self.libPRINT,
+            self.libFILL,
+        ]
+        if n < len(routines):
+            routines[n]()
+        else:
+            self.execX0()
+
+    def execSYS(self):
+        n = self.op[self.i]
+        self.i += 1
+        routines = [
+            self.execX0,
+            self.sysCLS,
+            self.sysFLIP,
+        ]
+        if n < len(routines):
+            routines[n]()
+        else:
+            self.execX0()
+
+    def libMUL(self):               # R1, R2 = R1 * R2 (low, high digits)
+        d = self.reg[1] * self.reg[2]
+        self.reg[self.Reg.MHi] = d // Cells
+        self.reg[1] = d % Cells
+        self.reg[2] = self.reg[self.Reg.MHi]
+        self.cycles += 20
+
+    def libDIV(self):               # R1, R2 = R1 / R2 (quotient, remainder)
+        s = self.reg[2]
+        if s == 0:
+            self.state = self.State.Error
+            return
+        self.reg[self.Reg.Rem] = self.reg[1] % s
+        self.reg[1] //= s
+        self.reg[2] = self.reg[self.Reg.Rem]
+        self.cycles += 30
+
+    def libRAND(self):              # R1 = random number below R1 (or Cells)
+        self.reg[self.Reg.Rand] = random.randrange(Cells)
+        if self.reg[1] > 0:
+            self.reg[1] = random.randrange(self.reg[1])
+        else:
+            self.reg[1] = self.reg[self.Reg.Rand]
+        self.cycles += 5
+
+    def libPRINT(self):             # print number R1 as text at address R3
+        digits = [CharToNum[ord(c)] for c in str(self.reg[1])]
+        a = self.reg[3]
+        self.writeBlock(a, digits)
+        self.reg[3] = (a + len(digits)) % Cells
+        self.cycles += 4 + 2 * len(digits)
+
+    def libFILL(self):              # fill R4 cells at address R3 with R1
+        self.writeBlock(self.reg[3], [self.reg[1]] * self.reg[4])
+        self.cycles += 2
+
+    def sysFLIP(self):              # show the back buffer, R1 = its text page
+        gpu.flip()
+        self.reg[1] = gpu.backmem
+        self.cycles += 2
+
+    def sysCLS(self):               # clear text and color video pages
+        gpu.clearVideo()
+        console.clear()
+        self.decoded.clear()
+        self.md = gpu.txtmem
+        self.cycles += 2 + 2 * gpu.vid_w * gpu.vid_h
+
+
 ##############################################################################
 #
 #  special instructions
@@ -741,6 +1786,1732 @@ class VirtualCPU:
         self.state = self.State.Error
 
 
+##############################################################################
+#
+#  micro operations (data flow of the last fetched instruction)
+#
+
+    def microOps(self):
+        key = (self.addressing,) + tuple(self.op[:self.size])
+        uops = self.microOpCache.get(key)
+        if uops == None:
+            uops = self.decodeMicroOps()
+            self.microOpCache[key] = uops
+        return uops
+
+    def operandLabel(self, m, i):
+        if m == 0:
+            return str(self.op[i]).zfill(Digits), i + 1
+        elif m < 5:
+            return "R" + str(m), i
+        elif m < 9:
+            return "(R" + str(m - 4) + ")", i
+        else:
+            v = self.op[i]
+            label = EALabels[self.addressing][v]
+            if self.eaExtra[v]:
+                label = label.replace("##", str(self.op[i + 1]).zfill(Digits))
+            return label, i + 1 + self.eaExtra[v]
+
+    def readMicroOp(self, m, label):
+        if m == 0:
+            return (self.MicroOp.ReadImm, label)
+        elif m < 5:
+            return (self.MicroOp.ReadReg, label)
+        return (self.MicroOp.ReadMem, label)
+
+    def writeMicroOp(self, m, label):
+        if m < 5:
+            return (self.MicroOp.WriteReg, label)
+        return (self.MicroOp.WriteMem, label)
+
+    def decodeMicroOps(self):
+        U = self.MicroOp
+        op = self.op[0]
+        i = 1
+        if op == 990 or op == 890:
+            prefix = op
+            op = self.op[1]
+            i = 2
+            dm = (op // 10) % 10
+            sm = op % 10
+            if op // 100 == 9:
+                d, i = self.operandLabel(sm, i)
+                uops = [self.readMicroOp(sm, d), (U.ALU, "~" if prefix == 990 else "#")]
+                if prefix == 890 and dm == 1:
+                    return uops + [(U.Compare, "?")]
+                return uops + [self.writeMicroOp(sm, d)]
+            if prefix == 990:
+                symbol = ["", "|", "^", "&", "&~", "<<", ">>", "", "", ""][op // 100]
+            else:
+                symbol = ["", "&", "SCAN", "LEN", "CNT", "", "", "MOVM", "", ""][op // 100]
+            d, i = self.operandLabel(dm, i)
+            s, i = self.operandLabel(sm, i)
+            if prefix == 890 and op // 100 == 7:
+                return [self.readMicroOp(dm, d), self.readMicroOp(sm, s), (U.ReadReg, "R4"),
+                    (U.ReadMem, "(" + s + ")"), (U.WriteMem, "(" + d + ")")]
+            if prefix == 890 and op // 100 > 1:
+                return [self.readMicroOp(dm, d), self.readMicroOp(sm, s), (U.ReadMem, "(…)"),
+                    (U.ALU, symbol), self.writeMicroOp(dm, d)]
+            uops = [self.readMicroOp(dm, d), self.readMicroOp(sm, s), (U.ALU, symbol)]
+            if prefix == 890:
+                return uops + [(U.Compare, "?")]
+            return uops + [self.writeMicroOp(dm, d)]
+        d = op // 100
+        dm = (op // 10) % 10
+        sm = op % 10
+        if d in [1, 2, 3, 4]:
+            d, i = self.operandLabel(dm, i)
+            s, i = self.operandLabel(sm, i)
+            symbol = ["", "+", "−", "×", "÷"][op // 100]
+            return [self.readMicroOp(dm, d), self.readMicroOp(sm, s),
+                (U.ALU, symbol), self.writeMicroOp(dm, d)]
+        elif d == 5:
+            s, i = self.operandLabel(sm, i)
+            d, i = self.operandLabel(dm, i)
+            return [self.readMicroOp(sm, s), self.writeMicroOp(dm, d)]
+        elif d == 6:
+            d, i = self.operandLabel(dm, i)
+            s, i = self.operandLabel(sm, i)
+            return [self.readMicroOp(dm, d), self.readMicroOp(sm, s),
+                (U.ALU, "−"), (U.Compare, "?")]
+        elif d == 7:
+            s, i = self.operandLabel(sm, i)
+            return [self.readMicroOp(sm, s), (U.WriteReg, "IP")]
+        elif op // 10 in [91, 92, 82]:
+            d, i = self.operandLabel(sm, i)
+            symbol = {91: "+1", 92: "−1", 82: "0−"}[op // 10]
+            return [self.readMicroOp(sm, d), (U.ALU, symbol), self.writeMicroOp(sm, d)]
+        elif op // 10 == 85:
+            d, i = self.operandLabel(sm, i)
+            return [(U.ALU, "0"), self.writeMicroOp(sm, d)]
+        elif op // 10 == 86:
+            s, i = self.operandLabel(sm, i)
+            return [self.readMicroOp(sm, s), (U.ALU, "−"), (U.Compare, "?")]
+        elif op // 10 == 95:
+            d, i = self.operandLabel(sm, i)
+            return [(U.ReadMem, "(SP)"), self.writeMicroOp(sm, d)]
+        elif op // 10 == 96:
+            s, i = self.operandLabel(sm, i)
+            return [self.readMicroOp(sm, s), (U.WriteMem, "(SP)")]
+        elif op // 10 == 97:
+            s, i = self.operandLabel(sm, i)
+            return [(U.ReadReg, "IP"), (U.WriteMem, "(SP)"),
+                self.readMicroOp(sm, s), (U.WriteReg, "IP")]
+        elif op == 996:
+            return [(U.ALU, "0"), (U.WriteMem, "(SP)")]
+        elif op // 10 == 93:
+            d, i = self.operandLabel(sm, i)
+            return [(U.ReadMem, "(KEY)"), self.writeMicroOp(sm, d)]
+        elif op // 10 == 94:
+            s, i = self.operandLabel(sm, i)
+            return [self.readMicroOp(sm, s), (U.WriteMem, "(OUT)")]
+        elif op == 994:
+            return [(U.ALU, "0"), (U.WriteMem, "(OUT)")]
+        elif op in [987, 989]:
+            return [(U.ReadImm, str(self.op[1]).zfill(Digits)), (U.ALU, ["LIB", "SYS"][op == 989])]
+        elif op in [895, 896]:
+            regs = "R" + str(self.op[1] // 10) + "-R" + str(self.op[1] % 10)
+            if op == 896:
+                return [(U.ReadReg, regs), (U.WriteMem, "(SP)")]
+            return [(U.ReadMem, "(SP)"), (U.WriteReg, regs)]
+        elif op == 997 or op // 10 == 87:
+            return [(U.ReadMem, "(SP)"), (U.WriteReg, "IP")]
+        return []
+
+
+##############################################################################
+#
+#  loop acceleration
+#
+#  When a JMP goes back to a loop head, the loop body is checked for a
+#  simple shape: ADD, SUB, INC, DEC and MOV on registers R1..R4 with
+#  numbers or registers the loop does not change, CMP, JMPcc out of the
+#  loop, and MOV from a register to a fixed (##) cell. Then the registers
+#  change by the same step in each iteration, and the iterations before the
+#  loop ends are done at once. Registers, flags, memory and the clock end
+#  up as if each instruction had run, and the last iteration runs normally.
+#  Device events still happen at their cycle, so a skip ends before the
+#  next event (at most a video frame of 1000 cycles).
+#
+
+class LoopAccelerator:
+    MinIterations = 2   # fewer are not worth it
+
+    def __init__(self):
+        self.loops = {}     # (head, jump address) -> (cells, body or None)
+        self.skipped = 0    # instructions not executed one by one
+
+    def jump(self, cpu):
+        # a taken JMPcc, after is the address after it
+        after = cpu.reg[cpu.Reg.IP]
+        cpu.setIP()
+        head = cpu.reg[cpu.Reg.IP]
+        if head >= after or Conditions:
+            return
+        cells = tuple([Mem[cpu.map[a]] for a in range(head, after)])
+        key = (head, after)
+        loop = self.loops.get(key)
+        if loop == None or loop[0] != cells:
+            loop = (cells, self.loopBody(cpu, head, after))
+            self.loops[key] = loop
+        if loop[1] != None and not any(Stops[head:after]):
+            self.skip(cpu, loop[1], head, after)
+
+    def loopBody(self, cpu, head, after):
+        # [(op, size)] of the instructions from head to the JMP, or None if
+        # the loop does not have the simple shape
+        body = []
+        op, size = cpu.op, cpu.size
+        a = head
+        while a < after:
+            cpu.op = [Mem[cpu.map[(a + i) % Cells]] for i in range(10)]
+            cpu.size = cpu.decode()
+            body.append((cpu.op, cpu.size))
+            a += cpu.size
+        cpu.op, cpu.size = op, size
+        if a != after:
+            return None
+        for k in range(len(body)):
+            o = body[k][0]
+            d = o[0] // 100
+            dm = (o[0] // 10) % 10
+            sm = o[0] % 10
+            if d in [1, 2, 6] and 1 <= dm <= 4 and sm <= 4:
+                continue        # ADD, SUB, CMP
+            if d == 5 and sm <= 4 and (1 <= dm <= 4 or
+                    dm == 9 and cpu.addressing == cpu.Addressing.Classic):
+                continue        # MOV
+            if o[0] // 10 in [91, 92] and 1 <= sm <= 4:
+                continue        # INC, DEC
+            if d == 7 and sm == 0 and dm > 0 and (dm < 7 and (o[1] < head or o[1] >= after) or
+                    k == len(body) - 1 and o[1] == head):
+                continue        # JMPcc out of the loop, or back to its head
+            if o[0] == 998:
+                continue        # NOP
+            return None
+        return body
+
+    def skip(self, cpu, body, head, after):
+        # run the body symbolically: registers R1..R4 have a value (q, c),
+        # which is the value of register q at the loop head plus c, or the
+        # number c if q is 0
+        reg = cpu.reg
+        written = set()
+        for o, size in body:
+            if o[0] // 100 in [1, 2] or o[0] // 100 == 5 and (o[0] // 10) % 10 < 9:
+                written.add((o[0] // 10) % 10)
+            elif o[0] // 10 in [91, 92]:
+                written.add(o[0] % 10)
+        value = [(0, 0)] + [(r, 0) if r in written else (0, reg[r]) for r in range(1, 5)]
+        compare = None  # (d, s) of the last CMP
+        exits = []      # (compare, flags that leave the loop)
+        stores = []     # (address, value)
+        cycles = 0
+        for o, size in body:
+            cycles += CycleCost[o[0]]
+            if o[0] == 998:
+                continue
+            d = o[0] // 100
+            dm = (o[0] // 10) % 10
+            sm = o[0] % 10
+            s = (0, o[1]) if sm == 0 else value[sm]
+            if d in [1, 2]:
+                if s[0]:
+                    return      # the loop changes the step
+                q, c = value[dm]
+                value[dm] = (q, c + s[1] if d == 1 else c - s[1])
+            elif d == 5 and dm == 9:
+                stores.append((o[2] if sm == 0 else o[1], s))
+            elif d == 5:
+                value[dm] = s
+            elif d == 6:
+                compare = (value[dm], s)
+            elif d == 9:
+                q, c = value[sm]
+                value[sm] = (q, c + 1 if dm == 1 else c - 1)
+            elif d == 7 and dm != 7:
+                if compare == None:
+                    return      # flags from before the loop
+                exits.append((compare, 7 & ~dm if o[1] == head else dm))
+        # registers counted up or down by a step, all values must only
+        # depend on these
+        counted = [r for r in written if value[r][0] == r]
+        step = [0] * 5
+        for r in counted:
+            step[r] = value[r][1] % Cells
+        values = [value[r] for r in written] + [v for a, v in stores]
+        if compare != None:
+            values += list(compare)
+        for v in values:
+            if v[0] and v[0] not in counted:
+                return
+        iterations = (cpu.nextEvent - 1 - cpu.clock - cpu.cycles) // cycles
+        for e in exits:
+            iterations = min(iterations, self.exitIteration(e, reg, step))
+            if iterations < 0:
+                return
+        if iterations < self.MinIterations:
+            return
+        for a, v in stores:
+            if PageFlags[a // 100] & cpu.PageFlag.NoWrite or Stops[a] or cpu.bus.ports[a] or head <= a < after:
+                return
+        # the stores and flags of the last skipped iteration, the registers
+        # at the loop head after it
+        last = iterations - 1
+        at = lambda v: (reg[v[0]] + step[v[0]] * last + v[1]) % Cells if v[0] else v[1] % Cells
+        for a, v in stores:
+            Mem[cpu.map[a]] = at(v)
+        if compare != None:
+            reg[cpu.Reg.Flags] = self.flags(at(compare[0]), at(compare[1]))
+        heads = {}
+        for r in written:
+            heads[r] = (reg[r] + step[r] * iterations) % Cells if r in counted else at(value[r])
+        for r in written:
+            reg[r] = heads[r]
+        cpu.clock += cycles * iterations
+        self.skipped += len(body) * iterations
+
+    @staticmethod
+    def flags(d, s):
+        if d < s:
+            return VirtualCPU.ComparisonResult.LessThan
+        elif d > s:
+            return VirtualCPU.ComparisonResult.GreaterThan
+        return VirtualCPU.ComparisonResult.EqualTo
+
+    def exitIteration(self, exit, reg, step):
+        # the first iteration (counted from 0) that leaves the loop, or -1
+        # if it cannot be computed
+        (d, s), flags = exit
+        if d[0] and s[0]:
+            return -1
+        x, y = (d, s) if d[0] else (s, d)
+        q, c = x
+        v = (reg[q] + c) % Cells if q else c % Cells
+        y = y[1] % Cells
+        # ranges of x that leave the loop
+        below, above = (1, 2) if x is d else (2, 1)
+        ranges = []
+        if flags & below and y > 0:
+            ranges.append((0, y - 1))
+        if flags & 4:
+            ranges.append((y, y))
+        if flags & above and y < Cells - 1:
+            ranges.append((y + 1, Cells - 1))
+        if any([lo <= v <= hi for lo, hi in ranges]):
+            return 0
+        k = step[q] if q else 0
+        if not ranges or k == 0:
+            return 1 << 62      # never
+        if k == 1:
+            return min([(lo - v) % Cells for lo, hi in ranges])
+        if k == Cells - 1:
+            return min([(v - hi) % Cells for lo, hi in ranges])
+        return -1
+
+
+##############################################################################
+#
+#  program analysis
+#
+#  ProgramAnalyzer follows the code like the CPU would, but without running
+#  it: from the start address (and the interrupt handlers), it decodes each
+#  instruction and goes on where it can continue or jump to. This finds the
+#  basic blocks, which cells are code, instructions no path reaches, data
+#  that would be executed, the deepest stack and the loops.
+#
+#  Decoded instructions are kept, and update() only decodes the cells again
+#  that changed since the last analysis, so it is cheap after an edit. When
+#  a program is loaded or run, update(cached = True) also keeps the results
+#  on disk in the ProgramCache, keyed by the memory image, so a program that
+#  was analyzed before (on any machine) is not decoded or followed again,
+#  and VirtualCPU.predecode() gives the decoded instructions to the CPU.
+#
+
+class ProgramAnalyzer:
+    class Cell:
+        Data = 0        # not reached
+        Code = 1        # first cell of a reached instruction
+        Operand = 2     # other cells of a reached instruction
+        Unreachable = 3 # instructions after a HLT, JMP or RET that no path reaches
+        Bad = 4         # reached, but not an instruction or inside another one
+
+    class Flow:
+        Next = 0        # goes on with the next instruction
+        Jump = 1        # JMPcc
+        Call = 2
+        Return = 3      # RET, RETcc
+        Stop = 4        # HLT
+        Error = 5       # not an instruction
+
+    Unknown = -2        # target of a jump through a register or memory
+    StackLimit = 100    # deeper stacks overflow the stack page
+
+    def __init__(self, cpu):
+        self.cpu = cpu          # decodes with its map and addressing
+        self.entries = [0]      # start addresses of the CPUs
+        self.clear()
+
+    def clear(self):
+        # forget everything, e.g. when the addressing or memory size changed
+        self.addressing = self.cpu.addressing
+        self.instructions = {}  # address -> (op, size, flow, after, target, delta)
+        self.watched = []       # addresses the analysis depends on
+        self.values = []        # their cells at the last analysis
+        self.dirty = True
+        self.kinds = bytearray(Cells)   # Cell kind of each address
+        self.blocks = {}        # start -> (end, successors) of basic blocks
+        self.calls = []         # CALL targets
+        self.returns = []       # addresses of RET and RETcc
+        self.handlers = []      # interrupt handlers
+        self.loops = []         # (head, address of the jump back)
+        self.maxStack = 0       # None if a loop or recursion keeps pushing
+
+    def setEntries(self, entries):
+        self.entries = entries
+        self.dirty = True
+
+    @staticmethod
+    def valid(op):
+        # False for codes the CPU stops at with an error
+        c = op[0]
+        if c == 990:
+            c = op[1]
+            return c // 100 in [1, 2, 3, 4, 5, 6] or c // 10 == 92
+        if c == 890:
+            c = op[1]
+            return c // 100 in [1, 2, 3, 4, 7] or c // 10 in [91, 93, 94]
+        if c in [895, 896]:
+            first, last = op[1] // 10, op[1] % 10   # see registerRange()
+            return op[1] <= 99 and 1 <= first <= last <= 8
+        if c == 987:
+            return op[1] < 6        # LIB routines
+        if c == 989:
+            return op[1] < 3        # SYS routines
+        return (100 <= c < 800 or c // 10 in [82, 85, 86, 87, 91, 92, 93, 94, 95, 96, 97]
+                or c in [898, 994, 996, 997, 998, 999])
+
+    def decode(self, a):
+        cpu = self.cpu
+        op = [Mem[cpu.map[(a + i) % Cells]] for i in range(10)]
+        if not self.valid(op):
+            return op, 1, self.Flow.Error, -1, -1, 0
+        saved = cpu.op, cpu.size
+        cpu.op = op
+        size = cpu.decode()
+        cpu.op, cpu.size = saved
+        after = (a + size) % Cells
+        c = op[0]
+        target = op[1] if c % 10 == 0 else self.Unknown
+        if c // 100 == 7:
+            cond = (c // 10) % 10
+            if cond == 0:
+                return op, size, self.Flow.Next, after, -1, 0    # never jumps
+            return op, size, self.Flow.Jump, after if cond != 7 else -1, target, 0
+        if c // 10 == 97:
+            return op, size, self.Flow.Call, after, target, 0
+        if c == 997 or c == 877:
+            return op, size, self.Flow.Return, -1, -1, 0
+        if c // 10 == 87:
+            return op, size, self.Flow.Return if c % 10 else self.Flow.Next, after, -1, 0
+        if c == 999:
+            return op, size, self.Flow.Stop, -1, -1, 0
+        delta = 0
+        if c // 10 == 96 or c == 996:
+            delta = 1
+        elif c // 10 == 95:
+            delta = -1
+        elif c in [895, 896]:
+            delta = op[1] % 10 - op[1] // 10 + 1
+            if c == 895:
+                delta = -delta
+        return op, size, self.Flow.Next, after, -1, delta
+
+    def instruction(self, a):
+        # (op, size, flow, after, target, delta) of the instruction at a:
+        # after is the address after it if the CPU can go on there (else -1),
+        # target where it can jump or call to (-1 if nowhere, Unknown if it
+        # is only known while running), delta the change of the stack depth
+        insn = self.instructions.get(a)
+        if insn == None:
+            insn = self.decode(a)
+            self.instructions[a] = insn
+        return insn
+
+    def update(self, cached = False):
+        # analyze again if watched cells changed, True if anything did;
+        # with cached, the results are looked up in (or added to) the
+        # ProgramCache, which hashes all cells, so not after each edit
+        if self.addressing != self.cpu.addressing or len(self.kinds) != Cells:
+            self.clear()    # other instruction sizes, or other cells
+        m = self.cpu.map
+        values = [Mem[m[a]] for a in self.watched]
+        if values != self.values:
+            for i in range(len(values)):
+                if values[i] != self.values[i]:
+                    self.changed(self.watched[i])
+        if not self.dirty:
+            return False
+        self.analyze(cached)
+        return True
+
+    def changed(self, a):
+        # forget the decoded instructions that have a cell at address a
+        for i in range(10):
+            insn = self.instructions.get((a - i) % Cells)
+            if insn != None and insn[1] > i:
+                del self.instructions[(a - i) % Cells]
+        self.dirty = True
+
+    def analyze(self, cached):
+        self.dirty = False
+        if cached:
+            key = programCache.key(self.cpu, self.entries)
+            results = programCache.load(key)
+            if results != None:
+                self.restore(results)
+                return
+        vectors = [VirtualTimer.Addr.Vector, VirtualGPU.Addr.FrameVector]
+        handlers = [Mem[self.cpu.map[v]] for v in vectors]
+        handlers = [a for a in handlers if a]
+        reached = self.reach(handlers, vectors)
+        self.handlers = sorted(set(handlers))
+        kinds = bytearray(Cells)
+        for a in reached:
+            size = self.instruction(a)[1]
+            for i in range(1, size):
+                kinds[(a + i) % Cells] = self.Cell.Operand
+        for a in reached:
+            if kinds[a] or self.instruction(a)[2] == self.Flow.Error:
+                kinds[a] = self.Cell.Bad    # data executed as code
+            else:
+                kinds[a] = self.Cell.Code
+        frontier = self.markUnreachable(reached, kinds)
+        self.kinds = kinds
+        self.findBlocks(reached)
+        self.findLoops()
+        self.maxStack = self.stackDepth(self.entries, 0)
+        if self.handlers and self.maxStack != None:
+            depth = self.stackDepth(self.handlers, 1)     # pushed IP
+            self.maxStack = None if depth == None else self.maxStack + depth
+        # keep only instructions of analyzed cells, others may change
+        # without being noticed
+        self.instructions = {a: insn for a, insn in self.instructions.items() if kinds[a]}
+        self.watched = [a for a in range(Cells) if kinds[a]] + sorted(frontier) + vectors
+        m = self.cpu.map
+        self.values = [Mem[m[a]] for a in self.watched]
+        if cached:
+            programCache.store(key, self.results())
+
+    def results(self):
+        # everything analyze() found, as types marshal can write
+        return (self.instructions, self.watched, self.values, bytes(self.kinds),
+                self.blocks, self.calls, self.returns, self.handlers, self.loops,
+                self.maxStack, list(self.leaders))
+
+    def restore(self, results):
+        (self.instructions, self.watched, self.values, kinds, self.blocks, self.calls,
+            self.returns, self.handlers, self.loops, self.maxStack, leaders) = results
+        self.kinds = bytearray(kinds)
+        self.leaders = set(leaders)
+
+    def reach(self, handlers, vectors):
+        # addresses of all instructions the CPU can get to
+        reached = set()
+        self.leaders = set(self.entries + handlers)  # first instructions of blocks
+        calls = set()
+        returns = []
+        ends = []           # addresses after direct jumps that always jump
+        indirect = False
+        work = list(self.leaders)
+        while work:
+            a = work.pop()
+            while a >= 0 and a not in reached:
+                reached.add(a)
+                op, size, flow, after, target, delta = self.instruction(a)
+                if target == self.Unknown:
+                    indirect = True
+                if flow == self.Flow.Jump and after < 0 and target >= 0:
+                    ends.append((a + size) % Cells)
+                if target >= 0:
+                    self.leaders.add(target)
+                    work.append(target)
+                    if flow == self.Flow.Call:
+                        calls.add(target)
+                if flow == self.Flow.Return:
+                    returns.append(a)
+                if flow != self.Flow.Next and after >= 0:
+                    self.leaders.add(after)
+                if (op[0] == 590 and op[2] in vectors and op[1] and
+                        self.cpu.addressing == self.cpu.Addressing.Classic):
+                    handlers.append(op[1])  # MOV ### to an interrupt vector
+                    self.leaders.add(op[1])
+                    work.append(op[1])
+                a = after
+            if not work and indirect:
+                # a jump through a register or memory (e.g. to a return
+                # address stored with MOV) can go to the code after a jump
+                work = [a for a in ends if a not in reached and
+                        self.instruction(a)[0][0] and self.instruction(a)[2] != self.Flow.Error]
+                self.leaders.update(work)
+        self.calls = sorted(calls)
+        self.returns = sorted(returns)
+        return reached
+
+    def markUnreachable(self, reached, kinds):
+        # instructions right after a HLT, JMP or RET that nothing jumps to
+        # are dead code; returns the cells of the instruction where each run ended
+        frontier = set()
+        for a in reached:
+            op, size, flow, after, target, delta = self.instruction(a)
+            if after >= 0 or flow == self.Flow.Error:
+                continue
+            a = (a + size) % Cells
+            cells = [a]
+            for n in range(Cells):
+                op, size, flow = self.instruction(a)[:3]
+                cells = [(a + i) % Cells for i in range(size)]
+                if op[0] == 0 or flow == self.Flow.Error or any([kinds[b] for b in cells]):
+                    break
+                for b in cells:
+                    kinds[b] = self.Cell.Unreachable
+                a = (a + size) % Cells
+            frontier.update(cells)
+        return frontier
+
+    def findBlocks(self, reached):
+        # a block runs from a leader to the next jump, call, return or leader
+        self.blocks = {}
+        for start in self.leaders & reached:
+            a = start
+            while True:
+                op, size, flow, after, target, delta = self.instruction(a)
+                if flow != self.Flow.Next or after in self.leaders:
+                    break
+                a = after
+            successors = [b for b in [after, target] if b >= 0]
+            self.blocks[start] = ((a + size) % Cells, successors)
+
+    def findLoops(self):
+        # a jump back to a block that is still being followed closes a loop
+        self.loops = []
+        state = {}      # 1 while following the block's successors, 2 done
+        for entry in self.entries + self.handlers:
+            if entry in state or entry not in self.blocks:
+                continue
+            state[entry] = 1
+            path = [(entry, iter(self.blocks[entry][1]))]
+            while path:
+                block, successors = path[-1]
+                b = next(successors, None)
+                if b == None:
+                    state[block] = 2
+                    path.pop()
+                elif state.get(b) == 1:
+                    self.loops.append((b, self.lastInstruction(block)))
+                elif b not in state and b in self.blocks:
+                    state[b] = 1
+                    path.append((b, iter(self.blocks[b][1])))
+        self.loops.sort()
+
+    def lastInstruction(self, block):
+        end = self.blocks[block][0]
+        a = block
+        while (a + self.instruction(a)[1]) % Cells != end:
+            a = (a + self.instruction(a)[1]) % Cells
+        return a
+
+    def stackDepth(self, entries, depth):
+        # the deepest stack reached from the entries, or None if it grows
+        # beyond the stack page
+        deepest = {}
+        maxDepth = depth
+        work = [(a, depth) for a in entries]
+        while work:
+            a, d = work.pop()
+            while a >= 0 and deepest.get(a, -Cells) < d:
+                if d > self.StackLimit:
+                    return None
+                deepest[a] = d
+                op, size, flow, after, target, delta = self.instruction(a)
+                maxDepth = max(maxDepth, d + max(delta, flow == self.Flow.Call))
+                if target >= 0:
+                    work.append((target, d + 1 if flow == self.Flow.Call else d))
+                a = after
+                d += delta
+        return maxDepth
+
+
+class ProgramCache:
+    # files named by a hash of everything the analysis depends on; the least
+    # recently used ones are removed when they take more than MaxBytes or
+    # are more than MaxFiles, and no file may take more than MaxFileBytes
+    MaxBytes = 16 << 20
+    MaxFiles = 1000
+    MaxFileBytes = 1 << 20
+    Version = 1             # of the results() tuple
+
+    def __init__(self, path):
+        self.path = path
+        self.size = None    # bytes of all files, counted at the first store()
+        self.files = 0
+
+    @staticmethod
+    def key(cpu, entries):
+        h = hashlib.sha1(str((ProgramCache.Version, Cells, cpu.addressing, entries)).encode())
+        m = cpu.map
+        for page in range(Cells // 100):
+            a = m[100 * page]   # pages are 100 cells in a row of Mem
+            h.update(Mem[a:a + 100])
+        return h.hexdigest()
+
+    def load(self, key):
+        path = os.path.join(self.path, key)
+        try:
+            with open(path, "rb") as fh:
+                results = marshal.loads(fh.read())
+            os.utime(path)      # recently used
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        return results
+
+    def store(self, key, results):
+        path = os.path.join(self.path, key)
+        try:
+            data = marshal.dumps(results)
+            if len(data) > self.MaxFileBytes:
+                return
+            os.makedirs(self.path, exist_ok = True)
+            with open(path + ".new", "wb") as fh:
+                fh.write(data)
+            os.replace(path + ".new", path)
+            if self.size == None:
+                self.evict()
+            else:
+                self.size += len(data)
+                self.files += 1
+                if self.size > self.MaxBytes or self.files > self.MaxFiles:
+                    self.evict()
+        except (OSError, ValueError):
+            pass                # no cache, e.g. a read-only home directory
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.path):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        self.size = sum([size for mtime, size, path in files])
+        self.files = len(files)
+        for mtime, size, path in files:
+            if self.size <= self.MaxBytes and self.files <= self.MaxFiles:
+                break
+            os.remove(path)
+            self.size -= size
+            self.files -= 1
+
+programCache = ProgramCache(os.path.join(os.path.expanduser("~"), ".alek", "cache"))
+
+
+##############################################################################
+#
+#  execution clock
+#
+#  Runs CPUs at a target frequency in cycles per second. The number of
+#  cycles to run is computed from the time since the clock was started, so
+#  late timer ticks are caught up and rounding does not drift. When a CPU
+#  falls behind by more than maxLag seconds (e.g. a suspended laptop), the
+#  lost time is dropped instead of running a long burst.
+#
+#  Several CPUs take turns (round robin), each running quantum instructions.
+#
+
+class ExecClock:
+    maxLag = 0.5
+    budget = 0.025      # seconds of host time per run() call
+
+    def __init__(self, cpus, hz = 10):
+        self.cpus = cpus
+        self.quantum = 1    # instructions per turn
+        self.rate = 0.0
+        self.setFrequency(hz)
+
+    def setFrequency(self, hz):     # 0 runs as fast as possible
+        self.hz = hz
+        self.samples = []
+        self.start(time.perf_counter())
+
+    def start(self, now):
+        self.t0 = now
+        self.c0 = [cpu.clock for cpu in self.cpus]
+        self.current = 0    # index of the CPU whose turn it is
+        self.slice = 0      # instructions done in the current turn
+
+    def rebase(self, k, now, lag = 0):
+        self.c0[k] = self.cpus[k].clock + int((lag - (now - self.t0)) * self.hz)
+
+    def target(self, k, now):
+        target = self.c0[k] + int((now - self.t0) * self.hz)
+        if target - self.cpus[k].clock > self.hz * self.maxLag:
+            self.rebase(k, now, self.maxLag)
+            target = self.c0[k] + int((now - self.t0) * self.hz)
+        return target
+
+    def clock(self):
+        return sum([cpu.clock for cpu in self.cpus])
+
+    def state(self):
+        states = [cpu.state for cpu in self.cpus]
+        for state in [VirtualCPU.State.Error, VirtualCPU.State.Break, VirtualCPU.State.Running, VirtualCPU.State.Waiting]:
+            if state in states:
+                return state
+        return VirtualCPU.State.Idle
+
+    def nextTurn(self):
+        self.current = (self.current + 1) % len(self.cpus)
+        self.slice = 0
+
+    def beginWrite(self):
+        if sharedState != None:
+            for cpu in self.cpus:
+                sharedState.beginWrite(cpu.number)
+
+    def endWrite(self):
+        if sharedState != None:
+            for cpu in self.cpus:
+                sharedState.endWrite(cpu.number)
+
+    def step(self):
+        # execute one instruction of the CPU whose turn it is
+        for i in range(len(self.cpus)):
+            cpu = self.cpus[self.current]
+            if cpu.state == cpu.State.Running:
+                self.beginWrite()
+                cpu.fetch()
+                cpu.execute()
+                self.endWrite()
+                self.slice += 1
+                if self.slice >= self.quantum:
+                    self.nextTurn()
+                return cpu
+            self.nextTurn()
+        return None
+
+    def run(self, now):
+        targets = []
+        for k, cpu in enumerate(self.cpus):
+            if cpu.state == cpu.State.Waiting and cpu.nextEvent < cpu.bus.NoEvent:
+                # time passes for devices, which may wake the CPU
+                cpu.idle(self.target(k, now) if self.hz else cpu.nextEvent)
+            if cpu.state != cpu.State.Running:
+                if cpu.state != cpu.State.Waiting or cpu.nextEvent == cpu.bus.NoEvent:
+                    self.rebase(k, now)     # do not catch up the time spent halted
+            targets.append(self.target(k, now) if self.hz else -1)
+        quantum = self.quantum if len(self.cpus) > 1 else 256
+        fuse = len(self.cpus) == 1  # turns of exactly quantum instructions
+        deadline = now + self.budget
+        self.beginWrite()
+        steps = 0
+        checked = 0
+        blocked = 0     # turns in a row in which no instruction was executed
+        while blocked < len(self.cpus):
+            cpu = self.cpus[self.current]
+            target = targets[self.current]
+            n = self.slice
+            while n < quantum and cpu.state == cpu.State.Running and (target < 0 or cpu.clock < target):
+                cpu.fetch(fuse)
+                n += cpu.execute()
+            done = n - self.slice
+            steps += done
+            blocked = 0 if done else blocked + 1
+            self.slice = n
+            if n >= quantum or done == 0 or cpu.state != cpu.State.Running:
+                self.nextTurn()
+            if steps - checked >= 256:
+                checked = steps
+                if time.perf_counter() > deadline:
+                    break
+        self.endWrite()
+        self.measure(now)
+        return steps
+
+    def measure(self, now):
+        # achieved cycles per second over about the last second
+        clock = self.clock()
+        if self.samples and clock < self.samples[-1][1]:
+            self.samples = []   # CPU was reset
+        self.samples.append((now, clock))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= 1.0:
+            del self.samples[0]
+        t, c = self.samples[0]
+        self.rate = 0.0
+        if now > t:
+            self.rate = (clock - c) / (now - t)
+
+
+##############################################################################
+#
+#  shared memory
+#
+#  Keeps the memory cells and CPU registers in a block of 16-bit cells in
+#  shared memory, so other processes can read the machine state without
+#  copying it through a pipe. Each CPU has a sequence counter, which is odd
+#  while it runs instructions. A reader copies the state and retries when a
+#  counter was odd or has changed meanwhile (torn read).
+#
+
+class SharedState:
+    class Header:
+        Cells = 0           # number of memory cells
+        Processors = 1      # number of CPUs
+        Console = 2         # number of console text cells
+        Size = 3            # followed by one sequence counter per CPU,
+                            # the memory cells, 20 registers per CPU, the
+                            # console text and state, and the GPU state
+
+    def __init__(self, name = None, cells = 0, processors = 0, console = 0):
+        if name == None:
+            size = self.Header.Size + processors + cells + 20 * processors + console + 3 + 3
+            self.block = shared_memory.SharedMemory(create = True, size = 2 * size)
+            self.view = self.block.buf.cast('H')
+            self.view[self.Header.Cells] = cells
+            self.view[self.Header.Processors] = processors
+            self.view[self.Header.Console] = console
+        else:
+            # attach to the state of another process; before Python 3.13,
+            # the resource tracker would remove the block when we exit
+            self.block = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(self.block._name, "shared_memory")
+            self.view = self.block.buf.cast('H')
+            cells = self.view[self.Header.Cells]
+            processors = self.view[self.Header.Processors]
+            console = self.view[self.Header.Console]
+        self.owner = name == None
+        self.name = self.block.name
+        a = self.Header.Size
+        self.sequence = self.view[a:a + processors]
+        a += processors
+        self.cells = self.view[a:a + cells]
+        a += cells
+        self.regs = []
+        for k in range(processors):
+            self.regs.append(self.view[a:a + 20])
+            a += 20
+        self.consoleText = self.view[a:a + console]
+        a += console
+        self.consoleState = self.view[a:a + 3]
+        a += 3
+        self.gpuState = self.view[a:a + 3]
+
+    def beginWrite(self, k):
+        self.sequence[k] = (self.sequence[k] + 1) % 65536
+
+    def endWrite(self, k):
+        self.sequence[k] = (self.sequence[k] + 1) % 65536
+
+    def read(self):
+        # consistent copy of the memory cells and the registers
+        while True:
+            sequence = self.sequence.tolist()
+            if not any([v % 2 for v in sequence]):
+                cells = self.cells.tolist()
+                regs = [r.tolist() for r in self.regs]
+                if self.sequence.tolist() == sequence:
+                    return cells, regs
+            time.sleep(0)
+
+    def close(self):
+        views = [self.sequence, self.cells] + self.regs
+        for view in views + [self.consoleText, self.consoleState, self.gpuState, self.view]:
+            view.release()
+        self.block.close()
+        if self.owner:
+            self.block.unlink()
+
+
+def shareState(cpus):
+    # move Mem and the registers of the CPUs into shared memory
+    global Mem, sharedState
+    for page in range(Cells // 100):
+        touchPage(100 * page)   # Mem cannot grow in shared memory
+    sharedState = SharedState(None, len(Mem), len(cpus), len(console.text))
+    cells = sharedState.cells
+    for a in range(len(Mem)):
+        cells[a] = Mem[a]
+    Mem = cells
+    for cpu in cpus:
+        regs = sharedState.regs[cpu.number]
+        for r in range(20):
+            regs[r] = cpu.reg[r]
+        cpu.reg = regs
+    # lines written and pages flipped by CPUs in other processes show up
+    # in the UI
+    sharedState.consoleText[:] = console.text
+    sharedState.consoleState[:] = console.state
+    console.text = sharedState.consoleText
+    console.state = sharedState.consoleState
+    sharedState.gpuState[:] = gpu.state
+    gpu.state = sharedState.gpuState
+
+
+def unshareState(cpus):
+    global Mem, sharedState
+    Mem = array('H', Mem)
+    for cpu in cpus:
+        cpu.reg = cpu.reg.tolist()
+    console.text = array('H', console.text)
+    console.state = array('H', console.state)
+    gpu.state = array('H', gpu.state)
+    sharedState.close()
+    sharedState = None
+
+
+##############################################################################
+#
+#  parallel execution
+#
+#  Runs each CPU in its own process. Mem and the CPU registers are moved
+#  into shared memory (if not already) while the processes run, so the UI
+#  can show them.
+#
+
+class ParallelRunner:
+    class Control:
+        State = 0       # CPU state, written by the CPU process
+        Clock = 1       # CPU clock, written by the CPU process
+        IntSP = 2       # CPU intSP, written by the CPU process
+        Command = 3     # written by the UI process
+
+    class Command:
+        Run = 0
+        Wake = 1
+        Stop = 2
+
+    def __init__(self, cpus, hz):
+        self.cpus = cpus
+        self.hz = hz
+        self.processes = []
+        self.shared = False     # whether start() moved the state into shared memory
+
+    @staticmethod
+    def available():
+        return "fork" in multiprocessing.get_all_start_methods()
+
+    def start(self):
+        if sharedState == None:
+            shareState(self.cpus)
+            self.shared = True
+        context = multiprocessing.get_context("fork")
+        for cpu in self.cpus:
+            cpu.control = multiprocessing.RawArray('l', [cpu.state, cpu.clock, cpu.intSP, self.Command.Run])
+            process = context.Process(target = self.work, args = (cpu,), daemon = True)
+            process.start()
+            self.processes.append(process)
+
+    def work(self, cpu):
+        # this runs in the CPU process
+        clock = ExecClock([cpu], self.hz)
+        control = cpu.control
+        while control[self.Control.Command] != self.Command.Stop:
+            if control[self.Control.Command] == self.Command.Wake:
+                control[self.Control.Command] = self.Command.Run
+                cpu.wake()
+            clock.run(time.perf_counter())
+            control[self.Control.State] = cpu.state
+            control[self.Control.Clock] = cpu.clock
+            control[self.Control.IntSP] = cpu.intSP
+            time.sleep(0.005)
+
+    def poll(self):
+        for cpu in self.cpus:
+            cpu.state = cpu.control[self.Control.State]
+            cpu.clock = cpu.control[self.Control.Clock]
+
+    def wake(self):
+        for cpu in self.cpus:
+            if cpu.control[self.Control.State] == cpu.State.Waiting:
+                cpu.control[self.Control.Command] = self.Command.Wake
+
+    def stop(self):
+        for cpu in self.cpus:
+            cpu.control[self.Control.Command] = self.Command.Stop
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.poll()
+        for cpu in self.cpus:
+            # device events were scheduled in the CPU process, so they are
+            # scheduled again from the clock it reached
+            cpu.intSP = cpu.control[self.Control.IntSP]
+            cpu.bus.reset()
+        if self.shared:
+            unshareState(self.cpus)
+
+
+##############################################################################
+#
+#  machines
+#
+#  The CPU and device code work on the global Mem, devices and debugger
+#  stops. A Machine has its own set of these and select() makes it the
+#  current one, so several machines can take turns in one process.
+#
+
+class Machine:
+    def __init__(self):
+        self.map, self.mem, self.pageFlags = newMemory()
+        self.maps = [self.map]
+        self.stops = bytearray(Cells)
+        self.conditions = []
+        self.gpu = None
+        self.io = None
+        self.timer = None
+        self.console = None
+        self.select()
+        self.gpu = VirtualGPU()
+        self.io = VirtualIO()
+        self.timer = VirtualTimer()
+        self.console = VirtualConsole()
+        self.cpu = VirtualCPU()
+        self.select()
+        self.cpu.bus.attach(self.gpu)
+        self.cpu.bus.attach(self.timer)
+        self.cpu.bus.attach(self.console)
+
+    def select(self):
+        global Map, Maps, Mem, Stops, Conditions, PageFlags, gpu, io, timer, console
+        Map = self.map
+        Maps = self.maps
+        Mem = self.mem
+        Stops = self.stops
+        Conditions = self.conditions
+        PageFlags = self.pageFlags
+        gpu = self.gpu
+        io = self.io
+        timer = self.timer
+        console = self.console
+
+    def reset(self):
+        self.select()
+        self.gpu.reset()
+        self.io.reset()
+        self.timer.reset()
+        self.console.reset()
+        self.cpu.reset()
+        self.cpu.state = self.cpu.State.Running
+
+    def run(self, count):
+        # execute up to count instructions, a waiting CPU skips to the
+        # next device event (each skip counts like an instruction)
+        cpu = self.cpu
+        if cpu.state == cpu.State.Break:
+            cpu.state = cpu.State.Running
+        steps = 0
+        skips = 0
+        while steps + skips < count:
+            if cpu.state == cpu.State.Waiting and cpu.nextEvent < cpu.bus.NoEvent:
+                cpu.idle(cpu.nextEvent)
+                skips += 1
+                continue
+            if cpu.state != cpu.State.Running:
+                break
+            cpu.fetch(count - steps - skips > 1)
+            steps += cpu.execute()
+        return steps
+
+
+##############################################################################
+#
+#  debug server
+#
+#  Lets editors, test scripts or a grader drive ALEK without the UI:
+#
+#      python3 alek.py --server [port]
+#
+#  Each line sent to the server is a JSON request like {"cmd": "step",
+#  "count": 100}, and each reply is a JSON line with "ok" or "error".
+#  Every connection has its own machine (a session). With "run", the
+#  session manager keeps running the machine in the background, so a
+#  whole class can share one host.
+#
+
+DebugPort = 7100
+
+class DebugSession:
+    Chunk = 1000    # instructions run before other sessions get a turn
+
+    def __init__(self, manager = None):
+        self.manager = manager
+        self.machine = Machine()
+        self.machine.reset()
+        self.running = False    # "run" was requested
+        self.hot = False        # in the manager's list of running sessions
+        self.commands = {
+            "load": self.load,
+            "reset": self.reset,
+            "step": self.step,
+            "read": self.read,
+            "write": self.write,
+            "registers": self.registers,
+            "break": self.setBreakpoint,
+            "protect": self.protect,
+            "run": self.run,
+            "stop": self.stop,
+            "key": self.key,
+            "metrics": self.metrics,
+            "analyze": self.analyze,
+            "console": self.console,
+        }
+        self.analyzer = ProgramAnalyzer(self.machine.cpu)
+        # metrics
+        self.requests = 0
+        self.latency = 0.0      # average seconds to handle a request
+        self.steps = 0          # instructions run by the manager
+        self.samples = []       # (time, steps) over about the last second
+        self.throughput = 0.0   # instructions per second
+        self.lastTurn = 0.0
+        self.turnGap = 0.0      # average seconds between turns
+
+    async def handle(self, request):
+        start = time.perf_counter()
+        if not isinstance(request, dict):
+            return {"error": "request is not an object"}
+        command = self.commands.get(request.get("cmd"))
+        if command == None:
+            return {"error": "unknown command"}
+        self.machine.select()
+        try:
+            reply = await command(request)
+        except Exception as e:
+            # only this request fails, e.g. for 1e400 as a cell value
+            return {"error": type(e).__name__ + ": " + str(e)}
+        reply["ok"] = True
+        self.requests += 1
+        self.latency += (time.perf_counter() - start - self.latency) / min(self.requests, 100)
+        return reply
+
+    def account(self, steps, now):
+        # called by the manager after each turn
+        if self.lastTurn:
+            self.turnGap += (now - self.lastTurn - self.turnGap) / 16
+        self.lastTurn = now
+        self.steps += steps
+        self.samples.append((now, self.steps))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= 1.0:
+            del self.samples[0]
+        t, n = self.samples[0]
+        self.throughput = (self.steps - n) / (now - t) if now > t else 0.0
+
+    def cell(self, a):
+        return self.machine.cpu.map[int(a) % Cells]
+
+    async def load(self, request):
+        # {"cells": [...], "address": 0, "addressing": 0, "fastLoops": false}
+        mem = self.machine.mem
+        for a in range(len(mem)):
+            mem[a] = 0
+        await self.write(request)
+        self.machine.cpu.setAddressing(request.get("addressing", VirtualCPU.Addressing.Classic))
+        self.machine.cpu.loops = LoopAccelerator() if request.get("fastLoops") else None
+        await self.reset(request)
+        self.prepare()
+        return {}
+
+    def prepare(self):
+        # a program that is loaded or run: its analysis comes from (or goes
+        # to) the ProgramCache, and the CPU gets its decoded instructions
+        self.analyzer.update(cached = True)
+        self.machine.cpu.predecode(self.analyzer)
+
+    async def reset(self, request):
+        self.machine.reset()
+        return {}
+
+    async def step(self, request):
+        # {"count": 1}, stops early at a breakpoint or when the CPU halts
+        count = request.get("count", 1)
+        steps = 0
+        while steps < count:
+            n = self.machine.run(min(self.Chunk, count - steps))
+            steps += n
+            if n < self.Chunk:
+                break
+            await asyncio.sleep(0)
+            self.machine.select()
+        return {"steps": steps, "state": self.machine.cpu.state}
+
+    async def read(self, request):
+        # {"ranges": [[address, count], ...]}, all in one round trip
+        mem = self.machine.mem
+        ranges = []
+        for a, n in request["ranges"]:
+            ranges.append([mem[self.cell(a + i)] for i in range(min(int(n), Cells))])
+        return {"cells": ranges}
+
+    async def write(self, request):
+        # {"address": 0, "cells": [...]}
+        a = int(request.get("address", 0))
+        cells = [int(v) % Cells for v in request["cells"]]
+        for i in range(len(cells)):
+            touchPage((a + i) % Cells)
+            self.machine.mem[self.cell(a + i)] = cells[i]
+            self.machine.cpu.bus.written((a + i) % Cells)
+        self.machine.cpu.decoded.clear()
+        return {}
+
+    async def registers(self, request):
+        cpu = self.machine.cpu
+        return {"reg": list(cpu.reg), "state": cpu.state, "clock": cpu.clock}
+
+    async def setBreakpoint(self, request):
+        # {"address": 14, "kind": "break" or "watch", "set": true}
+        flag = {"break": VirtualCPU.Stop.Break, "watch": VirtualCPU.Stop.Watch}[request.get("kind", "break")]
+        a = int(request["address"]) % Cells
+        if request.get("set", True):
+            self.machine.stops[a] |= flag
+        else:
+            self.machine.stops[a] &= ~flag
+        return {}
+
+    async def protect(self, request):
+        # {"page": 0, "flags": 1}, VirtualCPU.PageFlag bits
+        protectPage(int(request["page"]) % (Cells // 100), int(request["flags"]) & 7)
+        self.machine.cpu.decoded.clear()
+        return {}
+
+    async def run(self, request):
+        # keep running in the background until "stop"
+        if self.manager == None:
+            raise ValueError("no session manager")
+        self.prepare()
+        self.running = True
+        self.manager.admit(self)
+        return {}
+
+    async def stop(self, request):
+        self.running = False
+        if self.manager != None:
+            self.manager.evict(self)
+        return {"state": self.machine.cpu.state}
+
+    async def key(self, request):
+        # {"key": 48}, a character code for the keyboard buffer
+        cpu = self.machine.cpu
+        if not self.machine.io.pushKey(int(request["key"]) % Cells):
+            raise ValueError("keyboard buffer full")
+        cpu.wake()
+        if self.running:
+            self.manager.admit(self)
+        return {}
+
+    async def analyze(self, request):
+        # the control flow of the program from address 0 (see ProgramAnalyzer)
+        analyzer = self.analyzer
+        analyzer.update()
+        kinds = analyzer.kinds
+        return {
+            "blocks": [[a, end, successors] for a, (end, successors) in sorted(analyzer.blocks.items())],
+            "calls": analyzer.calls,
+            "returns": analyzer.returns,
+            "handlers": analyzer.handlers,
+            "loops": [list(loop) for loop in analyzer.loops],
+            "unreachable": [a for a in range(Cells) if kinds[a] == ProgramAnalyzer.Cell.Unreachable],
+            "bad": [a for a in range(Cells) if kinds[a] == ProgramAnalyzer.Cell.Bad],
+            "maxStack": analyzer.maxStack,
+        }
+
+    async def console(self, request):
+        # the text lines written to the output port
+        return {"lines": self.machine.console.lineTexts()}
+
+    async def metrics(self, request):
+        reply = {
+            "requests": self.requests,
+            "latency": self.latency,
+            "steps": self.steps,
+            "throughput": self.throughput,
+            "turnGap": self.turnGap,
+            "state": self.machine.cpu.state,
+        }
+        if self.machine.cpu.loops != None:
+            reply["skipped"] = self.machine.cpu.loops.skipped
+        if self.manager != None:
+            reply.update(self.manager.metrics())
+        return reply
+
+
+##############################################################################
+#
+#  session manager
+#
+#  Runs the machines of all sessions that asked to "run" in one asyncio
+#  task. Each tick, every running session gets the same instruction budget;
+#  the budget adapts so that one round takes about one tick, no matter how
+#  many sessions there are. Sessions whose CPU halted, stopped or still
+#  waits at the end of its turn are dropped from the round until a request
+#  (e.g. a key) wakes them.
+#
+
+class SessionManager:
+    Tick = 0.01         # seconds per scheduling round
+    MinBudget = 10
+    MaxBudget = 10000
+
+    def __init__(self):
+        self.sessions = []
+        self.hot = []           # sessions that run each round
+        self.budget = 1000      # instructions per session and round
+        self.roundTime = 0.0    # seconds used by the last round
+        self.task = None
+
+    def open(self):
+        session = DebugSession(self)
+        self.sessions.append(session)
+        return session
+
+    def close(self, session):
+        session.running = False
+        self.evict(session)
+        self.sessions.remove(session)
+
+    def admit(self, session):
+        if not session.hot:
+            session.hot = True
+            session.lastTurn = 0.0
+            self.hot.append(session)
+
+    def evict(self, session):
+        if session.hot:
+            session.hot = False
+            self.hot.remove(session)
+
+    def start(self):
+        if self.task == None:
+            self.task = asyncio.ensure_future(self.schedule())
+
+    async def schedule(self):
+        while True:
+            start = time.perf_counter()
+            hot = []
+            for session in self.hot:
+                machine = session.machine
+                machine.select()
+                steps = machine.run(self.budget)
+                session.account(steps, time.perf_counter())
+                cpu = machine.cpu
+                if (cpu.state == cpu.State.Running or
+                        cpu.state == cpu.State.Waiting and cpu.nextEvent < cpu.bus.NoEvent):
+                    hot.append(session)     # a device event may wake a waiting CPU
+                else:
+                    session.hot = False
+            self.hot = hot
+            self.roundTime = time.perf_counter() - start
+            if hot and self.roundTime > 0:
+                budget = int(self.budget * self.Tick / self.roundTime)
+                if budget > self.budget:
+                    budget = (self.budget + budget) // 2    # grow slowly
+                self.budget = max(self.MinBudget, min(budget, self.MaxBudget))
+            await asyncio.sleep(max(0.0, self.Tick - self.roundTime))
+
+    def metrics(self):
+        return {
+            "sessions": len(self.sessions),
+            "running": len(self.hot),
+            "budget": self.budget,
+            "roundTime": self.roundTime,
+        }
+
+    async def serveConnection(self, reader, writer):
+        session = self.open()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    reply = {"error": "invalid JSON"}
+                else:
+                    reply = await session.handle(request)
+                writer.write((json.dumps(reply) + "\n").encode())
+                await writer.drain()
+        finally:
+            self.close(session)
+            writer.close()
+
+    async def serve(self, port):
+        self.start()
+        server = await asyncio.start_server(self.serveConnection, "127.0.0.1", port)
+        async with server:
+            await server.serve_forever()
+
+
+class DebugClient:
+    # talks to a debug server, e.g. await client.request("step", count = 10)
+    async def connect(self, port, host = "127.0.0.1"):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+
+    async def request(self, cmd, **args):
+        args["cmd"] = cmd
+        self.writer.write((json.dumps(args) + "\n").encode())
+        await self.writer.drain()
+        return json.loads(await self.reader.readline())
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+class LocalClient(DebugClient):
+    # stand-in for tests: same requests, handled in this process
+    def __init__(self, manager = None):
+        self.manager = manager
+
+    async def connect(self, port = 0, host = None):
+        if self.manager == None:
+            self.manager = SessionManager()
+        self.manager.start()
+        self.session = self.manager.open()
+
+    async def request(self, cmd, **args):
+        args["cmd"] = cmd
+        return json.loads(json.dumps(await self.session.handle(args)))
+
+    async def close(self):
+        self.manager.close(self.session)
+
+
+def formatFrequency(hz):
+    if hz >= 1000000:
+        return "%.2f MHz" % (hz / 1000000)
+    elif hz >= 1000:
+        return "%.1f kHz" % (hz / 1000)
+    return "%.1f Hz" % hz
+
+
+##############################################################################
+#
+#  autosave
+#
+#  The Journal keeps the memory and registers of the UI in a file, so an
+#  empty battery loses at most about a second of work. The file starts with
+#  a snapshot in the project format, and each edit appends a line in the
+#  same format, so an edit costs the same for any memory size. Replaying
+#  all lines gives the last state. Now and then, the file is written again
+#  as a single snapshot (compaction), which also keeps what programs did.
+#
+
+AutosavePath = os.path.join(os.path.expanduser("~"), ".alek", "autosave.alek")
+
+def projectRecords(lines):
+    # the records of the lines after "ALEKv001" in a project file or the
+    # journal, up to a torn last line or a corrupt line; returns (records,
+    # None) or (records before the corrupt line, "line n: reason")
+    records = []
+    for n, line in enumerate(lines, 2):
+        if not line.endswith("\n"):
+            break   # torn by a crash while appending
+        try:
+            record = ast.literal_eval(line)
+            checkRecord(record)
+        except Exception as e:
+            return records, "line %d: %s" % (n, type(e).__name__)
+        records.append(record)
+    return records, None
+
+def checkRecord(record):
+    # raises ValueError unless MainWindow.loadProject can apply the record
+    # (unknown keys are ignored there)
+    def numbers(v):
+        return isinstance(v, list) and all([type(c) == int and 0 <= c < 1 << 62 for c in v])
+    if not isinstance(record, dict):
+        raise ValueError("not a record")
+    for key, v in record.items():
+        if key == 'mem_digits':
+            ok = v in [3, 4]
+        elif key == 'cpu_state':
+            ok = type(v) == int and VirtualCPU.State.Error <= v <= VirtualCPU.State.Break
+        elif key == 'cpu_addressing':
+            ok = v in [VirtualCPU.Addressing.Classic, VirtualCPU.Addressing.Extended]
+        elif key == 'cpu_reg':
+            ok = numbers(v)
+        elif key == 'mem':
+            ok = isinstance(v, list) and len(v) == 2 and type(v[0]) == int and numbers(v[1])
+        else:
+            ok = True
+        if not ok:
+            raise ValueError("bad " + key)
+
+class Journal:
+    SyncInterval = 1.0      # seconds between fsyncs of appended lines
+    CompactInterval = 60.0  # seconds between compactions
+    MaxRecords = 1000       # lines appended before compacting anyway
+
+    def __init__(self, path):
+        self.path = path
+        self.fh = None      # appends go here, None while replaying
+        self.records = 0    # lines appended since the snapshot
+        self.unsynced = False
+        self.lastSync = 0.0
+        self.lastCompact = 0.0
+
+    def replay(self):
+        # the records of the file (see projectRecords); a corrupt file is
+        # moved to path + ".bad", so the next compaction keeps it
+        try:
+            with open(self.path, "r", errors = "replace") as fh:
+                if fh.readline() != "ALEKv001\n":
+                    return [], None
+                records, error = projectRecords(fh)
+        except OSError:
+            return [], None
+        if error != None:
+            try:
+                os.replace(self.path, self.path + ".bad")
+            except OSError:
+                pass
+        return records, error
+
+    def append(self, record):
+        if self.fh == None:
+            return
+        self.fh.write(str(record) + "\n")
+        self.records += 1
+        self.unsynced = True
+
+    def due(self, now):
+        # whether the next compaction is due
+        return self.records >= self.MaxRecords or now - self.lastCompact >= self.CompactInterval
+
+    def sync(self, now):
+        # at most once per SyncInterval, so fast edits do not wait for the disk
+        if self.fh == None or not self.unsynced or now - self.lastSync < self.SyncInterval:
+            return
+        try:
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+        except OSError:
+            return
+        self.unsynced = False
+        self.lastSync = now
+
+    def compact(self, lines, now):
+        # write the snapshot to a new file and replace the journal with it,
+        # so a crash leaves either the old or the new file
+        self.close()
+        path = self.path + ".new"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok = True)
+            with open(path, "w") as fh:
+                fh.write("ALEKv001\n")
+                fh.writelines(lines)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(path, self.path)
+            self.fh = open(self.path, "a")
+        except OSError:
+            self.fh = None  # no autosave, e.g. a read-only home directory
+        self.records = 0
+        self.unsynced = False
+        self.lastSync = now
+        self.lastCompact = now
+
+    def close(self):
+        if self.fh != None:
+            self.fh.close()
+            self.fh = None
+
+
+##############################################################################
+#
+#  undo
+#
+#  The EditHistory keeps the cells changed by UI edits as runs of (address,
+#  old cells, new cells). A run does not cross a page, so its cells are a
+#  slice of Mem (copied, since Mem may be a view of shared memory), and
+#  undoing 1000 cells takes ten slice assignments. Bulk operations, such as
+#  loading a demo, are a single entry.
+#
+
+class EditHistory:
+    MaxCells = 200000       # old and new cells kept for all entries
+
+    def __init__(self):
+        self.undoList = []  # entries [map, runs], the last one is undone first
+        self.redoList = []
+        self.cells = 0
+        self.map = None     # while editing, the map that is written
+        self.entry = None   # and runs of (address, old cells)
+
+    def clear(self):
+        self.undoList.clear()
+        self.redoList.clear()
+        self.cells = 0
+
+    def begin(self, map):
+        self.map = map
+        self.entry = []
+
+    def save(self, a, n):
+        # the old cells of addresses a..a+n-1, before they are written
+        while n > 0:
+            k = min(n, 100 - a % 100)
+            m = self.map[a]
+            self.entry.append((a, array('H', Mem[m:m + k])))
+            a += k
+            n -= k
+
+    def end(self):
+        # the new cells, pages may have been allocated since save()
+        runs = []
+        map = self.map
+        for a, old in self.entry:
+            m = map[a]
+            new = array('H', Mem[m:m + len(old)])
+            if new != old:
+                runs.append((a, old, new))
+                self.cells += 2 * len(old)
+        self.map = None
+        self.entry = None
+        if not runs:
+            return
+        self.undoList.append([map, runs])
+        for entry in self.redoList:
+            self.cells -= self.entryCells(entry)
+        self.redoList.clear()
+        while self.cells > self.MaxCells and len(self.undoList) > 1:
+            self.cells -= self.entryCells(self.undoList.pop(0))
+
+    @staticmethod
+    def entryCells(entry):
+        return sum([2 * len(old) for a, old, new in entry[1]])
+
+    def undo(self):
+        # the runs of (address, cells) that were written, or []
+        if not self.undoList:
+            return []
+        entry = self.undoList.pop()
+        self.redoList.append(entry)
+        return self.restore(entry[0], [(a, old) for a, old, new in reversed(entry[1])])
+
+    def redo(self):
+        if not self.redoList:
+            return []
+        entry = self.redoList.pop()
+        self.undoList.append(entry)
+        return self.restore(entry[0], [(a, new) for a, old, new in entry[1]])
+
+    @staticmethod
+    def restore(map, runs):
+        for a, cells in runs:
+            touchPage(a)
+            m = map[a]
+            Mem[m:m + len(cells)] = cells
+        return runs
+
+
 ##############################################################################
 #
 #  ALEK's UI widgets
@@ -770,6 +3541,10 @@ def setTableAttributes(table, hlabels, vlabels, hsize, vsize, selectionMode):
 
 
 class MemoryWidget(QTableWidget):
+    # backgrounds for ProgramAnalyzer.Cell kinds
+    KindColors = [None, QColor(220, 235, 255), QColor(236, 244, 255),
+                  QColor(225, 225, 225), QColor(255, 205, 240)]
+
     def __init__(self, rows, columns, parent):
         QTableWidget.__init__(self, rows, columns, parent)
         hlabels = []
@@ -777,32 +3552,45 @@ class MemoryWidget(QTableWidget):
             hlabels += ["0" + str(x)]
         vlabels = []
         for y in range(10):
-            vlabels += [str(10 * y).zfill(3)]
+            vlabels += [str(10 * y).zfill(Digits)]
         setTableAttributes(self, hlabels, vlabels, 60, 40, QTableWidget.SelectionMode.ExtendedSelection)
+        self.map = Map      # pages as seen by the selected CPU
+        self.analyzer = ProgramAnalyzer(cpu)    # colors code cells
         self.setPage(0)
 
     def setPage(self, page):
         self.page = page
         vlabels = []
         for y in range(10):
-            vlabels += [str(100 * self.page + 10 * y).zfill(3)]
+            vlabels += [str(100 * self.page + 10 * y).zfill(Digits)]
         self.setVerticalHeaderLabels(vlabels)
         self.updateCells()
 
     def updateCells(self):
+        self.analyzer.update()
         for y in range(10):
             for x in range(10):
                 self.updateCell(y, x)
 
     def updateCell(self, y, x):
-        v = Mem[Map[100 * self.page + 10 * y + x]]
-        item = QTableWidgetItem(str(v).zfill(3))
+        a = 100 * self.page + 10 * y + x
+        v = Mem[self.map[a]]
+        item = QTableWidgetItem(str(v).zfill(Digits))
         item.setTextAlignment(Qt.AlignmentFlag.AlignCenter)
         if v == 0:
             item.setForeground(QColor(0, 0, 0, 60))
+        if Stops[a] & VirtualCPU.Stop.Break:
+            item.setBackground(QColor(255, 190, 190))
+        elif Stops[a] & VirtualCPU.Stop.Watch:
+            item.setBackground(QColor(255, 235, 170))
+        elif self.analyzer.kinds[a]:
+            item.setBackground(self.KindColors[self.analyzer.kinds[a]])
         self.setItem(y, x, item)
 
     def updateCellAddress(self, v):
+        if self.analyzer.update():
+            self.updateCells()  # the edit changed which cells are code
+            return
         if v // 100 != self.page:
             return
         y = (v // 10) % 10
@@ -850,7 +3638,7 @@ class CodeInspectorWidget(QTableWidget):
 
     def setData(self, data, size = 1):
         self.setRangeSelected(QTableWidgetSelectionRange(0, 0, 2, 9), False)
-        if size > 0:
+        if size > 0 and data[0] < 1000:
             l = [ ["---", "ADD", "SUB", "---", "---", "MOV", "CMP", "JMP", "---", ">>>"] ]
             d = data[0] // 100
             if d in [9]:
@@ -1003,6 +3791,12 @@ class ColorInspectorWidget(QWidget):
         w.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
         self.colorTable = w
         w.cellClicked.connect(self.tableClicked)
+        for y in range(3):
+            for x in range(10):
+                item = QTableWidgetItem("██")
+                item.setTextAlignment(Qt.AlignmentFlag.AlignCenter)
+                item.setFont(font)
+                w.setItem(y, x, item)
 
     codeClicked = pyqtSignal(int)
 
@@ -1017,8 +3811,8 @@ class ColorInspectorWidget(QWidget):
         self.codeClicked.emit(c)
 
     def updateColorTable(self):
-        font = QFont("Courier")
-        font.setPixelSize(24)
+        # the items are kept, only their colors change
+        colors = gpu.Colors
         for y in range(3):
             for x in range(10):
                 (R, G, B) = (self.R, self.G, self.B)
@@ -1028,18 +3822,16 @@ class ColorInspectorWidget(QWidget):
                     G = x
                 else:
                     B = x
-                item = QTableWidgetItem()
-                color = QColor(gpu.ColorMap[100 * R + 10 * G + B])
+                item = self.colorTable.item(y, x)
+                color = colors[100 * R + 10 * G + B]
                 if (R, G, B) == (self.R, self.G, self.B):
                     item.setBackground(color)
+                else:
+                    item.setBackground(QBrush())
                 item.setForeground(color)
-                item.setTextAlignment(Qt.AlignmentFlag.AlignCenter)
-                item.setText("██")
-                item.setFont(font)
-                self.colorTable.setItem(y, x, item)
 
     def setData(self, data, size = 1):
-        self.R = data[0] // 100
+        self.R = (data[0] // 100) % 10
         self.G = (data[0] // 10) % 10
         self.B = data[0] % 10
         self.updateColorTable()
@@ -1100,6 +3892,17 @@ class MemoryTabBar(QTabBar):
         self.addTab("Color 8  ")
         self.addTab("Stack 9")
 
+    def setBank(self, bank, banks):
+        # with more than 10 pages, the tabs show the pages of one bank
+        labels = ["Memory  " + str(10 * bank) + "  "] + [str(10 * bank + i) for i in range(1, 10)]
+        if bank == 0:
+            labels[7] = "Text 7  "
+            labels[8] = "Color 8  "
+        if bank == banks - 1:
+            labels[9] = "Stack " + str(10 * bank + 9)
+        for i in range(10):
+            self.setTabText(i, labels[i])
+
     def minimumTabSizeHint(self, index):
         size = QTabBar.minimumTabSizeHint(self, index)
         if index in [1, 2, 3, 4, 5, 6]:
@@ -1113,6 +3916,22 @@ class CPUTabBar(QTabBar):
         self.addTab("CPU")
         self.setToolTip("Central Processing Unit")
 
+        self.label = "CPU"
+
+    def setProcessors(self, n):
+        self.blockSignals(True)
+        while self.count() > 1:
+            self.removeTab(1)
+        self.label = "CPU" if n == 1 else "CPU 0"
+        self.setTabText(0, self.label)
+        for i in range(1, n):
+            self.addTab(str(i))
+        self.setCurrentIndex(0)
+        self.blockSignals(False)
+
+    def showRate(self, text):
+        self.setTabText(0, self.label + ("  " + text if text else ""))
+
 
 class CPUWidget(QFrame):
     def __init__(self, parent):
@@ -1132,6 +3951,13 @@ class CPUWidget(QFrame):
 
         self.regs1.cellChanged.connect(self.registerChanged)
 
+        self.cpu = cpu
+        self.old = [-1] * 10
+
+    registerEdited = pyqtSignal()
+
+    def setCPU(self, cpu):
+        self.cpu = cpu
         self.old = [-1] * 10
 
     def addRegisterFile(self, labels, geometry):
@@ -1187,38 +4013,39 @@ class CPUWidget(QFrame):
             v = 0
             text = item.text()
             if text.isnumeric():
-                v = int(text) % 1000
+                v = int(text) % Cells
             if y < 4:
                 r = y + 1
             else:
                 r = 9
-            cpu.reg[r] = v
+            self.cpu.reg[r] = v
             self.updateState()
+            self.registerEdited.emit()
 
     def showStack(self):
-        sp = cpu.reg[cpu.Reg.SP]
+        sp = self.cpu.reg[self.cpu.Reg.SP]
         if sp == 0:
-            sp = 1000
-        base = min(996, sp)
+            sp = Cells
+        base = min(Cells - 4, sp)
         vlabels = ["", "", "", "", "SP"]
         for i in range(4):
             if i + base >= sp:
-                vlabels[i] = str(i + base).zfill(3)
+                vlabels[i] = str(i + base).zfill(Digits)
         self.regs2.setVerticalHeaderLabels(vlabels)
         w = self.regs2
         for i in range(5):
             item = QTableWidgetItem()
             item.setTextAlignment(Qt.AlignmentFlag.AlignCenter)
             if i == 4:
-                v = cpu.reg[cpu.Reg.SP]
+                v = self.cpu.reg[self.cpu.Reg.SP]
             else:
                 v = ""
                 if i + base >= sp:
-                    v = Mem[Map[i + base]]
+                    v = Mem[self.cpu.map[i + base]]
             if v != "":
                 if v == 0:
                     item.setForeground(QColor(0, 0, 0, 100))
-                v = str(v).zfill(3)
+                v = str(v).zfill(Digits)
             if w.item(i, 0) == None or v != w.item(i, 0).text():
                 item.setText(v)
                 w.blockSignals(True)
@@ -1227,7 +4054,7 @@ class CPUWidget(QFrame):
 
     def updateState(self):
         for r in range(10):
-            v = cpu.reg[r]
+            v = self.cpu.reg[r]
             if self.old[r] != v:
                 if r == 0:
                     self.showStack()
@@ -1243,7 +4070,7 @@ class CPUWidget(QFrame):
                 item.setTextAlignment(Qt.AlignmentFlag.AlignCenter)
                 if v == 0:
                     item.setForeground(QColor(0, 0, 0, 100))
-                v = str(v).zfill(3)
+                v = str(v).zfill(Digits)
                 if w.item(i, 0) == None or v != w.item(i, 0).text():
                     item.setText(v)
                     w.blockSignals(True)
@@ -1254,25 +4081,37 @@ class CPUWidget(QFrame):
 
     def updateCmpResult(self):
         item = QTableWidgetItem()
-        text = ["?", "<", ">", "?", "="][cpu.reg[cpu.Reg.Flags]]
+        text = ["?", "<", ">", "?", "="][self.cpu.reg[self.cpu.Reg.Flags]]
         item.setText(text)
         item.setTextAlignment(Qt.AlignmentFlag.AlignCenter)
         self.cmpR.setItem(0, 0, item)
 
 
 class AnimationWidget(QWidget):
+    # wire paths (in window coordinates) along which micro operations move
+    microOpPaths = {
+        VirtualCPU.MicroOp.ReadImm: [(682, 155), (720, 155), (720, 75), (770, 75)],
+        VirtualCPU.MicroOp.ReadReg: [(964, 155), (900, 155), (900, 75), (850, 75)],
+        VirtualCPU.MicroOp.ReadMem: [(787, 190), (682, 190), (682, 155), (720, 155), (720, 75), (770, 75)],
+        VirtualCPU.MicroOp.ALU: [(810, 75), (810, 116), (810, 156)],
+        VirtualCPU.MicroOp.Compare: [(810, 116), (860, 117), (870, 117), (870, 189), (884, 189)],
+        VirtualCPU.MicroOp.WriteReg: [(787, 156), (900, 155), (964, 155)],
+        VirtualCPU.MicroOp.WriteMem: [(787, 156), (720, 155), (682, 155)],
+    }
+
     def __init__(self, parent):
         QWidget.__init__(self, parent)
         self.setAttribute(Qt.WidgetAttribute.WA_TransparentForMouseEvents, True)
-        self.xp = 100
-        self.yp = 100
-        self.xs = 8
-        self.ys = 0
         self.clock = 0
+        self.timer = 0
+        self.uops = []
+        self.uopFrame = 0
+        self.uopFrames = 1
+        self.uopRect = QRect()
+        self.errorText = ""
 
     def paintEvent(self, event):
         p = QPainter(self)
-#        p.fillRect(QRect(self.xp, self.yp, 60, 30), QColor(255, 0, 0))
         p.setRenderHints(QPainter.RenderHint.Antialiasing, True)
         p.translate(0.5, 0.5)
         p.setPen(QPen(QColor(0, 0, 0), 1.25))
@@ -1289,32 +4128,84 @@ class AnimationWidget(QWidget):
         p.drawLine(QLine(810, 172, 810, 174))
         p.drawPolyline(QPolygon([QPoint(860, 117), QPoint(870, 117), QPoint(870, 152)]))
         p.drawPolyline(QPolygon([QPoint(870, 158), QPoint(870, 189), QPoint(884, 189)]))
+        if self.uops and event.rect().intersects(self.uopRect):
+            self.paintMicroOp(p)
         if self.clock > 0:
             rect = QRect(400, 300, 400, 160)
             p.setPen(QPen(QColor(100, 0, 0), 2.0))
             p.setBrush(QColor(240, 220, 220))
             p.drawRect(rect)
-            p.drawText(rect, Qt.AlignmentFlag.AlignCenter, "ERROR! Processor Halted")
+            text = "ERROR! Processor Halted"
+            if self.errorText:
+                text += "\n\n" + self.errorText
+            p.drawText(rect, Qt.AlignmentFlag.AlignCenter, text)
+
+    def paintMicroOp(self, p):
+        kind, label = self.uops[self.uopFrame // self.uopFrames]
+        p.setPen(QPen(QColor(0, 0, 160), 1.25))
+        p.setBrush(QColor(220, 230, 250))
+        p.drawRoundedRect(self.uopRect.adjusted(1, 1, -2, -2), 6, 6)
+        p.drawText(self.uopRect, Qt.AlignmentFlag.AlignCenter, label)
+
+    def microOpRect(self):
+        kind, label = self.uops[self.uopFrame // self.uopFrames]
+        path = self.microOpPaths[kind]
+        t = (self.uopFrame % self.uopFrames + 1) / self.uopFrames
+        length = 0
+        for i in range(len(path) - 1):
+            length += abs(path[i + 1][0] - path[i][0]) + abs(path[i + 1][1] - path[i][1])
+        pos = t * length
+        for i in range(len(path) - 1):
+            (x0, y0), (x1, y1) = path[i], path[i + 1]
+            seg = abs(x1 - x0) + abs(y1 - y0)
+            if pos <= seg or i == len(path) - 2:
+                f = pos / seg if seg else 1
+                x = int(x0 + (x1 - x0) * f)
+                y = int(y0 + (y1 - y0) * f)
+                break
+            pos -= seg
+        return QRect(x - 26, y - 12, 52, 24)
+
+    def showMicroOps(self, uops, frames):
+        self.update(self.uopRect)
+        self.uops = uops
+        self.uopFrame = 0
+        self.uopRect = QRect()
+        if not uops:
+            return
+        self.uopFrames = max(1, frames // len(uops))
+        self.uopRect = self.microOpRect()
+        self.update(self.uopRect)
+        self.startAnimation()
 
-    def showError(self):
+    def showError(self, text = ""):
+        self.errorText = text
         self.clock = 90
-        self.timer = self.startTimer(33)
+        self.startAnimation()
         self.update()
 
+    def startAnimation(self):
+        if not self.timer:
+            self.timer = self.startTimer(33)
+
     def timerEvent(self, event):
-        self.clock -= 1
-        if self.clock == 0:
+        if self.clock > 0:
+            self.clock -= 1
+            if self.clock == 0:
+                self.update()
+        if self.uops:
+            # only repaint the area covered by the moving micro operation
+            self.update(self.uopRect)
+            self.uopFrame += 1
+            if self.uopFrame < len(self.uops) * self.uopFrames:
+                self.uopRect = self.microOpRect()
+                self.update(self.uopRect)
+            else:
+                self.uops = []
+                self.uopRect = QRect()
+        if self.clock == 0 and not self.uops:
             self.killTimer(self.timer)
-            self.update()
-        '''
-        self.xp += self.xs
-        self.yp += self.ys
-        if self.xp > self.rect().width() - 65 or self.xp < 5:
-            self.xs = -self.xs
-        if self.yp > self.rect().height() - 35 or self.yp < 5:
-            self.ys = -self.ys
-        self.update(QRect(self.xp - 10, self.yp - 10, 80, 50))
-        '''
+            self.timer = 0
 
 
 class MenuButton(QToolButton):
@@ -1346,6 +4237,7 @@ class MainWindow(QMainWindow):
         font = self.font()
         font.setPixelSize(20)
         self.setFont(font)
+        self.setFocusPolicy(Qt.FocusPolicy.StrongFocus)
 
         w = MemoryTabBar(self)
         self.memoryTabBar = w
@@ -1356,8 +4248,10 @@ class MainWindow(QMainWindow):
         w.setGeometry(20, 52, 660 + 4, 432 + 4)
         w.updateCells()
 
-        self.memoryTabBar.currentChanged.connect(self.memoryWidget.setPage)
+        self.bank = 0       # the tabs show pages 10 * bank .. 10 * bank + 9
+        self.memoryTabBar.currentChanged.connect(self.pageSelected)
 #        self.memoryWidget.cellClicked.connect(self.memoryCellClicked)
+        self.memoryWidget.cellClicked.connect(self.memoryCellStopClicked)
         self.memoryWidget.cellChanged.connect(self.memoryCellChanged)
         self.memoryWidget.itemSelectionChanged.connect(self.memoryCellsSelected)
 
@@ -1375,11 +4269,13 @@ class MainWindow(QMainWindow):
 
         w = CPUTabBar(self)
         self.cpuTabBar = w
-        w.setGeometry(700, 16, 80, 36)
+        w.setGeometry(700, 16, 340, 36)
+        self.cpuTabBar.currentChanged.connect(self.cpuSelected)
 
         w = CPUWidget(self)
         self.cpuWidget = w
         w.setGeometry(700, 52, 480, 164)
+        self.cpuWidget.registerEdited.connect(self.registerEdited)
 
         w = MenuButton(self)
         self.menuButton = w
@@ -1387,7 +4283,117 @@ class MainWindow(QMainWindow):
         menu = QMenu(w)
         w.setMenu(menu)
         menu.addAction("Reset").triggered.connect(self.resetClicked)
+        action = menu.addAction("Extended Addressing")
+        action.setCheckable(True)
+        action.toggled.connect(self.addressingToggled)
+        self.addressingAction = action
+        action = menu.addAction("Auto Exec")
+        action.setCheckable(True)
+        action.toggled.connect(self.autoExecToggled)
+        speedMenu = menu.addMenu("Speed")
+        group = QActionGroup(speedMenu)
+        for hz in [10, 100, 1000, 10000, 100000, 0]:
+            action = speedMenu.addAction(formatFrequency(hz) if hz else "Maximum")
+            action.setCheckable(True)
+            action.setChecked(hz == 10)
+            action.setData(hz)
+            group.addAction(action)
+        group.triggered.connect(self.speedTriggered)
+        processorsMenu = menu.addMenu("Processors")
+        group = QActionGroup(processorsMenu)
+        for n in [1, 2, 4]:
+            action = processorsMenu.addAction(str(n) + (" CPU" if n == 1 else " CPUs"))
+            action.setCheckable(True)
+            action.setChecked(n == 1)
+            action.setData(n)
+            group.addAction(action)
+        group.triggered.connect(self.processorsTriggered)
+        quantumMenu = menu.addMenu("Quantum")
+        group = QActionGroup(quantumMenu)
+        for n in [1, 10, 100]:
+            action = quantumMenu.addAction(str(n) + (" Instruction" if n == 1 else " Instructions"))
+            action.setCheckable(True)
+            action.setChecked(n == 1)
+            action.setData(n)
+            group.addAction(action)
+        group.triggered.connect(self.quantumTriggered)
+        action = menu.addAction("Fast Loops")
+        action.setCheckable(True)
+        action.toggled.connect(self.fastLoopsToggled)
+        self.fastLoopsAction = action
+        paletteMenu = menu.addMenu("Palette")
+        group = QActionGroup(paletteMenu)
+        for index in range(len(Palettes)):
+            action = paletteMenu.addAction(Palettes[index][0])
+            action.setCheckable(True)
+            action.setChecked(index == 0)
+            action.setData(index)
+            group.addAction(action)
+        group.triggered.connect(self.paletteTriggered)
+        action = menu.addAction("Render on Flip")
+        action.setCheckable(True)
+        action.toggled.connect(self.renderOnFlipToggled)
+        action = menu.addAction("Parallel Processes")
+        action.setCheckable(True)
+        action.setEnabled(ParallelRunner.available())
+        action.toggled.connect(self.parallelToggled)
+        self.parallelAction = action
+        action = menu.addAction("Shared Memory")
+        action.setCheckable(True)
+        action.toggled.connect(self.sharedToggled)
+        self.sharedAction = action
+        debugMenu = menu.addMenu("Debug")
+        debugMenu.addAction("Run").triggered.connect(self.runClicked)
+        debugMenu.addAction("Step Over").triggered.connect(self.stepOverClicked)
+        debugMenu.addAction("Run Until Return").triggered.connect(self.runUntilReturnClicked)
+        debugMenu.addSeparator()
+        debugMenu.addAction("Toggle Breakpoint  (Ctrl+Click)").triggered.connect(self.toggleBreakClicked)
+        debugMenu.addAction("Toggle Watchpoint  (Shift+Ctrl+Click)").triggered.connect(self.toggleWatchClicked)
+        debugMenu.addAction("Watch Page").triggered.connect(self.watchPageClicked)
+        debugMenu.addAction("Break on Register Value").triggered.connect(self.conditionClicked)
+        debugMenu.addAction("Clear Breakpoints").triggered.connect(self.clearStopsClicked)
+        protectMenu = menu.addMenu("Page Protection")
+        self.protectActions = []
+        for label, flag in [("Read-Only", VirtualCPU.PageFlag.ReadOnly),
+                            ("No-Execute", VirtualCPU.PageFlag.NoExecute),
+                            ("Stack-Only", VirtualCPU.PageFlag.StackOnly)]:
+            action = protectMenu.addAction(label)
+            action.setCheckable(True)
+            action.setData(flag)
+            action.triggered.connect(self.protectTriggered)
+            self.protectActions.append(action)
+        memoryMenu = menu.addMenu("Memory")
+        group = QActionGroup(memoryMenu)
+        self.digitsActions = []
+        for digits in [3, 4]:
+            action = memoryMenu.addAction(str(10 ** digits) + " Cells  (" + str(digits) + " Digits)")
+            action.setCheckable(True)
+            action.setChecked(digits == 3)
+            action.setData(digits)
+            group.addAction(action)
+            self.digitsActions.append(action)
+        group.triggered.connect(self.digitsTriggered)
+        memoryMenu.addSeparator()
+        group = QActionGroup(memoryMenu)
+        self.bankActions = []
+        for bank in range(10):
+            action = memoryMenu.addAction("Bank " + str(1000 * bank).zfill(4) + "..")
+            action.setCheckable(True)
+            action.setChecked(bank == 0)
+            action.setEnabled(False)
+            action.setData(bank)
+            group.addAction(action)
+            self.bankActions.append(action)
+        group.triggered.connect(lambda action: self.bankSelected(action.data()))
         menu.addSeparator()
+        action = menu.addAction("Undo")
+        action.setShortcut("Ctrl+Z")
+        action.triggered.connect(self.undoClicked)
+        self.addAction(action)
+        action = menu.addAction("Redo")
+        action.setShortcut("Ctrl+Shift+Z")
+        action.triggered.connect(self.redoClicked)
+        self.addAction(action)
         menu.addAction("Clear Video").triggered.connect(self.clearVideoClicked)
         menu.addAction("Clear Memory Cells").triggered.connect(self.clearMemoryClicked)
         menu.addSeparator()
@@ -1399,6 +4405,11 @@ class MainWindow(QMainWindow):
         menu.addAction("Demo 3: Count Down").triggered.connect(self.demo3Clicked)
         menu.addAction("Demo 4: Multiply").triggered.connect(self.demo4Clicked)
         menu.addAction("Demo 5: Multiply 2").triggered.connect(self.demo5Clicked)
+        menu.addAction("Demo 6: Copy Text").triggered.connect(self.demo6Clicked)
+        menu.addAction("Demo 7: Multiply 3").triggered.connect(self.demo7Clicked)
+        menu.addAction("Demo 8: Type Keys").triggered.connect(self.demo8Clicked)
+        menu.addAction("Demo 9: Console").triggered.connect(self.demo9Clicked)
+        menu.addAction("Demo 10: Sprite").triggered.connect(self.demo10Clicked)
         menu.addSeparator()
         menu.addAction("Font Size +").triggered.connect(self.fontSizePlus)
         menu.addAction("Font Size −").triggered.connect(self.fontSizeMinus)
@@ -1420,11 +4431,27 @@ class MainWindow(QMainWindow):
 
         self.clock = 0
         self.startTimer(33)
-        self.execDelay = 3
+        self.execClock = ExecClock([cpu], 10)
+        self.runClock = None    # runs as fast as possible until the CPUs stop
+        self.runner = None
         self.autoExec = False
+        self.frame = None       # video output kept until the next flip
+        self.frameFlips = -1    # gpu.flips when it was painted
+        self.journal = Journal(AutosavePath)
+        self.history = EditHistory()
+        self.savedClock = 0     # execClock.clock() at the last compaction
 
 #        self.demo1Clicked()
         self.resetClicked()
+        records, error = self.journal.replay()
+        if records:
+            self.loadProject(records)   # the state when ALEK was left
+            self.history.clear()        # which is not an edit to undo
+        if error != None:
+            QMessageBox.warning(self, "Autosave", "The autosave file is damaged (" + error +
+                                "), so later edits are missing. It was kept as " +
+                                self.journal.path + ".bad")
+        self.journal.compact(self.projectLines(), time.perf_counter())
 
 #        self.memoryWidget.updateCells()
 #        self.cpuWidget.updateState()
@@ -1433,50 +4460,99 @@ class MainWindow(QMainWindow):
     def openProject(self):
         filename = QFileDialog.getOpenFileName(self, "Open Project", "", "ALEK Files (*.alek)")
         if filename and filename[0]:
-            global Mem
-            fh = open(filename[0], "r")
+            fh = open(filename[0], "r", errors = "replace")
             line = fh.readline()
             if line != "ALEKv001\n":
                 return
-            Mem = [0] * 1000
-            cpu.reset()
-            for line in fh:
-                mapline = eval(line)
-                for key in mapline:
-                    if key == 'cpu_state':
-                        cpu.state = mapline[key]
-                    elif key == 'cpu_reg':
-                        reg = mapline[key]
-                        for i in range(len(cpu.reg)):
-                            if i < len(reg):
-                                cpu.reg[i] = reg[i]
-                    elif key == 'mem':
-                        data = mapline[key]
-                        addr = data[0]
-                        cells = data[1]
-                        for i in range(len(cells)):
-                            Mem[Map[addr + i]] = cells[i]
+            records, error = projectRecords(fh)
             fh.close()
-            self.updateAll()
-            self.execButton.setEnabled(cpu.state > cpu.State.Idle)
+            if error != None:
+                QMessageBox.warning(self, "Open Project", "The project file is damaged (" + error + ").")
+                return
+            self.loadProject(records)
+            self.journal.compact(self.projectLines(), time.perf_counter())
+
+    def loadProject(self, records):
+        # records of a project file or of the journal (see projectRecords),
+        # loading is a single edit, unless the memory size changes
+        self.stopParallel()
+        digits = Digits
+        for mapline in records:
+            digits = mapline.get('mem_digits', digits)
+        if digits != Digits:
+            self.setDigits(digits)
+        self.history.begin(Map)
+        self.history.save(0, Cells)
+        for a in range(len(Mem)):
+            Mem[a] = 0
+        for c in self.execClock.cpus:
+            c.reset()
+            c.state = c.State.Running
+        self.addressingAction.setChecked(False)
+        for mapline in records:
+            for key in mapline:
+                if key == 'cpu_state':
+                    cpu.state = mapline[key]
+                elif key == 'cpu_addressing':
+                    self.addressingAction.setChecked(mapline[key] == cpu.Addressing.Extended)
+                elif key == 'cpu_reg':
+                    reg = mapline[key]
+                    for i in range(len(cpu.reg)):
+                        if i < len(reg):
+                            cpu.reg[i] = reg[i]
+                    cpu.clock = cpu.reg[cpu.Reg.Clk]
+                elif key == 'mem':
+                    data = mapline[key]
+                    addr = data[0]
+                    cells = data[1]
+                    for i in range(len(cells)):
+                        a = (addr + i) % Cells
+                        touchPage(a)
+                        Mem[Map[a]] = cells[i] % Cells
+        self.history.end()
+        cpu.bus.reset()
+        self.memoryWidget.analyzer.update(cached = True)
+        self.updateAll()
+        self.execButton.setEnabled(self.execClock.state() > cpu.State.Idle)
 
     def saveProject(self):
         filename = QFileDialog.getSaveFileName(self, "Save Project", "", "ALEK Files (*.alek)")
         if filename and filename[0]:
             fh = open(filename[0], "w")
             fh.write("ALEKv001\n")
-            fh.write(str({'cpu_reg': cpu.reg}) + "\n")
-            fh.write(str({'cpu_state': cpu.state}) + "\n")
-            for addr in range(0, 1000, 10):
-                for i in range(10):
-                    if Mem[Map[addr + i]] != 0:
-                        cells = []
-                        for j in range(10):
-                            cells.append(Mem[Map[addr + j]])
-                        fh.write(str({'mem': [addr, cells]}) + "\n")
-                        break
+            fh.writelines(self.projectLines())
             fh.close()
 
+    def projectLines(self):
+        lines = [{'mem_digits': Digits}, {'cpu_reg': list(cpu.reg)},
+                 {'cpu_state': cpu.state}, {'cpu_addressing': cpu.addressing}]
+        for addr in range(0, Cells, 10):
+            for i in range(10):
+                if Mem[Map[addr + i]] != 0:
+                    cells = []
+                    for j in range(10):
+                        cells.append(Mem[Map[addr + j]])
+                    lines.append({'mem': [addr, cells]})
+                    break
+        return [str(line) + "\n" for line in lines]
+
+    def autosave(self):
+        # about once a second: appended edits are synced, and the journal
+        # is compacted when due (if anything changed since the last time)
+        now = time.perf_counter()
+        clock = self.execClock.clock()
+        if self.journal.due(now) and (self.journal.records or clock != self.savedClock):
+            self.savedClock = clock
+            self.journal.compact(self.projectLines(), now)
+        else:
+            self.journal.sync(now)
+
+    def closeEvent(self, event):
+        self.stopParallel()
+        self.journal.compact(self.projectLines(), time.perf_counter())
+        self.journal.close()
+        QMainWindow.closeEvent(self, event)
+
     def fontSizePlus(self):
         font = self.font()
         if font.pixelSize() < 24:
@@ -1492,7 +4568,7 @@ class MainWindow(QMainWindow):
             self.update()
 
     def codeClicked(self, c):
-        page = self.memoryTabBar.currentIndex()
+        page = self.memoryPage()
         ranges = self.memoryWidget.selectedRanges()
         a = -1
         if len(ranges) == 1:
@@ -1503,12 +4579,18 @@ class MainWindow(QMainWindow):
                 a = 100 * page + 10 * my + mx
         if a < 0:
             return
-        Mem[Map[a]] = c
+        self.history.begin(self.memoryWidget.map)
+        self.history.save(a, 1)
+        touchPage(a)
+        Mem[self.memoryWidget.map[a]] = c
+        self.history.end()
+        self.journal.append({'mem': [a, [c]]})
+        self.memoryEdited()
         self.memoryWidget.updateCellAddress(a)
         self.inspectorWidget.setData([c], 1)
 
     def inspectorClicked(self, y, x):
-        page = self.memoryTabBar.currentIndex()
+        page = self.memoryPage()
         ranges = self.memoryWidget.selectedRanges()
         a = -1
         if len(ranges) == 1:
@@ -1517,8 +4599,9 @@ class MainWindow(QMainWindow):
                 my = sr.topRow()
                 mx = sr.leftColumn()
                 a = 100 * page + 10 * my + mx
-        if a >= 0:
-            c = Mem[Map[a]]
+        if a < 0:
+            return
+        c = Mem[self.memoryWidget.map[a]]
         if y == 0:
             if x == 0:
                 c = 0
@@ -1532,12 +4615,18 @@ class MainWindow(QMainWindow):
             c = 10 * (c // 10) + x
         else:
             print("?")
-        Mem[Map[a]] = c
+        self.history.begin(self.memoryWidget.map)
+        self.history.save(a, 1)
+        touchPage(a)
+        Mem[self.memoryWidget.map[a]] = c
+        self.history.end()
+        self.journal.append({'mem': [a, [c]]})
+        self.memoryEdited()
         self.memoryWidget.updateCellAddress(a)
         self.inspectorWidget.setData([c], 1)
 
     def memoryCellsSelected(self):
-        page = self.memoryTabBar.currentIndex()
+        page = self.memoryPage()
         ranges = self.memoryWidget.selectedRanges()
         if len(ranges) == 1:
             sr = ranges[0]
@@ -1546,49 +4635,90 @@ class MainWindow(QMainWindow):
                 x = sr.leftColumn()
                 self.memoryCellClicked(y, x)
 
+    def registerEdited(self):
+        if self.cpuWidget.cpu == cpu:   # projects keep the registers of CPU 0
+            self.journal.append({'cpu_reg': list(cpu.reg)})
+
     def memoryCellChanged(self, y, x):
         item = self.memoryWidget.takeItem(y, x)
         if item != None:
             v = 0
             text = item.text()
             if text.isnumeric():
-                v = int(text) % 1000
+                v = int(text) % Cells
             elif len(text) == 1 and ord(text[0]) < 128 and CharToNum[ord(text[0])] > 4:
                 v = CharToNum[ord(text[0])]
-            page = self.memoryTabBar.currentIndex()
+            page = self.memoryPage()
             a = 100 * page + 10 * y + x
-            Mem[Map[a]] = v
+            if Mem[self.memoryWidget.map[a]] != v:
+                self.memoryEdited()
+                self.history.begin(self.memoryWidget.map)
+                self.history.save(a, 1)
+                touchPage(a)
+                Mem[self.memoryWidget.map[a]] = v
+                self.history.end()
+                self.journal.append({'mem': [a, [v]]})
+            cpu.bus.written(a)
             self.memoryWidget.blockSignals(True)
             self.memoryWidget.updateCellAddress(a)
             self.memoryWidget.blockSignals(False)
             self.memoryCellsSelected()
-            if page == 7 or page == 8:
+            if page - gpu.txtmem // 100 in [0, 1]:
                 self.update()
 
     def memoryCellClicked(self, y, x):
-        page = self.memoryTabBar.currentIndex()
+        page = self.memoryPage()
         a = 100 * page + 10 * y + x
 #        if page < 5:
 #            cpu.reg[cpu.Reg.IP] = a
 #            self.cpuWidget.updateState()
-        self.inspectorWidget.setData([Mem[Map[a]]], 1)
+        self.inspectorWidget.setData([Mem[self.memoryWidget.map[a]]], 1)
 
     def clearMemoryClicked(self):
-        page = self.memoryTabBar.currentIndex()
+        page = self.memoryPage()
         ranges = self.memoryWidget.selectedRanges()
+        self.history.begin(self.memoryWidget.map)
         for sr in ranges:
             for y in range(sr.topRow(), sr.bottomRow() + 1):
+                a = 100 * page + 10 * y + sr.leftColumn()
+                self.history.save(a, sr.columnCount())
                 for x in range(sr.leftColumn(), sr.rightColumn() + 1):
                     a = 100 * page + 10 * y + x
-                    Mem[Map[a]] = 0
+                    Mem[self.memoryWidget.map[a]] = 0
+                a = 100 * page + 10 * y + sr.leftColumn()
+                self.journal.append({'mem': [a, [0] * sr.columnCount()]})
+        self.history.end()
+        self.memoryEdited()
+        self.memoryWidget.updateCells()
+        self.memoryCellsSelected()
+        self.update()
+
+    def undoClicked(self):
+        self.historyRestored(self.history.undo())
+
+    def redoClicked(self):
+        self.historyRestored(self.history.redo())
+
+    def historyRestored(self, runs):
+        if not runs:
+            return
+        for a, cells in runs:
+            self.journal.append({'mem': [a, cells.tolist()]})
+        self.memoryEdited()
         self.memoryWidget.updateCells()
         self.memoryCellsSelected()
         self.update()
 
     def clearVideoClicked(self):
+        self.history.begin(Map)
+        self.history.save(gpu.txtmem, 2 * gpu.vid_w * gpu.vid_h)
         gpu.clearVideo()
-        page = self.memoryTabBar.currentIndex()
-        if page == 7 or page == 8:
+        self.history.end()
+        console.clear()
+        self.journal.append({'mem': [gpu.txtmem, [0] * (2 * gpu.vid_w * gpu.vid_h)]})
+        self.memoryEdited()
+        page = self.memoryPage()
+        if page - gpu.txtmem // 100 in [0, 1]:
             self.memoryWidget.updateCells()
         self.update()
 
@@ -1624,62 +4754,420 @@ class MainWindow(QMainWindow):
                           3, 17,
                           ])
 
-    def demoClicked(self, code):
+    def demo6Clicked(self):
+        self.demoClicked([510, 20, 520, 700, 865, 740, 12, 599, 911, 922,
+                          770, 4, 999, 0, 0, 0, 0, 0, 0, 0,
+                          48, 75, 82, 82, 85, 7, 5, 63, 85, 88, 82, 74, 8, 0],
+                          VirtualCPU.Addressing.Extended)
+
+    def demo7Clicked(self):
+        self.demoClicked([510, 3, 530, 700, 987, 4, 570, 12, 913, 510,
+                          17, 987, 4, 570, 28, 913, 510, 3, 520, 17,
+                          987, 1, 987, 4, 999])
+
+    def demo8Clicked(self):
+        self.demoClicked([520, 700, 898, 931, 561, 912, 941, 770, 2])
+
+    def demo9Clicked(self):
+        self.demoClicked([510, 1, 591, 698, 520, 41, 942, 940, 2, 912,
+                          620, 67, 710, 6, 999])
+
+    def demo10Clicked(self):
+        self.demoClicked([510, 1, 591, 660, 510, 50, 591, 663, 510, 18,
+                          591, 662, 919, 661, 690, 661, 36, 710, 12, 859,
+                          661, 770, 12, 999, 0, 0, 0, 0, 0, 0,
+                          0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+                          0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+                          0, 990, 990, 0, 990, 111, 111, 990,
+                          990, 990, 990, 990, 0, 900, 900, 0])
+
+    def demoClicked(self, code, addressing = VirtualCPU.Addressing.Classic):
+        self.history.begin(Map)
+        self.history.save(0, max(100, len(code)))
         for a in range(100):
             Mem[Map[a]] = 0
         for i in range(len(code)):
             Mem[Map[i]] = code[i]
+        self.history.end()
+        self.journal.append({'mem': [0, [Mem[Map[a]] for a in range(100)]]})
+        self.addressingAction.setChecked(addressing == VirtualCPU.Addressing.Extended)
+        self.memoryWidget.analyzer.update(cached = True)
+        self.resetClicked()
+
+    def addressingToggled(self, checked):
+        self.stopParallel()
+        for c in cpus:
+            if checked:
+                c.setAddressing(c.Addressing.Extended)
+            else:
+                c.setAddressing(c.Addressing.Classic)
+        self.journal.append({'cpu_addressing': cpu.addressing})
+        self.startParallel()
+
+    def processorsTriggered(self, action):
+        self.stopParallel()
+        if sharedState != None:
+            unshareState(self.execClock.cpus)
+        n = action.data()
+        while len(cpus) < n:
+            c = VirtualCPU(len(cpus))
+            c.mapPages([Cells // 100 - 1])  # each CPU has its own stack
+            c.setAddressing(cpu.addressing)
+            c.loops = cpu.loops and LoopAccelerator()
+            c.bus.attach(console)       # OUT of every CPU goes to the console
+            cpus.append(c)
+        self.execClock.cpus = cpus[:n]
+        self.memoryWidget.analyzer.setEntries([100 * c.number for c in self.execClock.cpus])
+        if self.sharedAction.isChecked():
+            shareState(self.execClock.cpus)
+            self.setWindowTitle("ALEK  (" + sharedState.name + ")")
+        self.cpuTabBar.setProcessors(n)
+        self.cpuSelected(0)
         self.resetClicked()
 
+    def quantumTriggered(self, action):
+        self.execClock.quantum = action.data()
+
+    def cpuSelected(self, index):
+        c = self.execClock.cpus[index]
+        self.cpuWidget.setCPU(c)
+        self.memoryWidget.map = c.map
+        self.updateAll()
+
+    def fastLoopsToggled(self, checked):
+        self.stopParallel()
+        for c in cpus:
+            c.loops = LoopAccelerator() if checked else None
+        self.startParallel()
+
+    def paletteTriggered(self, action):
+        gpu.setPalette(action.data())
+        self.frameFlips = -1
+        self.memoryCellsSelected()  # the color inspector
+        self.update()
+
+    def renderOnFlipToggled(self, checked):
+        # the video output is only painted again after SYS 2 (FLIP)
+        self.frame = QPixmap(480, 480) if checked else None
+        self.frameFlips = -1
+        self.update()
+
+    def parallelToggled(self, checked):
+        if checked:
+            self.startParallel()
+        else:
+            self.stopParallel()
+
+    def sharedToggled(self, checked):
+        # other processes can attach with SharedState(name)
+        self.stopParallel()
+        if checked:
+            shareState(self.execClock.cpus)
+            self.setWindowTitle("ALEK  (" + sharedState.name + ")")
+        else:
+            unshareState(self.execClock.cpus)
+            self.setWindowTitle("ALEK")
+        self.startParallel()
+
+    def startParallel(self):
+        if self.autoExec and self.parallelAction.isChecked() and self.runner == None:
+            if self.execButton.isEnabled():
+                self.runner = ParallelRunner(self.execClock.cpus, self.execClock.hz)
+                self.runner.start()
+
+    def stopParallel(self):
+        if self.runner != None:
+            self.runner.stop()
+            self.runner = None
+            self.execClock.start(time.perf_counter())
+
     def updateAll(self):
+        c = self.cpuWidget.cpu
         self.memoryWidget.updateCells()
         self.cpuWidget.updateState()
-        self.memoryTabBar.setCurrentIndex(cpu.reg[cpu.Reg.IP] // 100)
-        self.memoryWidget.highlightAddress(cpu.reg[cpu.Reg.IP])
+        self.showPage(c.reg[c.Reg.IP] // 100)
+        self.memoryWidget.highlightAddress(c.reg[c.Reg.IP])
         self.memoryCellsSelected()
         self.update()
 
-    def RunClicked(self):
-        cpu.state = cpu.State.Running
-        while cpu.state == cpu.State.Running:
-            cpu.fetch()
-            cpu.execute()
-        self.updateAll()
-        self.execButton.setEnabled(False)
+    def protectTriggered(self):
+        flags = 0
+        for action in self.protectActions:
+            if action.isChecked():
+                flags |= action.data()
+        protectPage(self.memoryPage(), flags)
+        self.memoryEdited()
+
+    def updateProtectActions(self, page):
+        for action in self.protectActions:
+            action.setChecked(PageFlags[page] & action.data() != 0)
+
+    def memoryPage(self):
+        return 10 * self.bank + self.memoryTabBar.currentIndex()
+
+    def pageSelected(self, index):
+        page = 10 * self.bank + index
+        self.memoryWidget.setPage(page)
+        self.updateProtectActions(page)
+
+    def bankSelected(self, bank):
+        # only the selected page is shown, unallocated pages show the zero page
+        self.bank = bank
+        self.bankActions[bank].setChecked(True)
+        self.memoryTabBar.setBank(bank, Cells // 1000)
+        self.pageSelected(self.memoryTabBar.currentIndex())
+
+    def showPage(self, page):
+        if page // 10 != self.bank:
+            self.bankSelected(page // 10)
+        self.memoryTabBar.setCurrentIndex(page % 10)
+
+    def digitsTriggered(self, action):
+        self.setDigits(action.data())
+
+    def setDigits(self, digits):
+        # a new memory of the other size, the machine is reset
+        self.stopParallel()
+        if sharedState != None:
+            unshareState(self.execClock.cpus)
+        configureMemory(digits)
+        for c in cpus:
+            c.map = Map
+            if c.number > 0:
+                c.mapPages([Cells // 100 - 1])
+        for action in self.digitsActions:
+            action.setChecked(action.data() == digits)
+        for action in self.bankActions:
+            action.setEnabled(Cells > 1000)
+        if self.sharedAction.isChecked():
+            shareState(self.execClock.cpus)
+            self.setWindowTitle("ALEK  (" + sharedState.name + ")")
+        self.bankSelected(0)
+        self.cpuSelected(self.cpuTabBar.currentIndex())
+        self.history.clear()
+        self.journal.append({'mem_digits': digits})
+        self.resetClicked()
+
+    def memoryEdited(self):
+        # decoded instructions of read-only pages are only kept while no
+        # instruction can change them, but the UI can
+        for c in cpus:
+            c.decoded.clear()
+        self.frameFlips = -1    # show edits of the video pages
+
+    def selectedAddresses(self):
+        page = self.memoryPage()
+        addresses = []
+        for sr in self.memoryWidget.selectedRanges():
+            for y in range(sr.topRow(), sr.bottomRow() + 1):
+                for x in range(sr.leftColumn(), sr.rightColumn() + 1):
+                    addresses.append(100 * page + 10 * y + x)
+        return addresses
+
+    def toggleStops(self, addresses, flag):
+        for a in addresses:
+            Stops[a] ^= flag
+        self.memoryWidget.updateCells()
+
+    def memoryCellStopClicked(self, y, x):
+        modifiers = QApplication.keyboardModifiers()
+        if modifiers & Qt.KeyboardModifier.ControlModifier:
+            a = 100 * self.memoryPage() + 10 * y + x
+            if modifiers & Qt.KeyboardModifier.ShiftModifier:
+                self.toggleStops([a], VirtualCPU.Stop.Watch)
+            else:
+                self.toggleStops([a], VirtualCPU.Stop.Break)
+
+    def toggleBreakClicked(self):
+        self.toggleStops(self.selectedAddresses(), VirtualCPU.Stop.Break)
+
+    def toggleWatchClicked(self):
+        self.toggleStops(self.selectedAddresses(), VirtualCPU.Stop.Watch)
+
+    def watchPageClicked(self):
+        # watches all cells of the page, unless all are watched already;
+        # then all watchpoints of the page are removed
+        page = self.memoryPage()
+        addresses = range(100 * page, 100 * page + 100)
+        watched = all([Stops[a] & VirtualCPU.Stop.Watch for a in addresses])
+        for a in addresses:
+            if watched:
+                Stops[a] &= ~VirtualCPU.Stop.Watch
+            else:
+                Stops[a] |= VirtualCPU.Stop.Watch
+        self.memoryWidget.updateCells()
+
+    def conditionClicked(self):
+        text, ok = QInputDialog.getText(self, "Break on Register Value", "Register = value, e.g. R1 = 5")
+        names = ["SP", "R1", "R2", "R3", "R4", "R5", "R6", "R7", "R8", "IP"]
+        text = text.upper().replace(" ", "").split("=")
+        if not ok or len(text) != 2 or text[0] not in names or not text[1].isnumeric():
+            return
+        r = names.index(text[0])
+        v = int(text[1]) % Cells
+        for condition in Conditions:
+            if condition[0] == r:
+                condition[1][v] = 1
+                return
+        values = bytearray(Cells)
+        values[v] = 1
+        last = [-1] * 10
+        for c in self.execClock.cpus:
+            last[c.number] = c.reg[r]
+        Conditions.append([r, values, last])
+
+    def clearStopsClicked(self):
+        Stops[:] = bytearray(Cells)
+        Conditions.clear()
+        self.memoryWidget.updateCells()
+
+    def runClicked(self):
+        self.stopParallel()
+        analyzer = self.memoryWidget.analyzer
+        analyzer.update(cached = True)
+        for c in self.execClock.cpus:
+            c.predecode(analyzer)
+            if c.state == c.State.Break:
+                c.state = c.State.Running
+        if self.execClock.state() == cpu.State.Running:
+            self.runClock = ExecClock(self.execClock.cpus, 0)
+            self.execButton.setText("Run")
+
+    def stepOverClicked(self):
+        c = self.cpuWidget.cpu
+        if c.state in [c.State.Running, c.State.Break] and Mem[c.map[c.reg[c.Reg.IP]]] // 10 == 97:
+            c.runUntilReturn(c.stackDepth())     # CALL
+            self.runClicked()
+        else:
+            self.execClicked()
+
+    def runUntilReturnClicked(self):
+        c = self.cpuWidget.cpu
+        if c.state in [c.State.Running, c.State.Break]:
+            c.runUntilReturn(c.stackDepth() - 1)
+            self.runClicked()
 
     def resetClicked(self):
-        cpu.reset()
+        self.stopParallel()
+        self.runClock = None
         gpu.reset()
-        cpu.state = cpu.State.Running
+        io.reset()
+        timer.reset()
+        console.reset()
+        self.frameFlips = -1
+        for c in self.execClock.cpus:
+            c.reset()
+            c.state = c.State.Running
         self.updateAll()
+        self.execButton.setText("Exec")
         self.execButton.setEnabled(True)
+        self.execClock.start(time.perf_counter())
+        self.journal.append({'cpu_reg': list(cpu.reg), 'cpu_state': cpu.state})
+        self.startParallel()
+
+    def autoExecToggled(self, checked):
+        self.autoExec = checked
+        self.execClock.setFrequency(self.execClock.hz)
+        if checked:
+            self.startParallel()
+        else:
+            self.stopParallel()
+            self.cpuTabBar.showRate("")
+
+    def speedTriggered(self, action):
+        self.stopParallel()
+        self.execClock.setFrequency(action.data())
+        self.startParallel()
 
     def execClicked(self):
-        if cpu.state == cpu.State.Running:
-            cpu.fetch()
-            cpu.execute()
+        if self.runner != None or self.runClock != None:
+            return
+        for c in self.execClock.cpus:
+            if c.state == c.State.Break:
+                c.state = c.State.Running
+        c = self.execClock.step()
+        if c != None:
+            if len(self.execClock.cpus) > 1:
+                self.cpuTabBar.setCurrentIndex(c.number)
+            self.execDone(1, c)
+        else:
+            self.execDone(0)
+
+    def execDone(self, steps, c = None):
+        if steps > 0:
             self.updateAll()
-        if cpu.state == cpu.State.Error:
-            self.animationWidget.showError()
-        if cpu.state != cpu.State.Running:
+        if steps == 1 and c != None:
+            frames = 24
+            if self.autoExec and self.execClock.hz:
+                frames = min(frames, (30 * c.cycles) // self.execClock.hz)
+            self.animationWidget.showMicroOps(c.microOps(), frames)
+        state = self.execClock.state()
+        if state == cpu.State.Error:
+            text = ""
+            for c in self.execClock.cpus:
+                if c.state == c.State.Error and c.fault >= 0:
+                    text = "Protection fault at " + str(c.fault).zfill(Digits)
+            self.animationWidget.showError(text)
+        if state == cpu.State.Waiting:
+            self.setFocus()
+        if self.runClock == None:
+            self.execButton.setText({cpu.State.Waiting: "Wait", cpu.State.Break: "Break"}.get(state, "Exec"))
+        if state not in [cpu.State.Running, cpu.State.Break]:
             self.execButton.setEnabled(False)
+        else:
+            self.execButton.setEnabled(True)    # e.g. an interrupt ended a WAIT
 
     def showEvent(self, event):
         pass
 
     def timerEvent(self, event):
         self.clock += 1
-        if self.autoExec:
-            if (self.clock % self.execDelay) == 0:
-                if self.execButton.isEnabled():
-                    self.execClicked()
+        if self.runClock != None:
+            steps = self.runClock.run(time.perf_counter())
+            if self.execClock.state() != cpu.State.Running:
+                self.runClock = None
+                self.execClock.start(time.perf_counter())
+            if steps > 0 or self.runClock == None:
+                self.execDone(steps)
+        elif self.autoExec:
+            if self.runner != None:
+                clock = self.execClock.clock()
+                self.runner.poll()
+                self.execClock.measure(time.perf_counter())
+                if self.execClock.clock() != clock:
+                    self.execDone(2)    # more than one step, no animation
+                if self.execClock.state() in [cpu.State.Idle, cpu.State.Error, cpu.State.Break]:
+                    self.stopParallel()
+                    self.execDone(0)
+            elif self.execButton.isEnabled() and self.execClock.state() != cpu.State.Break or self.eventPending():
+                steps = self.execClock.run(time.perf_counter())
+                if steps > 0:
+                    self.execDone(steps)
+            if (self.clock % 10) == 0:
+                self.cpuTabBar.showRate(formatFrequency(self.execClock.rate))
+        if (self.clock % 30) == 0:
+            self.autosave()
         if self.clock == 180:
             self.update()
 
+    def eventPending(self):
+        # a waiting CPU is woken by timer and frame interrupts, even though
+        # the Exec button is disabled
+        return self.execClock.state() == cpu.State.Waiting and any(
+            [c.nextEvent < c.bus.NoEvent for c in self.execClock.cpus])
+
     def paintEvent(self, event):
         painter = QPainter(self)
         rect = QRect(700, 224, 480, 480)
-        gpu.paintVideo(painter, rect)
+        if self.frame != None:
+            if self.frameFlips != gpu.flips:
+                self.frameFlips = gpu.flips
+                framePainter = QPainter(self.frame)
+                gpu.paintVideo(framePainter, self.frame.rect())
+                framePainter.end()
+            painter.drawPixmap(rect.topLeft(), self.frame)
+        else:
+            gpu.paintVideo(painter, rect)
         if self.clock < 150:
             painter.setPen(QColor(240, 240, 240))
             copyright = "ALEK 0.1 Copyright 2023 Christoph Feck"
@@ -1690,9 +5178,35 @@ class MainWindow(QMainWindow):
 #        return QSize(1880, 1020)
         return QSize(1200, 720)
 
+    def wheelEvent(self, event):
+        # scroll the console back and forth over the video output
+        if not Mem[Map[VirtualConsole.Addr.Show]] or event.position().x() < 700:
+            return
+        a = Map[VirtualConsole.Addr.Scroll]
+        lines = 1 if event.angleDelta().y() > 0 else -1
+        Mem[a] = max(0, min(Mem[a] + lines, console.lines - gpu.vid_h))
+        self.update()
+
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_Escape:
             self.close()
+            return
+        c = {Qt.Key_Tab: 1, Qt.Key_Return: 2, Qt.Key_Enter: 2, Qt.Key_Backspace: 3}.get(event.key(), 0)
+        text = event.text()
+        if len(text) == 1 and ord(text[0]) < 128 and CharToNum[ord(text[0])] > 4:
+            c = CharToNum[ord(text[0])]
+        if c == 0 or not io.pushKey(c):
+            QMainWindow.keyPressEvent(self, event)
+            return
+        if self.execClock.state() == cpu.State.Waiting:
+            if self.runner != None:
+                self.runner.wake()
+            for c in self.execClock.cpus:
+                c.wake()
+            self.execButton.setText("Exec")
+            self.execButton.setEnabled(True)
+        if self.memoryPage() == io.Addr.Keys // 100:
+            self.memoryWidget.updateCells()
 
 
 ##############################################################################
@@ -1700,18 +5214,34 @@ class MainWindow(QMainWindow):
 #  main
 #
 
-app = QApplication(["alek.py"])
-
 initTables()
-
-gpu = VirtualGPU()
-cpu = VirtualCPU()
-
-window = MainWindow()
-if QApplication.desktop().screenGeometry().height() < 768:
-    window.showFullScreen()
-else:
-    window.show()
-
-app.exec()
+sharedState = None  # SharedState while Mem is in shared memory
+
+# importing alek (e.g. for tests with LocalClient) only defines the machine
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--server":
+        asyncio.run(SessionManager().serve(int(sys.argv[2]) if len(sys.argv) > 2 else DebugPort))
+        sys.exit()
+
+    app = QApplication(["alek.py"])
+
+    gpu = VirtualGPU()
+    io = VirtualIO()
+    timer = VirtualTimer()
+    console = VirtualConsole()
+    cpu = VirtualCPU()
+    cpu.bus.attach(gpu)
+    cpu.bus.attach(timer)
+    cpu.bus.attach(console)
+    cpus = [cpu]
+
+    window = MainWindow()
+    if QApplication.desktop().screenGeometry().height() < 768:
+        window.showFullScreen()
+    else:
+        window.show()
+
+    app.exec()
+    if sharedState != None:
+        sharedState.close()
 
@@ -0,0 +1,1087 @@
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import alek
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def execute(cells, ranges = [], count = 1000, **options):
+    # runs a program loaded into a debug session, returns its registers
+    # and the cells of ranges afterwards
+    client = alek.LocalClient()
+    await client.connect()
+    await client.request("load", cells = cells, **options)
+    await client.request("step", count = count)
+    registers = await client.request("registers")
+    read = await client.request("read", ranges = ranges)
+    await client.close()
+    return registers, read["cells"]
+
+
+def decoded(cells, addressing = alek.VirtualCPU.Addressing.Classic):
+    # a CPU that has fetched the instruction in cells
+    cpu = alek.VirtualCPU(0)
+    cpu.setAddressing(addressing)
+    cpu.op = (cells + [0] * 10)[:10]
+    cpu.size = cpu.decode()
+    return cpu
+
+
+class MicroOpTest(unittest.TestCase):
+    # data flow shown by the animation
+
+    def test_operands(self):
+        U = alek.VirtualCPU.MicroOp
+        # ADD R1, #2
+        self.assertEqual(decoded([110, 2]).microOps(),
+                         [(U.ReadReg, "R1"), (U.ReadImm, "002"), (U.ALU, "+"), (U.WriteReg, "R1")])
+        # MOV (R2), R1 reads the source first
+        self.assertEqual(decoded([561]).microOps(), [(U.ReadReg, "R1"), (U.WriteMem, "(R2)")])
+        # CMP R1, (50)
+        self.assertEqual(decoded([619, 50]).microOps(),
+                         [(U.ReadReg, "R1"), (U.ReadMem, "(050)"), (U.ALU, "−"), (U.Compare, "?")])
+        # MOV R1, (R2+300) with extended addressing
+        self.assertEqual(decoded([519, 920, 300], alek.VirtualCPU.Addressing.Extended).microOps(),
+                         [(U.ReadMem, "(R2+300)"), (U.WriteReg, "R1")])
+
+    def test_shared(self):
+        self.assertIs(decoded([110, 2]).microOps(), decoded([110, 2, 999]).microOps())
+        self.assertIsNot(decoded([110, 2]).microOps(), decoded([110, 3]).microOps())
+
+
+class AddressingTest(unittest.TestCase):
+    # operands with the mode cell of extended addressing
+
+    def extended(self, cells, ranges = []):
+        return run(execute(cells, ranges, addressing = alek.VirtualCPU.Addressing.Extended))
+
+    def test_classic(self):
+        # MOV R1, #8; MOV R2, #50; MOV (R2), R1; MOV (60), R1; MOV R3, (50); HLT
+        registers, cells = run(execute([510, 8, 520, 50, 561, 591, 60, 539, 50, 999],
+                                       [[50, 1], [60, 1]]))
+        self.assertEqual(cells, [[8], [8]])
+        self.assertEqual(registers["reg"][3], 8)
+
+    def test_register_modes(self):
+        # MOV R2, #40; MOV R3, #10; MOV R1, (R2+5); MOV R4, (R2+R3); HLT
+        registers, cells = self.extended([520, 40, 530, 10, 519, 205, 549, 923, 999]
+                                         + [0] * 36 + [7, 0, 0, 0, 0, 9])
+        self.assertEqual(registers["reg"][1:5], [7, 40, 10, 9])
+
+    def test_increment(self):
+        # MOV R2, #50; MOV R1, (R2)+; MOV R1, (R2)+; HLT
+        registers, cells = self.extended([520, 50, 519, 922, 519, 922, 999] + [0] * 43 + [7, 8])
+        self.assertEqual(registers["reg"][1:3], [8, 52])
+
+    def test_stack_and_relative(self):
+        # PUSH #5; PUSH #6; MOV R1, (SP+1); MOV R2, (IP+20); MOV R3, (60); HLT
+        registers, cells = self.extended([960, 5, 960, 6, 519, 1, 529, 909, 20, 539, 990, 60, 999]
+                                         + [0] * 16 + [33] + [0] * 30 + [44])
+        self.assertEqual(registers["reg"][1:4], [5, 33, 44])
+
+    def test_write(self):
+        # MOV R2, #50; MOV (R2+5), #7; MOV (R2+###), R2 with ### = 300; HLT
+        registers, cells = self.extended([520, 50, 590, 7, 205, 592, 920, 300, 999], [[55, 1], [350, 1]])
+        self.assertEqual(cells, [[7], [50]])
+
+
+class BlockInstructionTest(unittest.TestCase):
+    # each takes a single step, 1 cycle plus 1 for each cell read or written
+
+    def program(self, code):
+        return code + [0] * (50 - len(code)) + [42, 41, 42, 0]     # "BAB" at 50
+
+    def test_len(self):
+        # LEN R1, #50; HLT
+        registers, cells = run(execute(self.program([890, 310, 50, 999])))
+        self.assertEqual(registers["reg"][1], 3)
+        self.assertEqual(registers["clock"], 1 + 4 + 1)
+
+    def test_scan(self):
+        # MOV R2, #50; SCAN R2, #41; HLT
+        registers, cells = run(execute(self.program([520, 50, 890, 220, 41, 999])))
+        self.assertEqual(registers["reg"][2], 51)
+        self.assertEqual(registers["reg"][alek.VirtualCPU.Reg.Flags], 4)     # "="
+        registers, cells = run(execute(self.program([520, 50, 890, 220, 43, 999])))
+        self.assertNotEqual(registers["reg"][alek.VirtualCPU.Reg.Flags], 4)
+
+    def test_cnt(self):
+        # MOV R2, #50; CNT R2, #42; HLT
+        registers, cells = run(execute(self.program([520, 50, 890, 420, 42, 999])))
+        self.assertEqual(registers["reg"][2], 2)
+
+    def test_movm(self):
+        # MOV R4, #3; MOV R2, #50; MOV R3, #70; MOVM R3, R2; HLT
+        registers, cells = run(execute(self.program([540, 3, 520, 50, 530, 70, 890, 732, 999]),
+                                       [[70, 4]]))
+        self.assertEqual(cells, [[42, 41, 42, 0]])
+        self.assertEqual(registers["reg"][alek.VirtualCPU.Reg.IP], 9)
+
+    def test_pushm_popm(self):
+        # MOV R1..R3, #1..3; PUSHM R1..R3; MOV R1..R3, #0; POPM R1..R3; HLT
+        registers, cells = run(execute([510, 1, 520, 2, 530, 3, 896, 13,
+                                        510, 0, 520, 0, 530, 0, 895, 13, 999], [[997, 3]]))
+        self.assertEqual(cells, [[3, 2, 1]])
+        self.assertEqual(registers["reg"][:4], [0, 1, 2, 3])
+
+
+class LibraryTest(unittest.TestCase):
+    # LIB and SYS routines, each a single step with the documented cycles
+
+    def test_mul_div(self):
+        # MOV R1, #123; MOV R2, #45; MUL; HLT
+        registers, cells = run(execute([510, 123, 520, 45, 987, 1, 999]))
+        self.assertEqual(registers["reg"][1:3], [535, 5])
+        self.assertEqual(registers["clock"], 1 + 1 + 21 + 1)
+        # MOV R1, #999; MOV R2, #7; DIV; HLT
+        registers, cells = run(execute([510, 999, 520, 7, 987, 2, 999]))
+        self.assertEqual(registers["reg"][1:3], [142, 5])
+        self.assertEqual(registers["clock"], 1 + 1 + 31 + 1)
+
+    def test_rand(self):
+        for n in range(20):
+            registers, cells = run(execute([510, 10, 987, 3, 999]))
+            self.assertLess(registers["reg"][1], 10)
+
+    def test_print_fill(self):
+        # MOV R1, #405; MOV R3, #50; PRINT; HLT
+        registers, cells = run(execute([510, 405, 530, 50, 987, 4, 999], [[50, 4]]))
+        self.assertEqual(cells, [[34, 30, 35, 0]])
+        self.assertEqual(registers["reg"][3], 53)
+        self.assertEqual(registers["clock"], 1 + 1 + 5 + 3 * 3 + 1)
+        # MOV R1, #7; MOV R3, #50; MOV R4, #3; FILL; HLT
+        registers, cells = run(execute([510, 7, 530, 50, 540, 3, 987, 5, 999], [[49, 5]]))
+        self.assertEqual(cells, [[0, 7, 7, 7, 0]])
+
+    def test_cls(self):
+        # MOV R1, #5; MOV (700), R1; MOV (899), R1; CLS; HLT
+        registers, cells = run(execute([510, 5, 591, 700, 591, 899, 989, 1, 999], [[700, 1], [899, 1]]))
+        self.assertEqual(cells, [[0], [0]])
+        self.assertEqual(registers["clock"], 1 + 2 + 2 + 203 + 1)
+
+    def test_unknown_routine(self):
+        registers, cells = run(execute([987, 9, 999]))
+        self.assertEqual(registers["state"], alek.VirtualCPU.State.Error)
+
+
+class KeyboardTest(unittest.TestCase):
+    # the key ring buffer at 680..691, IN, OUT and WAIT
+
+    async def session(self, requests):
+        client = alek.LocalClient()
+        await client.connect()
+        replies = []
+        for cmd, args in requests:
+            replies.append(await client.request(cmd, **args))
+        await client.close()
+        return replies
+
+    def test_wait_in_out(self):
+        # WAIT; IN R1; OUT R1; IN R2; HLT
+        replies = run(self.session([
+            ("load", {"cells": [898, 931, 941, 932, 999]}),
+            ("step", {"count": 10}),
+            ("key", {"key": 65}),
+            ("step", {"count": 10}),
+            ("registers", {}),
+            ("read", {"ranges": [[680, 1], [690, 3]]}),
+        ]))
+        self.assertEqual(replies[1]["state"], alek.VirtualCPU.State.Waiting)
+        self.assertEqual(replies[3]["state"], alek.VirtualCPU.State.Idle)
+        self.assertEqual(replies[4]["reg"][1:3], [65, 0])
+        self.assertEqual(replies[5]["cells"], [[65], [1, 1, 65]])
+
+    def test_buffer_full(self):
+        replies = run(self.session([("key", {"key": k}) for k in range(10)]))
+        self.assertTrue(all(["ok" in reply for reply in replies[:9]]))
+        self.assertIn("error", replies[9])
+
+
+class ClockTest(unittest.TestCase):
+    # cycles of instructions, and running at a frequency
+
+    def test_cycles(self):
+        # MOV R1, #1; ADD R1, (50); PUSH R1; POP R2; CALL 20; HLT; at 20: RET
+        registers, cells = run(execute([510, 1, 119, 50, 961, 952, 970, 20, 999] + [0] * 11 + [997]))
+        self.assertEqual(registers["clock"], 1 + 3 + 2 + 2 + 3 + 3 + 1)
+        self.assertEqual(registers["reg"][alek.VirtualCPU.Reg.Clk], registers["clock"] % 1000)
+
+    def test_frequency(self):
+        # JMP 0 (2 cycles) at 100 Hz, with times in seconds since the start
+        machine = alek.Machine()
+        machine.mem[machine.map[0]] = 770
+        machine.reset()
+        clock = alek.ExecClock([machine.cpu], 100)
+        clock.start(0.0)
+        clock.run(0.3)
+        self.assertEqual(machine.cpu.clock, 30)
+        clock.run(0.4)
+        self.assertEqual(machine.cpu.clock, 40)
+        clock.run(5.0)      # late, only maxLag is caught up
+        self.assertEqual(machine.cpu.clock, 40 + 100 * clock.maxLag)
+
+
+class InterruptTest(unittest.TestCase):
+    # timer and video frame interrupts, handler at 20: ADD R1, #1; RET
+    Handler = [0] * 12 + [110, 1, 997]
+
+    def test_timer(self):
+        # MOV (694), #20; MOV (693), #50; JMP 6
+        registers, cells = run(execute([590, 20, 694, 590, 50, 693, 770, 6] + self.Handler,
+                                       [[695, 1]], count = 100))
+        self.assertEqual(registers["clock"], 203)   # 3 periods of 50 cycles
+        self.assertEqual(cells, [[3]])
+        self.assertEqual(registers["reg"][1], 3)
+
+    def test_frame(self):
+        # MOV (696), #20; JMP 3
+        registers, cells = run(execute([590, 20, 696, 770, 3] + [0] * 3 + self.Handler,
+                                       [[697, 1]], count = 2000))
+        frames = registers["clock"] // 1000
+        self.assertEqual(cells, [[frames]])
+        self.assertEqual(registers["reg"][1], frames)
+
+    def test_wait_ends(self):
+        # MOV (694), #20; MOV (693), #50; WAIT; HLT
+        registers, cells = run(execute([590, 20, 694, 590, 50, 693, 898, 999] + self.Handler,
+                                       [[695, 1]], count = 100))
+        self.assertEqual(registers["state"], alek.VirtualCPU.State.Idle)
+        self.assertEqual(registers["reg"][1], 1)
+        self.assertLess(registers["clock"], 100)
+
+
+class MultiCPUTest(unittest.TestCase):
+    # CPUs share all pages but their stack page, and take turns
+
+    def test_shared_page(self):
+        # CPU 0: MOV R1, #7; PUSH R1; MOV (400), R1; HLT
+        # CPU 1: CMP (400), #0; JMP= 100; PUSH #5; MOV R2, (400); HLT
+        machine = alek.Machine()
+        for a, cells in [(0, [510, 7, 961, 591, 400, 999]),
+                         (100, [690, 400, 0, 740, 100, 960, 5, 529, 400, 999])]:
+            for i, c in enumerate(cells):
+                machine.mem[machine.map[a + i]] = c
+        machine.reset()
+        second = alek.VirtualCPU(1)
+        second.mapPages([9])
+        second.state = second.State.Running
+        cpus = [machine.cpu, second]
+        clock = alek.ExecClock(cpus, 0)
+        for i in range(100):
+            if clock.step() == None:
+                break
+        self.assertEqual(clock.state(), alek.VirtualCPU.State.Idle)
+        self.assertEqual(second.reg[2], 7)
+        self.assertEqual([machine.mem[c.map[999]] for c in cpus], [7, 5])
+
+
+class SharedStateTest(unittest.TestCase):
+    # memory and registers moved into shared memory, as seen by another process
+
+    def test_attach(self):
+        machine = alek.Machine()
+        for i, c in enumerate([510, 7, 591, 500, 999]):
+            machine.mem[machine.map[i]] = c
+        machine.reset()
+        cpu = machine.cpu
+        alek.shareState([cpu])
+        try:
+            other = alek.SharedState(alek.sharedState.name)
+            self.assertEqual(other.cells[machine.map[0]], 510)
+            for i in range(3):
+                cpu.fetch()
+                cpu.execute()
+            self.assertEqual(other.cells[machine.map[500]], 7)
+            self.assertEqual(other.regs[0][1], 7)
+            other.cells[machine.map[501]] = 8
+            other.close()
+        finally:
+            alek.unshareState([cpu])
+        self.assertEqual(alek.Mem[machine.map[501]], 8)
+        self.assertEqual(cpu.reg[1], 7)
+        self.assertIsInstance(cpu.reg, list)
+
+
+class MachineStateTest(unittest.TestCase):
+    # machines stay small: no instance dicts, cells in 16-bit arrays
+
+    def test_compact(self):
+        machine = alek.Machine()
+        for obj in [machine.cpu, machine.cpu.bus, machine.gpu]:
+            self.assertFalse(hasattr(obj, "__dict__"), type(obj).__name__)
+        with self.assertRaises(AttributeError):
+            machine.cpu.scratch = 1
+        self.assertEqual(machine.mem.typecode, "H")
+        self.assertEqual(machine.gpu.ColorMap.typecode, "I")
+
+
+class DebuggingTest(unittest.TestCase):
+    # watchpoints, run until return and register conditions
+
+    def machine(self, cells):
+        machine = alek.Machine()
+        for i, c in enumerate(cells):
+            machine.mem[machine.map[i]] = c
+        machine.reset()
+        return machine
+
+    def test_watchpoint(self):
+        # MOV R1, #5; MOV (50), R1; MOV R1, #6; HLT
+        machine = self.machine([510, 5, 591, 50, 510, 6, 999])
+        machine.stops[50] |= alek.VirtualCPU.Stop.Watch
+        machine.run(100)
+        cpu = machine.cpu
+        self.assertEqual((cpu.state, cpu.reg[cpu.Reg.IP]), (cpu.State.Break, 4))
+
+    def test_run_until_return(self):
+        # CALL 20; HLT; at 20: CALL 30; RET; at 30: RET
+        machine = self.machine([970, 20, 999] + [0] * 17 + [970, 30, 997] + [0] * 7 + [997])
+        cpu = machine.cpu
+        machine.run(1)
+        cpu.runUntilReturn(cpu.stackDepth() - 1)
+        machine.run(100)
+        self.assertEqual((cpu.state, cpu.reg[cpu.Reg.IP]), (cpu.State.Break, 2))
+
+    def test_condition(self):
+        # ADD R1, #1; JMP 0, stops when R1 changes to 3
+        machine = self.machine([110, 1, 770, 0])
+        values = bytearray(alek.Cells)
+        values[3] = 1
+        machine.conditions.append([1, values, [-1] * 10])
+        machine.run(100)
+        cpu = machine.cpu
+        self.assertEqual((cpu.state, cpu.reg[1], cpu.reg[cpu.Reg.IP]), (cpu.State.Break, 3, 2))
+
+
+class DebugProtocolTest(unittest.TestCase):
+    # requests of the debug server, handled in this process by LocalClient
+
+    async def session(self, requests):
+        client = alek.LocalClient()
+        await client.connect()
+        replies = []
+        for cmd, args in requests:
+            replies.append(await client.request(cmd, **args))
+        await client.close()
+        return replies
+
+    def test_load_step_read(self):
+        # MOV R1, #5; ADD R1, #2; MOV (700), R1; HLT
+        load, step, read, registers = run(self.session([
+            ("load", {"cells": [510, 5, 110, 2, 591, 700, 999]}),
+            ("step", {"count": 100}),
+            ("read", {"ranges": [[0, 3], [700, 1]]}),
+            ("registers", {}),
+        ]))
+        self.assertTrue(load["ok"])
+        self.assertEqual(step["steps"], 4)
+        self.assertEqual(step["state"], alek.VirtualCPU.State.Idle)
+        self.assertEqual(read["cells"], [[510, 5, 110], [7]])
+        self.assertEqual(registers["reg"][1], 7)
+
+    def test_breakpoint(self):
+        step, registers = run(self.session([
+            ("load", {"cells": [510, 5, 110, 2, 999]}),
+            ("break", {"address": 2}),
+            ("step", {"count": 100}),
+            ("registers", {}),
+        ]))[2:]
+        self.assertEqual(step["state"], alek.VirtualCPU.State.Break)
+        self.assertEqual(registers["reg"][alek.VirtualCPU.Reg.IP], 2)
+
+    def test_write_and_console(self):
+        replies = run(self.session([
+            ("write", {"address": 692, "cells": [alek.CharToNum[ord("A")]]}),
+            ("console", {}),
+        ]))
+        self.assertEqual(replies[1]["lines"], ["A"])
+
+    def test_code_on_device_page(self):
+        # JMP 679, then at 679: MOV R1, #(680); JMP 679 with 680 the first cell
+        # of the keyboard buffer, on read-only page 6
+        replies = run(self.session([
+            ("load", {"cells": [770, 679]}),
+            ("write", {"address": 679, "cells": [510, 0, 770, 679]}),
+            ("protect", {"page": 6, "flags": alek.VirtualCPU.PageFlag.ReadOnly}),
+            ("step", {"count": 10}),
+            ("registers", {}),
+            ("key", {"key": 42}),
+            ("step", {"count": 10}),
+            ("registers", {}),
+        ]))
+        self.assertEqual(replies[4]["reg"][1], 0)
+        self.assertEqual(replies[7]["reg"][1], 42)
+
+    def test_errors(self):
+        async def requests():
+            client = alek.LocalClient()
+            await client.connect()
+            replies = [
+                await client.request("nothing"),
+                await client.request("read"),
+                await client.request("write", cells = [1e400]),
+                await client.session.handle([1, 2]),
+                await client.request("registers"),
+            ]
+            sessions = client.manager.metrics()["sessions"]
+            await client.close()
+            return replies, sessions, client.manager.metrics()["sessions"]
+        replies, opened, closed = run(requests())
+        for reply in replies[:4]:
+            self.assertIn("error", reply)
+        self.assertTrue(replies[4]["ok"])
+        self.assertEqual((opened, closed), (1, 0))
+
+
+class MemoryTest(unittest.TestCase):
+    # 4-digit cells, pages 10..99 are allocated by their first write
+
+    def setUp(self):
+        alek.configureMemory(4)
+
+    def tearDown(self):
+        alek.configureMemory(3)
+
+    async def session(self, requests):
+        client = alek.LocalClient()
+        await client.connect()
+        replies = []
+        for cmd, args in requests:
+            replies.append(await client.request(cmd, **args))
+        flags = bytes(client.session.machine.pageFlags)
+        await client.close()
+        return replies, flags
+
+    def test_wrap_around(self):
+        # MOV R1, #9999; ADD R1, #2; HLT
+        replies, flags = run(self.session([
+            ("load", {"cells": [510, 9999, 110, 2, 999]}),
+            ("step", {"count": 10}),
+            ("registers", {}),
+        ]))
+        self.assertEqual(replies[2]["reg"][1], 1)
+
+    def test_sparse_pages(self):
+        # MOV R1, #7; MOV (1505), R1; HLT
+        replies, flags = run(self.session([
+            ("load", {"cells": [510, 7, 591, 1505, 999]}),
+            ("step", {"count": 10}),
+            ("read", {"ranges": [[1505, 1], [4205, 1], [9905, 1]]}),
+        ]))
+        self.assertEqual(replies[2]["cells"], [[7], [0], [0]])
+        self.assertEqual(flags[15], 0)
+        self.assertEqual(flags[42], alek.VirtualCPU.PageFlag.Unallocated)
+
+    def test_protect_unallocated(self):
+        # protecting a page must not map its writes to the shared zero page
+        replies, flags = run(self.session([
+            ("load", {"cells": [510, 7, 591, 1505, 999]}),
+            ("protect", {"page": 15, "flags": alek.VirtualCPU.PageFlag.NoExecute}),
+            ("step", {"count": 10}),
+            ("read", {"ranges": [[1505, 1], [4205, 1], [9905, 1]]}),
+        ]))
+        self.assertEqual(replies[3]["cells"], [[7], [0], [0]])
+        self.assertEqual(flags[15], alek.VirtualCPU.PageFlag.NoExecute)
+
+    def test_stack_page(self):
+        # PUSH #5; HLT, the stack page 99 gets its cells at the first push
+        async def push():
+            client = alek.LocalClient()
+            await client.connect()
+            await client.request("load", cells = [960, 5, 999])
+            cells = len(client.session.machine.mem)
+            await client.request("step", count = 10)
+            read = await client.request("read", ranges = [[9999, 1]])
+            grown = len(client.session.machine.mem) - cells
+            await client.close()
+            return read["cells"], grown
+        self.assertEqual(run(push()), ([[5]], 100))
+
+    def test_not_an_instruction(self):
+        # 4-digit cells above 999 are no instruction codes
+        replies, flags = run(self.session([
+            ("load", {"cells": [1110, 1, 999]}),
+            ("step", {"count": 10}),
+        ]))
+        self.assertEqual(replies[1]["state"], alek.VirtualCPU.State.Error)
+
+
+class SessionManagerTest(unittest.TestCase):
+    # many sessions run in the background of one asyncio loop
+
+    def test_run_many(self):
+        async def classroom():
+            manager = alek.SessionManager()
+            clients = []
+            for n in range(30):
+                client = alek.LocalClient(manager)
+                await client.connect()
+                # MOV R1, #0; ADD R1, #1; CMP R1, #(100 + n); JMP< 2; HLT
+                await client.request("load", cells = [510, 0, 110, 1, 610, 100 + n, 710, 2, 999])
+                await client.request("run")
+                clients.append(client)
+            for i in range(200):
+                if manager.metrics()["running"] == 0:
+                    break
+                await asyncio.sleep(0.01)
+            results = [(await client.request("registers"))["reg"][1] for client in clients]
+            metrics = await clients[0].request("metrics")
+            for client in clients:
+                await client.close()
+            return results, metrics
+        results, metrics = run(classroom())
+        self.assertEqual(results, [100 + n for n in range(30)])
+        self.assertEqual((metrics["sessions"], metrics["running"]), (30, 0))
+        self.assertGreater(metrics["steps"], 0)
+
+
+class EditHistoryTest(unittest.TestCase):
+    # undo and redo of memory edits, as done by the UI
+
+    def setUp(self):
+        alek.configureMemory(3)
+
+    def tearDown(self):
+        alek.configureMemory(3)
+
+    def edit(self, history, a, cells):
+        history.begin(alek.Map)
+        history.save(a, len(cells))
+        for i, c in enumerate(cells):
+            alek.touchPage(a + i)
+            alek.Mem[alek.Map[a + i]] = c
+        history.end()
+
+    def cells(self, a, n):
+        return [alek.Mem[alek.Map[a + i]] for i in range(n)]
+
+    def test_undo_redo(self):
+        history = alek.EditHistory()
+        self.edit(history, 98, [1, 2, 3, 4])    # across pages 0 and 1
+        self.edit(history, 99, [5])
+        self.assertEqual(self.cells(98, 4), [1, 5, 3, 4])
+        history.undo()
+        self.assertEqual(self.cells(98, 4), [1, 2, 3, 4])
+        history.undo()
+        self.assertEqual(self.cells(98, 4), [0, 0, 0, 0])
+        self.assertEqual(history.undo(), [])
+        history.redo()
+        self.assertEqual(self.cells(98, 4), [1, 2, 3, 4])
+        self.edit(history, 0, [7])              # drops the redo of 99
+        self.assertEqual(history.redo(), [])
+        self.assertEqual(history.cells, 2 * 4 + 2 * 1)
+
+    def test_unchanged_edit(self):
+        history = alek.EditHistory()
+        self.edit(history, 10, [0, 0])
+        self.assertEqual((history.undoList, history.cells), ([], 0))
+
+    def test_whole_memory(self):
+        # loading a project saves all cells, but keeps only the changed ones
+        history = alek.EditHistory()
+        self.edit(history, 500, [9, 8])
+        history.begin(alek.Map)
+        history.save(0, alek.Cells)
+        for a in range(alek.Cells):
+            alek.Mem[alek.Map[a]] = 0
+        alek.Mem[alek.Map[3]] = 1
+        history.end()
+        self.assertEqual(len(history.undoList), 2)
+        self.assertEqual(history.cells, 2 * 2 + 2 * 100 + 2 * 100)
+        history.undo()
+        self.assertEqual(self.cells(0, 4) + self.cells(500, 2), [0, 0, 0, 0, 9, 8])
+
+    def test_dropped_edits(self):
+        history = alek.EditHistory()
+        history.MaxCells = 500
+        for n in range(3):
+            self.edit(history, 0, [n + 1] * 100)
+        self.assertEqual(len(history.undoList), 2)
+        history.undo()
+        history.undo()
+        self.assertEqual(self.cells(0, 2), [1, 1])
+
+    def test_allocated_page(self):
+        # a 4-digit page allocated by the edit gets back its zeros
+        alek.configureMemory(4)
+        history = alek.EditHistory()
+        self.edit(history, 4205, [6])
+        self.assertEqual(self.cells(4205, 1), [6])
+        history.undo()
+        self.assertEqual(self.cells(4200, 10), [0] * 10)
+        history.redo()
+        self.assertEqual(self.cells(4205, 1), [6])
+
+
+class ReadOnlyCodeTest(unittest.TestCase):
+    # code on a read-only page (decoded once, fused pairs) must leave the
+    # same registers, flags, memory and clock as unprotected code
+    Sub = 80            # RET
+    Handler = 90        # timer interrupt: ADD R4, #1; MOV (599), R4; RET
+
+    def randomProgram(self, rnd, pairs, timer):
+        code = [510, rnd.randrange(1000), 520, rnd.randrange(1000),
+                530, rnd.randrange(1000), 540, rnd.randrange(1000)]
+        if timer:
+            code += [590, self.Handler, 694, 590, rnd.randrange(20, 90), 693]
+        head = len(code)
+        choices = [[110, 1], [210, rnd.randrange(1000)], [912], [923], [524], [134],
+                   [591, 500 + rnd.randrange(99)], [139, 500 + rnd.randrange(99)],
+                   [516], [990, 132], [890, 320, 500]]
+        if pairs:
+            choices += [[620, rnd.randrange(1000), 710 + 10 * rnd.randrange(7), len(code)],
+                        [520 + 10 * rnd.randrange(3), rnd.randrange(1000), 110, rnd.randrange(1000)],
+                        [961, 970, self.Sub, 952]]
+        while len(code) < self.Sub - 8:
+            code += rnd.choice(choices)
+        code += [610, rnd.randrange(1000), 700 + 10 * rnd.randrange(1, 7), head, 999]
+        code += [0] * (self.Sub - len(code)) + [997]
+        code += [0] * (self.Handler - len(code)) + [140, 1, 594, 599, 997]
+        return code
+
+    async def session(self, requests):
+        client = alek.LocalClient()
+        await client.connect()
+        replies = []
+        for cmd, args in requests:
+            replies.append(await client.request(cmd, **args))
+        await client.close()
+        return replies
+
+    async def runProgram(self, client, code, protect):
+        await client.request("load", cells = code)
+        if protect:
+            await client.request("protect", page = 0, flags = alek.VirtualCPU.PageFlag.ReadOnly)
+        step = await client.request("step", count = 2000)
+        registers = await client.request("registers")
+        cells = (await client.request("read", ranges = [[0, 1000]]))["cells"]
+        self.decoded = dict(client.session.machine.cpu.decoded)
+        await client.request("protect", page = 0, flags = 0)
+        return step["state"], registers, cells
+
+    def compare(self, pairs, timer):
+        async def compare():
+            rnd = random.Random(3)
+            client = alek.LocalClient()
+            await client.connect()
+            decoded = 0
+            fused = 0
+            for n in range(60):
+                code = self.randomProgram(rnd, pairs, timer)
+                unprotected = await self.runProgram(client, code, False)
+                self.assertEqual(unprotected, await self.runProgram(client, code, True), code)
+                decoded += len(self.decoded)
+                fused += len([a for a in self.decoded if self.decoded[a][2] != None])
+            await client.close()
+            return decoded, fused
+        return run(compare())
+
+    def test_same_state(self):
+        decoded, fused = self.compare(False, False)
+        self.assertGreater(decoded, 1000)
+
+    def test_fused_pairs(self):
+        # CMP + JMPcc, MOV to a register + ADD and PUSH + CALL, with timer
+        # interrupts that may come between the two instructions of a pair
+        decoded, fused = self.compare(True, True)
+        self.assertGreater(fused, 100)
+
+    def test_break_inside_pair(self):
+        # MOV R1, #5; ADD R1, #2; JMP 0, the breakpoint at the ADD is set
+        # after the first round decoded the pair
+        replies = run(self.session([
+            ("load", {"cells": [510, 5, 110, 2, 770, 0]}),
+            ("protect", {"page": 0, "flags": alek.VirtualCPU.PageFlag.ReadOnly}),
+            ("step", {"count": 3}),
+            ("break", {"address": 2}),
+            ("step", {"count": 10}),
+            ("registers", {}),
+        ]))
+        registers = replies[5]
+        self.assertEqual(replies[4]["steps"], 1)
+        self.assertEqual(registers["state"], alek.VirtualCPU.State.Break)
+        self.assertEqual((registers["reg"][1], registers["reg"][alek.VirtualCPU.Reg.IP]), (5, 2))
+
+
+class FastLoopsTest(unittest.TestCase):
+    # skipped loops must leave the same registers, flags, memory and clock
+    # as running every instruction
+
+    def loopProgram(self, rnd):
+        # set R1..R4, then a loop with a CMP and a JMPcc back or out of it
+        code = [510, rnd.randrange(1000), 520, rnd.randrange(1000),
+                530, rnd.randrange(1000), 540, rnd.randrange(1000)]
+        head = len(code)
+        for k in range(rnd.randrange(1, 5)):
+            code += rnd.choice([[110, 1], [210, 1], [911], [921], [123], [224], [134],
+                                [532], [120, rnd.randrange(1000)], [594, 950], [593, 960],
+                                [998], [543, 914, 0]])
+        code += [600 + 10 * rnd.choice([1, 2]), rnd.randrange(1000)]
+        if rnd.random() < 0.5:
+            code += [700 + 10 * rnd.randrange(1, 7), -1, 770, head]   # -1: the HLT
+        else:
+            code += [700 + 10 * rnd.randrange(1, 7), head]
+        code += [999]
+        return [len(code) - 1 if c == -1 else c for c in code]
+
+    async def runProgram(self, client, code, fastLoops):
+        await client.request("load", cells = code, fastLoops = fastLoops)
+        step = await client.request("step", count = 30000)
+        registers = await client.request("registers")
+        cells = (await client.request("read", ranges = [[0, 1000]]))["cells"]
+        return step["state"], registers, cells
+
+    def test_same_state(self):
+        async def compare():
+            rnd = random.Random(2)
+            client = alek.LocalClient()
+            await client.connect()
+            checked = 0
+            skipped = 0
+            for n in range(150):
+                code = self.loopProgram(rnd)
+                state, registers, cells = await self.runProgram(client, code, False)
+                if state == alek.VirtualCPU.State.Running:
+                    continue    # did not halt in time
+                self.assertEqual((state, registers, cells),
+                                 await self.runProgram(client, code, True), code)
+                skipped += client.session.machine.cpu.loops.skipped
+                checked += 1
+            await client.close()
+            return checked, skipped
+        checked, skipped = run(compare())
+        self.assertGreater(checked, 100)
+        self.assertGreater(skipped, 0)
+
+
+class ConsoleTest(unittest.TestCase):
+    # lines written to the output port, kept in a ring of Backlog lines
+
+    def write(self, machine, text):
+        for c in text:
+            machine.mem[machine.map[alek.VirtualIO.Addr.Out]] = c
+            machine.console.written()
+
+    def test_lines(self):
+        machine = alek.Machine()
+        A = alek.CharToNum[ord("A")]
+        # 12 characters wrap after Width, Backspace removes the last one
+        self.write(machine, [A] * 12 + [3, 2, A + 1])
+        self.assertEqual(machine.console.lineTexts(), ["AAAAAAAAAA", "A", "B"])
+
+    def test_backlog(self):
+        machine = alek.Machine()
+        console = machine.console
+        for n in range(console.Backlog + 20):
+            self.write(machine, [alek.CharToNum[ord(c)] for c in str(n)] + [2])
+        lines = console.lineTexts()
+        self.assertEqual(len(lines), console.Backlog)
+        self.assertEqual(lines[-2:], [str(console.Backlog + 19), ""])
+        # the last 10 lines, and scrolled back by 5
+        rows = console.rows(10)
+        self.assertEqual(rows[-1], console.Width * console.line)
+        machine.mem[machine.map[console.Addr.Scroll]] = 5
+        self.assertEqual(console.rows(10)[-1], console.Width * ((console.line - 5) % console.Backlog))
+
+
+class SpriteTest(unittest.TestCase):
+    # sprite pixmaps are only made again when their color cells change
+
+    @classmethod
+    def setUpClass(cls):
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        cls.app = alek.QApplication.instance() or alek.QApplication([])
+
+    def setUp(self):
+        self.machine = alek.Machine()
+        self.gpu = self.machine.gpu
+        # sprite 0 at (8, 4) with the color cells at 500: a red dot at the
+        # top left, everything else transparent
+        self.write(alek.VirtualGPU.Addr.Sprites, [1, 8, 4, 500])
+        self.write(500, [900])
+
+    def write(self, a, cells):
+        for i, c in enumerate(cells):
+            self.machine.mem[self.machine.map[a + i]] = c
+
+    def test_cached(self):
+        pixmap = self.gpu.spritePixmap(500, 2)
+        self.assertIs(self.gpu.spritePixmap(500, 2), pixmap)
+        self.write(501, [90])
+        self.assertIsNot(self.gpu.spritePixmap(500, 2), pixmap)
+        pixmap = self.gpu.spritePixmap(500, 2)
+        self.assertIsNot(self.gpu.spritePixmap(500, 3), pixmap)
+        self.gpu.setPalette(1)
+        self.assertEqual(self.gpu.sprites, {})
+
+    def test_paint(self):
+        image = alek.QImage(80, 80, alek.QImage.Format.Format_ARGB32)
+        image.fill(0)
+        painter = alek.QPainter(image)
+        self.gpu.paintSprites(painter, alek.QRect(0, 0, 80, 80))    # 2 pixels a dot
+        painter.end()
+        self.assertEqual(image.pixel(16, 8), self.gpu.ColorMap[900])
+        self.assertEqual(image.pixel(17, 9), self.gpu.ColorMap[900])
+        self.assertEqual(image.pixel(18, 8), 0)     # transparent
+
+
+class AnalyzerTest(unittest.TestCase):
+    # control flow found without running the program
+
+    async def session(self, cells, writes = []):
+        client = alek.LocalClient()
+        await client.connect()
+        await client.request("load", cells = cells)
+        replies = [await client.request("analyze")]
+        for address, written in writes:
+            await client.request("write", address = address, cells = written)
+            replies.append(await client.request("analyze"))
+        await client.close()
+        return replies
+
+    def test_loop(self):
+        # MOV R1, #3; SUB R1, #1; CMP R1, #0; JMP> 2; HLT; then MOV R1, #7
+        reply, = run(self.session([510, 3, 210, 1, 610, 0, 720, 2, 999, 510, 7]))
+        self.assertEqual(reply["blocks"], [[0, 2, [2]], [2, 8, [8, 2]], [8, 9, []]])
+        self.assertEqual(reply["loops"], [[2, 6]])
+        self.assertEqual(reply["unreachable"], [9, 10])
+        self.assertEqual((reply["bad"], reply["maxStack"]), ([], 0))
+
+    def test_call(self):
+        # CALL 10; HLT; at 10: PUSH R1; POP R2; RET
+        reply, = run(self.session([970, 10, 999] + [0] * 7 + [961, 952, 997]))
+        self.assertEqual((reply["calls"], reply["returns"]), ([10], [12]))
+        self.assertEqual(reply["maxStack"], 2)
+
+    def test_recursion(self):
+        # CALL 0, the stack grows without limit
+        reply, = run(self.session([970, 0]))
+        self.assertEqual(reply["loops"], [[0, 0]])
+        self.assertEqual(reply["maxStack"], None)
+
+    def test_bad_code(self):
+        # MOV R1, #770; JMP 1 runs the operand 770 as JMP 770
+        reply, = run(self.session([510, 770, 770, 1]))
+        self.assertEqual(reply["bad"], [1, 2, 770])
+
+    def test_handler(self):
+        # MOV (694), #20; HLT; at 20: RET
+        reply, = run(self.session([590, 20, 694, 999] + [0] * 16 + [997]))
+        self.assertEqual(reply["handlers"], [20])
+        self.assertEqual(reply["maxStack"], 1)
+
+    def test_edit(self):
+        # MOV R1, #3; HLT, then the HLT becomes ADD R1, #1; HLT
+        replies = run(self.session([510, 3, 999], [(2, [110, 1, 999])]))
+        self.assertEqual([reply["blocks"] for reply in replies], [[[0, 3, []]], [[0, 5, []]]])
+
+
+class VideoTest(unittest.TestCase):
+    # double buffering with FLIP, next to the code of other CPUs
+
+    def test_flip_keeps_code_of_cpus(self):
+        # CPU 0: FLIP; CLS; HLT, CPUs 1 and 2: HLT, CPU 3: ADD R1, #1; JMP 300
+        async def flip():
+            client = alek.LocalClient()
+            await client.connect()
+            await client.request("load", cells = [989, 2, 989, 1, 999])
+            await client.request("write", address = 100, cells = [999])
+            await client.request("write", address = 200, cells = [999])
+            await client.request("write", address = 300, cells = [110, 1, 770, 300])
+            machine = client.session.machine
+            machine.select()
+            cpus = [machine.cpu]
+            for n in range(1, 4):
+                c = alek.VirtualCPU(n)
+                c.mapPages([9])
+                c.state = c.State.Running
+                cpus.append(c)
+            for i in range(10):
+                for c in cpus:
+                    if c.state == c.State.Running:
+                        c.fetch()
+                        c.execute()
+            code = (await client.request("read", ranges = [[300, 4]]))["cells"]
+            shown = machine.gpu.txtmem
+            await client.close()
+            return [c.state for c in cpus], code, shown
+        states, code, shown = run(flip())
+        self.assertEqual(code, [[110, 1, 770, 300]])
+        self.assertEqual(states, [alek.VirtualCPU.State.Idle] * 3 + [alek.VirtualCPU.State.Running])
+        self.assertNotEqual(shown, 700)
+
+
+class PaletteTest(unittest.TestCase):
+    # palettes are computed once and shared, their QColors made once
+
+    def tearDown(self):
+        alek.configureMemory(3)
+
+    def test_shared(self):
+        first = alek.Machine().gpu
+        second = alek.Machine().gpu
+        self.assertIs(first.ColorMap, second.ColorMap)
+        colors = first.Colors
+        first.setPalette(2)
+        first.reset()
+        self.assertEqual(first.palette, 2)
+        first.setPalette(0)
+        self.assertIs(first.Colors, colors)
+        self.assertEqual(colors[999].rgb(), first.ColorMap[999])
+
+    def test_gray_and_contrast(self):
+        gray, contrast = alek.Palettes[1][1], alek.Palettes[2][1]
+        for c in [123, 456, 900]:
+            color = alek.QColor(gray[c])
+            self.assertEqual(color.red(), color.green())
+            self.assertEqual(color.green(), color.blue())
+        self.assertEqual(contrast[29], alek.qRgb(0, 0, 255))
+
+    def test_four_digits(self):
+        alek.configureMemory(4)
+        gpu = alek.Machine().gpu
+        self.assertEqual(len(gpu.ColorMap), alek.Cells)
+        self.assertEqual(gpu.ColorMap[4567], gpu.ColorMap[567])
+        self.assertIs(gpu.Colors[4567], gpu.Colors[567])
+
+
+class JournalTest(unittest.TestCase):
+    # autosave journal lines, replayed on the next start
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "autosave.alek")
+        self.journal = alek.Journal(self.path)
+
+    def tearDown(self):
+        self.journal.close()
+        self.directory.cleanup()
+
+    def test_append_and_replay(self):
+        self.journal.compact(["{'mem_digits': 3}\n", "{'mem': [0, [510, 7]]}\n"], 0.0)
+        self.journal.append({'mem': [1, [8]]})
+        self.journal.append({'cpu_reg': [0, 8, 0]})
+        self.journal.close()
+        records, error = alek.Journal(self.path).replay()
+        self.assertEqual(records, [{'mem_digits': 3}, {'mem': [0, [510, 7]]},
+                                   {'mem': [1, [8]]}, {'cpu_reg': [0, 8, 0]}])
+        self.assertEqual(error, None)
+
+    def test_torn_last_line(self):
+        with open(self.path, "w") as fh:
+            fh.write("ALEKv001\n{'mem': [0, [510, 7]]}\n{'mem': [1, [")
+        records, error = self.journal.replay()
+        self.assertEqual(records, [{'mem': [0, [510, 7]]}])
+        self.assertEqual(error, None)
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_corrupt_line(self):
+        # replay stops at the corrupt line, and the file is kept aside
+        with open(self.path, "w") as fh:
+            fh.write("ALEKv001\n{'mem': [0, [510, 7]]}\n{'mem': [0, [oops\n"
+                     "{'mem': [5, [1]]}\n")
+        records, error = self.journal.replay()
+        self.assertEqual(records, [{'mem': [0, [510, 7]]}])
+        self.assertTrue(error.startswith("line 3"))
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(os.path.exists(self.path + ".bad"))
+
+    def test_bad_records(self):
+        for line in ["[1, 2]\n", "{'mem': 5}\n", "{'cpu_reg': [-1]}\n",
+                     "{'mem_digits': 7}\n", "__import__('os')\n"]:
+            records, error = alek.projectRecords(["{'cpu_state': 1}\n", line])
+            self.assertEqual((records, error[:6]), ([{'cpu_state': 1}], "line 3"), line)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+class ProgramCacheTest(unittest.TestCase):
+    # analyses kept on disk when a program is loaded or run
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.programCache = alek.programCache
+        alek.programCache = alek.ProgramCache(self.directory.name)
+
+    def tearDown(self):
+        alek.programCache = self.programCache
+        self.directory.cleanup()
+
+    def files(self):
+        return sorted(os.listdir(self.directory.name))
+
+    async def session(self, requests):
+        client = alek.LocalClient()
+        await client.connect()
+        for cmd, args in requests:
+            await client.request(cmd, **args)
+        cpu = client.session.machine.cpu
+        analyzer = client.session.analyzer
+        await client.close()
+        return cpu, analyzer
+
+    def test_known_program(self):
+        # MOV R1, #5; ADD R1, #2; HLT, the second load is not decoded
+        load = ("load", {"cells": [510, 5, 110, 2, 999]})
+        cpu, analyzer = run(self.session([load]))
+        self.assertEqual(len(self.files()), 1)
+        decode = alek.ProgramAnalyzer.decode
+        try:
+            alek.ProgramAnalyzer.decode = None
+            cpu, known = run(self.session([load]))
+        finally:
+            alek.ProgramAnalyzer.decode = decode
+        self.assertEqual(known.results(), analyzer.results())
+        self.assertEqual(len(self.files()), 1)
+
+    def test_edits_not_cached(self):
+        cpu, analyzer = run(self.session([
+            ("load", {"cells": [510, 5, 999]}),
+            ("write", {"address": 2, "cells": [110, 2, 999]}),
+            ("analyze", {}),
+        ]))
+        self.assertEqual(analyzer.kinds[4], alek.ProgramAnalyzer.Cell.Code)
+        self.assertEqual(len(self.files()), 1)
+
+    def test_predecoded(self):
+        # instructions of a read-only page are decoded at the load, the
+        # MOV to R1 with the ADD as a fused pair
+        cpu, analyzer = run(self.session([
+            ("protect", {"page": 0, "flags": alek.VirtualCPU.PageFlag.ReadOnly}),
+            ("load", {"cells": [510, 5, 110, 2, 999]}),
+        ]))
+        self.assertEqual(sorted(cpu.decoded), [0, 2, 4])
+        self.assertEqual(cpu.decoded[0][:2], ([510, 5, 110, 2, 999, 0, 0, 0, 0, 0], 2))
+        self.assertNotEqual(cpu.decoded[0][2], None)
+        self.assertEqual(cpu.decoded[2][2], None)
+
+    def test_eviction(self):
+        cache = alek.programCache
+        cache.MaxFiles = 2
+        for n, key in enumerate(["a", "b", "c"]):
+            cache.store(key, (n,))
+            os.utime(os.path.join(self.directory.name, key), (n, n))
+        self.assertEqual(self.files(), ["b", "c"])
+        self.assertEqual(cache.load("b"), (1,))
+        cache.store("d", (3,))
+        self.assertEqual(self.files(), ["b", "d"])  # b was used after c
+
+    def test_size_limits(self):
+        cache = alek.programCache
+        cache.store("big", (bytes(cache.MaxFileBytes),))
+        self.assertEqual(self.files(), [])
+        cache.MaxBytes = 100
+        for key in ["a", "b", "c"]:
+            cache.store(key, (bytes(40),))
+        self.assertEqual(self.files(), ["b", "c"])